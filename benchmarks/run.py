@@ -0,0 +1,477 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: (c) 2023 SUSE LLC
+#
+# This file is part of obs-service-replace_using_package_version.
+#
+#   obs-service-replace_using_package_version is free software: you can
+#   redistribute it and/or modify it under the terms of the GNU General
+#   Public License as published by the Free Software Foundation, either
+#   version 3 of the License, or (at your option) any later version.
+#
+#   obs-service-replace_using_package_version is distributed in the hope
+#   that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#   implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with obs-service-replace_using_package_version.  If not,
+#   see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmarks of the version lookups and of the file rewriting.
+
+Every case runs in a fresh interpreter on synthetic repositories (see
+test/rpmgen.py), which are generated once per size below the work directory.
+The wall time of the case, the number of spawned processes and the peak RSS of
+the interpreter and its children are recorded. Repository lookups run
+twice, with a cold and a warm header index.
+
+Usage:
+    run.py [--sizes=SIZES] [--file-sizes=SIZES] [--repeat=N]
+        [--cases=CASES] [--workdir=DIR] [--output=FILE] [--seed=SEED]
+    run.py compare BASE NEW [--threshold=RATIO]
+    run.py child CASE WORKDIR ARGUMENT
+
+Options:
+    -h,--help           : show this help message
+    --sizes=SIZES       : comma separated numbers of packages of the
+                            repositories [default: 100,1000,10000,50000]
+    --file-sizes=SIZES  : comma separated sizes in MiB of the rewritten
+                            files [default: 1,64,256]
+    --repeat=N          : runs per case, the fastest one is reported
+                            [default: 3]
+    --cases=CASES       : comma separated cases to run, all by default
+    --workdir=DIR       : directory of the generated data
+                            [default: benchmarks/.data]
+    --output=FILE       : write the results as JSON to FILE
+    --seed=SEED         : seed of the generated data [default: 0]
+    --threshold=RATIO   : slowdown that is reported as a regression
+                            [default: 1.25]
+
+`compare` prints the ratios of two result files written via --output and
+fails if a case got slower than the threshold. `child` runs a single case and
+is used internally.
+"""
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import docopt
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+repo_root = os.path.dirname(benchmarks_dir)
+# the package generator is shared with the tests
+sys.path.insert(0, os.path.join(repo_root, 'test'))
+
+import rpmgen  # noqa: E402
+
+module_name = (
+    'replace_using_package_version.replace_using_package_version'
+)
+
+# audit events of spawned processes
+fork_events = (
+    'os.fork', 'os.forkpty', 'os.posix_spawn', 'os.spawn', 'os.system',
+    'subprocess.Popen',
+)
+# the number of obsinfo files in the working directory of the cases
+obsinfo_count = 20
+# number of distinct placeholders of the template file, one of them is added
+# to every 50th line
+template_placeholders = 20
+# differences below this many seconds are never reported as regressions
+min_regression = 0.005
+
+
+def _import_module():
+    sys.path.insert(0, repo_root)
+    return __import__(module_name, fromlist=['main'])
+
+
+def _case_import(argument: str):
+    return _import_module().__name__
+
+
+def _case_find_package_version(argument: str):
+    return _import_module().find_package_version(argument, 'repos')
+
+
+def _case_get_pkg_version(argument: str):
+    return _import_module().get_pkg_version(argument)
+
+
+def _case_find_package_version_in_local_repos(argument: str):
+    return _import_module().find_package_version_in_local_repos(
+        'repos', argument
+    )
+
+
+def _case_find_package_version_in_obsinfo(argument: str):
+    return _import_module().find_package_version_in_obsinfo('.', argument)
+
+
+def _case_get_installed_version_by_capability(argument: str):
+    return _import_module().get_installed_version_by_capability(argument)
+
+
+def _case_find_package_version_by_capability(argument: str):
+    return _import_module().find_package_version_by_capability(
+        'repos', argument
+    )
+
+
+def _case_find_package_version_by_dependency(argument: str):
+    return _import_module().find_package_version(argument, 'repos')
+
+
+def _case_apply_regex_to_file(argument: str):
+    module = _import_module()
+    input_file, regexes = argument.split(':', 1)
+    return module.apply_regexes_to_file(
+        input_file, input_file + '.out',
+        [(regex, '1.2.3-4.5') for regex in regexes.split('\n')]
+    )
+
+
+#: case -> (function, whether it reads the repository)
+cases: Dict[str, tuple] = {
+    'import': (_case_import, False),
+    'find_package_version': (_case_find_package_version, True),
+    'get_pkg_version': (_case_get_pkg_version, False),
+    'find_package_version_in_local_repos': (
+        _case_find_package_version_in_local_repos, True
+    ),
+    'find_package_version_in_obsinfo': (
+        _case_find_package_version_in_obsinfo, False
+    ),
+    'get_installed_version_by_capability': (
+        _case_get_installed_version_by_capability, False
+    ),
+    'find_package_version_by_capability': (
+        _case_find_package_version_by_capability, True
+    ),
+    'find_package_version_by_dependency': (
+        _case_find_package_version_by_dependency, True
+    ),
+}
+file_cases = {
+    # a literal, a regex matching on most lines and one matching nowhere
+    'apply_regex_to_file:literal': r'zypper',
+    'apply_regex_to_file:regex': r'\d+\.\d+\.\d+-\d+\.\d+',
+    'apply_regex_to_file:nomatch': r'no-such-[a-z]+-line',
+    # several literals (separated by newlines) matching on most lines and
+    # equivalent regexes
+    'apply_regex_to_file:literals': 'zypper\nLABEL\nCOPY\nBUILD_ID',
+    'apply_regex_to_file:regexes': 'zyppe[rR]\nLABE[lL]\nCOP[yY]\nBUILD_I[dD]',
+    # the placeholders of a template file, replaced in a single pass, and
+    # equivalent regexes that are applied one after another
+    'apply_regex_to_file:placeholders': '\n'.join(
+        f'%%PKG{i}%%' for i in range(template_placeholders)
+    ),
+    'apply_regex_to_file:placeholder-regexes': '\n'.join(
+        f'%%PK[GH]{i}%%' for i in range(template_placeholders)
+    ),
+}
+# the cases that rewrite the template file instead of the input file
+template_file_cases = (
+    'apply_regex_to_file:placeholders',
+    'apply_regex_to_file:placeholder-regexes',
+)
+
+
+def run_child(case: str, workdir: str, argument: str) -> None:
+    """Run `case` and print its measurements as JSON."""
+    forks = [0]
+    if hasattr(sys, 'addaudithook'):
+        def count_forks(event: str, args) -> None:
+            if event in fork_events:
+                forks[0] += 1
+        sys.addaudithook(count_forks)
+    else:
+        forks[0] = None
+
+    if case.startswith('apply_regex_to_file'):
+        function = _case_apply_regex_to_file
+    else:
+        function = cases[case][0]
+    os.chdir(workdir)
+    if case != 'import':
+        # only the `import` case includes the time to import the module
+        _import_module()
+    start = time.perf_counter()
+    result = function(argument)
+    wall = time.perf_counter() - start
+    print(json.dumps({
+        'wall': wall,
+        'forks': forks[0],
+        # kilobytes on Linux
+        'max_rss': max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        ),
+        'result': None if result is None else str(result),
+    }))
+
+
+def prepare_repo(workdir: str, size: int, seed: int) -> dict:
+    """Generate the repository with `size` packages below `workdir` unless
+    it exists already and return the arguments of the cases.
+
+    """
+    directory = os.path.join(workdir, f'repo-{size}-{seed}')
+    complete = os.path.join(directory, '.complete')
+    packages = rpmgen.generate_packages(size, seed)
+    if not os.path.exists(complete):
+        shutil.rmtree(directory, ignore_errors=True)
+        rpmgen.generate_repo(os.path.join(directory, 'repos'), size, seed)
+        for package in packages[:obsinfo_count]:
+            with open(os.path.join(
+                directory, f'{package.name}.obsinfo'
+            ), 'w') as obsinfo:
+                obsinfo.write(
+                    f'name: {package.name}\nversion: {package.version}\n'
+                )
+        open(complete, 'w').close()
+
+    target = packages[len(packages) // 2]
+    # a provides besides the package name, preferring a library symbol
+    capability = max(
+        (provide for package in packages[len(packages) * 3 // 4:]
+         for provide, _, _ in package.provides[2:]),
+        key=lambda provide: '.so.' in provide,
+        default=target.name,
+    )
+    return {
+        'directory': directory,
+        'find_package_version': target.name,
+        'get_pkg_version': target.name,
+        'find_package_version_in_local_repos': target.name,
+        'find_package_version_in_obsinfo': packages[obsinfo_count // 2].name,
+        'get_installed_version_by_capability': capability,
+        'find_package_version_by_capability': capability,
+        'find_package_version_by_dependency': (
+            f'{target.name} >= {target.version}'
+        ),
+        'import': '',
+    }
+
+
+def prepare_input_file(workdir: str, size_mib: int, seed: int) -> str:
+    path = os.path.join(workdir, f'input-{size_mib}M-{seed}.txt')
+    if not os.path.exists(path):
+        versions = [
+            package.evr for package in rpmgen.generate_packages(100, seed)
+        ]
+        rpmgen.generate_input_file(
+            path + '.tmp', size_mib * 1024 * 1024, versions, seed
+        )
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def prepare_template_file(input_file: str, seed: int) -> str:
+    path = input_file.replace('input-', 'template-', 1)
+    if not os.path.exists(path):
+        rng = random.Random(seed)
+        with open(input_file) as source, open(path + '.tmp', 'w') as target:
+            for number, line in enumerate(source):
+                if number % 50 == 0:
+                    line = '{0} %%PKG{1}%%\n'.format(
+                        line.rstrip('\n'),
+                        rng.randrange(template_placeholders),
+                    )
+                target.write(line)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def measure(case: str, directory: str, argument: str, repeat: int) -> dict:
+    """Run `case` `repeat` times in fresh interpreters and return the
+    fastest run.
+
+    """
+    runs = []
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'child', case,
+             directory, argument],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if process.returncode != 0:
+            stderr = process.stderr.decode().strip().splitlines()
+            return {'error': stderr[-1] if stderr else 'failed'}
+        runs.append(json.loads(process.stdout.decode().splitlines()[-1]))
+    best = min(runs, key=lambda run: run['wall'])
+    best['walls'] = [run['wall'] for run in runs]
+    return best
+
+
+def run_benchmarks(
+    sizes: List[int],
+    file_sizes: List[int],
+    repeat: int,
+    selected: Optional[List[str]],
+    workdir: str,
+    seed: int,
+    report: Callable[[dict], None],
+) -> List[dict]:
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+
+    def selected_case(case: str) -> bool:
+        return not selected or any(
+            case == name or case.startswith(name + ':') for name in selected
+        )
+
+    for size in sizes:
+        if not any(selected_case(case) for case in cases):
+            break
+        arguments = prepare_repo(workdir, size, seed)
+        directory = arguments['directory']
+        for case, (_, reads_repo) in cases.items():
+            if not selected_case(case):
+                continue
+            for cache in ('cold', 'warm') if reads_repo else ('-',):
+                index_file = os.path.join(directory, 'repos', '.rupv-index')
+                if cache == 'cold' and os.path.exists(index_file):
+                    os.unlink(index_file)
+                result = measure(
+                    case, directory, arguments[case],
+                    1 if cache == 'cold' else repeat,
+                )
+                result.update(case=case, size=size, cache=cache)
+                report(result)
+                results.append(result)
+
+    for size_mib in file_sizes:
+        path = None
+        rewritten = set()
+        for case, regex in file_cases.items():
+            if not selected_case(case):
+                continue
+            path = path or prepare_input_file(workdir, size_mib, seed)
+            case_path = path
+            if case in template_file_cases:
+                case_path = prepare_template_file(path, seed)
+            rewritten.add(case_path)
+            result = measure(case, workdir, f'{case_path}:{regex}', repeat)
+            result.update(case=case, size=f'{size_mib}M', cache='-')
+            report(result)
+            results.append(result)
+        for case_path in rewritten:
+            if os.path.exists(case_path + '.out'):
+                os.unlink(case_path + '.out')
+    return results
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=repo_root,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ).stdout.decode().strip() or None
+    except OSError:
+        return None
+
+
+def format_result(result: dict) -> str:
+    label = f"{result['case']:<40} {result['size']:>6} {result['cache']:>5}"
+    if 'error' in result:
+        return f"{label}  error: {result['error']}"
+    forks = '-' if result['forks'] is None else result['forks']
+    return (
+        f"{label} {result['wall'] * 1000:10.1f} ms {forks:>6} forks "
+        f"{result['max_rss'] / 1024:8.1f} MiB"
+    )
+
+
+def compare(base_file: str, new_file: str, threshold: float) -> int:
+    """Print the ratios of the wall times and peak RSS of the cases in both
+    result files, returns the number of regressions.
+
+    """
+    def load(path: str) -> Dict[tuple, dict]:
+        with open(path) as result_file:
+            data = json.load(result_file)
+        return {
+            (result['case'], str(result['size']), result['cache']): result
+            for result in data['results'] if 'error' not in result
+        }
+
+    base = load(base_file)
+    new = load(new_file)
+    regressions = 0
+    for key in sorted(base.keys() & new.keys(), key=str):
+        old_result, new_result = base[key], new[key]
+        ratio = new_result['wall'] / max(old_result['wall'], 1e-9)
+        rss_ratio = new_result['max_rss'] / max(old_result['max_rss'], 1)
+        regression = ratio > threshold and (
+            new_result['wall'] - old_result['wall'] > min_regression
+        )
+        regressions += regression
+        print(
+            f'{key[0]:<40} {key[1]:>6} {key[2]:>5} '
+            f"{old_result['wall'] * 1000:10.1f} -> "
+            f"{new_result['wall'] * 1000:10.1f} ms x{ratio:5.2f} "
+            f'rss x{rss_ratio:5.2f}'
+            + ('  REGRESSION' if regression else '')
+        )
+    return regressions
+
+
+def parse_list(value: Optional[str]) -> List[str]:
+    return [item for item in (value or '').split(',') if item]
+
+
+def main():
+    command_args = docopt.docopt(__doc__)
+
+    if command_args['child']:
+        run_child(
+            command_args['CASE'], command_args['WORKDIR'],
+            command_args['ARGUMENT'],
+        )
+        return
+
+    if command_args['compare']:
+        regressions = compare(
+            command_args['BASE'], command_args['NEW'],
+            float(command_args['--threshold']),
+        )
+        sys.exit(1 if regressions else 0)
+
+    seed = int(command_args['--seed'])
+    results = run_benchmarks(
+        [int(size) for size in parse_list(command_args['--sizes'])],
+        [int(size) for size in parse_list(command_args['--file-sizes'])],
+        int(command_args['--repeat']),
+        parse_list(command_args['--cases']),
+        os.path.abspath(command_args['--workdir']),
+        seed,
+        lambda result: print(format_result(result), flush=True),
+    )
+    if command_args['--output']:
+        with open(command_args['--output'], 'w') as output:
+            json.dump({
+                'commit': get_commit(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'seed': seed,
+                'results': results,
+            }, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
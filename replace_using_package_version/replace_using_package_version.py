@@ -25,32 +25,151 @@ replace_with_package_version.py
 Usage:
     replace_using_package_version.py -h
     replace_using_package_version.py --regex=REGEX --outdir=DIR
-        [--file=FILE]
         (--package=PACKAGE | --replacement=REPLACEMENT)
-        [--parse-version=DEPTH]
+        [--parse-version=DEPTH] [--jobs=JOBS] [--stream-overlap=SIZE]
+        [--regex-timeout=SECONDS] [--trace=FILE] [--repo-dir=DIR...]
+        [--repo-include=GLOB...] [--repo-exclude=GLOB...] [--file=FILE...]
+    replace_using_package_version.py --outdir=DIR
+        (--rule=RULE... | --rules=RULES)
+        [--jobs=JOBS] [--stream-overlap=SIZE] [--regex-timeout=SECONDS]
+        [--trace=FILE]
+        [--repo-dir=DIR...] [--repo-include=GLOB...] [--repo-exclude=GLOB...]
+        [--file=FILE...]
+    replace_using_package_version.py --outdir=DIR --template=ENABLE
+        [--jobs=JOBS] [--stream-overlap=SIZE] [--regex-timeout=SECONDS]
+        [--trace=FILE]
+        [--repo-dir=DIR...] [--repo-include=GLOB...] [--repo-exclude=GLOB...]
+        [--file=FILE...]
+    replace_using_package_version.py --serve [--socket=SOCKET] [--jobs=JOBS]
 
 Options:
     -h,--help                   : show this help message
     --outdir=DIR                : output directory
-    --file=FILE                 : file to update
+    --file=FILE                 : file to update, or a glob of files (e.g.
+                                    'charts/**/*.yaml'). Can be given
+                                    multiple times, the files are written
+                                    to DIR under their base names.
                                     The default build recipe file
                                     (e.g. Dockerfile) is used when this
                                     parameter is omitted.
-    --package=PACKAGE           : package to check
+    --package=PACKAGE           : package to check, or a versioned
+                                    dependency like 'httpd >= 2.4' to use
+                                    the highest version satisfying it
     --replacement=REPLACEMENT   : replacement string for any match
     --regex=REGEX               : regular expression for parsing file
     --parse-version=DEPTH       : parse the package version string to match
                                     major.minor.patch.patch_update format.
                                     It can be set to 'major', 'minor',
                                     'patch', 'patch_update' and 'offset'.
+    --jobs=JOBS                 : number of packages headers that are read
+                                    in parallel. Defaults to BUILD_JOBS of
+                                    the current build or the number of
+                                    CPUs.
+    --rule=RULE                 : a substitution in the form
+                                    regex=REGEX,package=PACKAGE
+                                    [,parse-version=DEPTH] or
+                                    regex=REGEX,replacement=REPLACEMENT.
+                                    Can be given multiple times, all
+                                    packages are resolved at once and the
+                                    file is rewritten only once.
+    --rules=RULES               : file with one rule per line (see --rule),
+                                    empty lines and lines starting with #
+                                    are ignored.
+    --template=ENABLE           : if 'true', replace the placeholders
+                                    %%pkg:NAME%% and %%pkg:NAME:DEPTH%% in
+                                    the file with the version of the
+                                    package NAME, parsed according to DEPTH
+                                    (see --parse-version). All packages are
+                                    resolved at once and the file is
+                                    rewritten only once.
+    --stream-overlap=SIZE       : big files are rewritten in chunks, a match
+                                    of a regex spanning multiple lines must
+                                    not be longer than SIZE characters.
+                                    Defaults to 65536.
+    --regex-timeout=SECONDS     : time budget for applying the regexes to
+                                    a file, a regex that takes longer
+                                    (e.g. as it backtracks
+                                    catastrophically) fails the run.
+                                    Defaults to 120, literal regexes are
+                                    not limited.
+    --trace=FILE                : append the timings of the lookup stages
+                                    and of the rewriting of the file as a
+                                    line of JSON to FILE. Defaults to
+                                    $RUPV_TRACE, tracing is disabled if
+                                    neither is set.
+    --repo-dir=DIR              : local repository searched for packages,
+                                    can be given multiple times. Defaults
+                                    to ./repos.
+    --repo-include=GLOB         : packages of the local repositories, matched
+                                    against the path relative to the
+                                    repository, can be given multiple
+                                    times. Defaults to *.rpm.
+    --repo-exclude=GLOB         : files of the local repositories that are
+                                    ignored, can be given multiple times.
+                                    Defaults to source and debug packages:
+                                    *.src.rpm, *.nosrc.rpm,
+                                    *-debuginfo-*.rpm and *-debugsource-*.rpm.
+    --serve                     : run a resolver daemon that keeps the
+                                    package versions, the rpm database and
+                                    the repositories loaded, the other
+                                    invocations use it when it is running.
+    --socket=SOCKET             : Unix socket of the resolver daemon.
+                                    Defaults to $RUPV_SOCKET or .rupv.sock
+                                    in the current directory.
 """
 from typing import Optional
-import docopt
+import codecs
+import filecmp
+import importlib
+import locale
+import mmap
 import re
 import os
+import shutil
+import struct
 import subprocess
-from rpm import labelCompare
-from typing import List
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from typing import (
+    TYPE_CHECKING, BinaryIO, Callable, Dict, Iterable, Iterator, List, Match,
+    NamedTuple, Pattern, Set, TextIO, Tuple, Union
+)
+
+# modules that are only needed for some of the lookups are imported where
+# they are used, plain replacements should start as fast as possible
+if TYPE_CHECKING:
+    import socketserver
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+
+class _LazyModule:
+    """Stand-in for the module `name`, which is imported once one of its
+    attributes is used.
+
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr: str):
+        value = getattr(importlib.import_module(self._name), attr)
+        # later lookups do not end up here anymore
+        setattr(self, attr, value)
+        return value
+
+
+# the rpm bindings load librpm and read its configuration, which is not
+# needed for replacements and obsinfo lookups
+rpm = _LazyModule('rpm')
 
 version_regex = {
     'major': r'^(\d+)',
@@ -63,6 +182,386 @@ version_regex = {
 }
 allowed_version_regex = version_regex.keys()
 obsinfo_regex = r'version: (.+)'
+repomd_namespace = 'http://linux.duke.edu/metadata/repo'
+rpmmd_common_namespace = 'http://linux.duke.edu/metadata/common'
+rpmmd_rpm_namespace = 'http://linux.duke.edu/metadata/rpm'
+rpm_filename_regex = re.compile(
+    r'^(.+)-([^-]+)-([^-]+)\.([^.-]+)\.rpm$'
+)
+rule_fields = ('regex', 'package', 'replacement', 'parse-version')
+# the placeholders of the template mode: %%pkg:NAME%% or %%pkg:NAME:DEPTH%%
+template_placeholder_regex = re.compile(
+    r'%%pkg:([^%\n]+?)(?::({0}))?%%'.format('|'.join(version_regex))
+)
+# the segments compared by rpmvercmp, any other character is a separator
+_version_segment_regex = re.compile(r'[0-9]+|[a-zA-Z]+|~|\^')
+
+# the options of the usage in the module docstring that take a value
+value_options = (
+    '--file', '--jobs', '--outdir', '--package', '--parse-version', '--regex',
+    '--regex-timeout', '--repo-dir', '--repo-exclude', '--repo-include',
+    '--replacement', '--rule', '--rules', '--socket', '--stream-overlap',
+    '--template', '--trace',
+)
+# the value options that can be given multiple times
+repeated_options = (
+    '--file', '--repo-dir', '--repo-exclude', '--repo-include', '--rule',
+)
+# the options without a value
+flag_options = ('--serve',)
+# (required, exactly one of, optional) options of the usage patterns
+usage_patterns = (
+    (
+        ('--regex', '--outdir'), ('--package', '--replacement'),
+        (
+            '--file', '--parse-version', '--jobs', '--stream-overlap',
+            '--regex-timeout', '--trace', '--repo-dir', '--repo-include',
+            '--repo-exclude',
+        ),
+    ),
+    (
+        ('--outdir',), ('--rule', '--rules'),
+        (
+            '--file', '--jobs', '--stream-overlap', '--regex-timeout',
+            '--trace', '--repo-dir', '--repo-include', '--repo-exclude',
+        ),
+    ),
+    (
+        ('--outdir', '--template'), (),
+        (
+            '--file', '--jobs', '--stream-overlap', '--regex-timeout',
+            '--trace', '--repo-dir', '--repo-include', '--repo-exclude',
+        ),
+    ),
+    (('--serve',), (), ('--socket', '--jobs')),
+)
+
+# files of at least this size are rewritten in chunks instead of as a whole
+streaming_threshold = 64 * 1024 * 1024
+stream_chunk_size = 1024 * 1024
+# the default length of the longest match that can span multiple lines
+default_stream_overlap = 64 * 1024
+# the default time budget in seconds for applying non-literal regexes to a
+# file, so that a catastrophically backtracking regex fails the build early
+default_regex_timeout = 120
+
+# the repetitions that backtrack, unlike possessive ones
+_regex_backtracking_repeat_ops = (
+    sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+)
+_regex_repeat_ops = tuple(
+    getattr(sre_constants, op) for op in (
+        'MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT'
+    ) if hasattr(sre_constants, op)
+)
+# regex character categories that contain the newline character
+_newline_categories = (
+    sre_constants.CATEGORY_SPACE,
+    sre_constants.CATEGORY_NOT_WORD,
+    sre_constants.CATEGORY_NOT_DIGIT,
+    sre_constants.CATEGORY_LINEBREAK,
+)
+
+# the local repositories searched by default and the files of them that are
+# considered as packages, matched against their path relative to the
+# repository: source and debug packages never provide a usable version
+default_repo_dir = './repos'
+default_repo_includes = ('*.rpm',)
+default_repo_excludes = (
+    '*.src.rpm', '*.nosrc.rpm', '*-debuginfo-*.rpm', '*-debugsource-*.rpm',
+)
+# directories that only contain repository metadata, of which just the file
+# named after the directory is read
+repo_metadata_dirs = {'repodata': 'repomd.xml'}
+
+# name of the header cache stored in the root of a repository directory
+repo_index_filename = '.rupv-index'
+# bump whenever the layout of the cached entries changes
+REPO_INDEX_FORMAT = 3
+# number of substring searches of the provides answered by scanning them,
+# before a trigram index is built for the following ones: building it takes
+# about as long as that many scans
+trigram_index_queries = 100
+
+# query used by the batched `rpm -qp` fallback: every package starts with a
+# marker line followed by one line per provides
+rpm_query_record_marker = '@@rupv@@'
+rpm_query_format = (
+    rpm_query_record_marker
+    + r'\t%{NAME}\t%{EPOCH}\t%{VERSION}\t%{RELEASE}\t%{ARCH}\n'
+    + r'[%{PROVIDENAME}\t%{PROVIDEFLAGS}\t%{PROVIDEVERSION}\n]'
+)
+rpm_query_command = [
+    'rpm', '-qp', '--nosignature', '--nodigest', '--queryformat',
+    rpm_query_format,
+]
+
+# the locations of the rpm database, without one there are no installed
+# packages to look up
+rpmdb_paths = ('/usr/lib/sysimage/rpm', '/var/lib/rpm')
+# the files of the rpm database that change when packages are installed
+rpmdb_files = ('rpmdb.sqlite', 'Packages.db', 'Packages')
+
+# the versions resolved during a build are recorded in this file, which is
+# stored next to the build.data of the build
+build_lock_filename = '.rupv-lock'
+# bump whenever the layout of the lock file changes
+BUILD_LOCK_FORMAT = 1
+
+# Unix socket of the resolver daemon, relative to the current directory
+default_resolver_socket = '.rupv.sock'
+# seconds to wait for each reply of the resolver daemon, before the versions
+# are resolved in-process instead
+default_resolver_timeout = 30
+
+# dependency sense flags as defined in rpm's rpmds.h
+RPMSENSE_LESS = 1 << 1
+RPMSENSE_GREATER = 1 << 2
+RPMSENSE_EQUAL = 1 << 3
+
+# the flags of dependencies in the rpm-md metadata
+rpmmd_dependency_flags = {
+    'LT': RPMSENSE_LESS,
+    'GT': RPMSENSE_GREATER,
+    'EQ': RPMSENSE_EQUAL,
+    'LE': RPMSENSE_LESS | RPMSENSE_EQUAL,
+    'GE': RPMSENSE_GREATER | RPMSENSE_EQUAL,
+}
+# the comparison operators of dependency expressions like `httpd >= 2.4`
+dependency_operators = {
+    '<': RPMSENSE_LESS,
+    '<=': RPMSENSE_LESS | RPMSENSE_EQUAL,
+    '=<': RPMSENSE_LESS | RPMSENSE_EQUAL,
+    '=': RPMSENSE_EQUAL,
+    '==': RPMSENSE_EQUAL,
+    '>=': RPMSENSE_GREATER | RPMSENSE_EQUAL,
+    '=>': RPMSENSE_GREATER | RPMSENSE_EQUAL,
+    '>': RPMSENSE_GREATER,
+}
+RPMSENSE_SENSEMASK = RPMSENSE_LESS | RPMSENSE_GREATER | RPMSENSE_EQUAL
+
+# layout of rpm package files as defined in rpm's rpmlead.c and header.c
+RPM_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+RPM_INT32_TYPE = 4
+RPM_STRING_TYPE = 6
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_ARCH = 1022
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_PROVIDEFLAGS = 1112
+RPMTAG_PROVIDEVERSION = 1113
+# the tags decoded by parse_rpm_header, all others are skipped
+_rpm_header_tags = frozenset((
+    RPMTAG_NAME, RPMTAG_VERSION, RPMTAG_RELEASE, RPMTAG_EPOCH, RPMTAG_ARCH,
+    RPMTAG_PROVIDENAME, RPMTAG_PROVIDEFLAGS, RPMTAG_PROVIDEVERSION,
+))
+
+
+class Rule(NamedTuple):
+    """A single substitution: every match of `regex` is replaced with the
+    version of `package` (parsed according to `parse_version`) or with the
+    fixed string `replacement`.
+
+    """
+    regex: str
+    package: Optional[str] = None
+    replacement: Optional[str] = None
+    parse_version: Optional[str] = None
+
+
+class RpmFilename(NamedTuple):
+    """Name, version, release and architecture of a package as encoded in
+    its file name.
+
+    """
+    name: str
+    version: str
+    release: str
+    arch: str
+
+    @property
+    def version_release(self) -> str:
+        return f'{self.version}-{self.release}'
+
+
+class RpmHeader(NamedTuple):
+    """The subset of the header of a rpm package that is required to resolve
+    package versions.
+
+    """
+    name: str
+    epoch: Optional[str]
+    version: str
+    release: str
+    arch: str
+    #: provides formatted like the output of :command:`rpm -qP`
+    provides: List[str]
+
+    @property
+    def version_release(self) -> str:
+        return f'{self.version}-{self.release}'
+
+    @property
+    def evr(self) -> str:
+        """`[EPOCH:]VERSION-RELEASE`, the epoch is omitted if not set."""
+        if self.epoch is None:
+            return self.version_release
+        return f'{self.epoch}:{self.version_release}'
+
+
+class Dependency(NamedTuple):
+    """A rpm dependency like ``httpd >= 2.4``, unversioned dependencies have
+    no `flags` and `evr`.
+
+    """
+    name: str
+    flags: int = 0
+    #: `[EPOCH:]VERSION[-RELEASE]`
+    evr: Optional[str] = None
+
+
+class LocalRepos(NamedTuple):
+    """The local repositories searched for packages: their root directories
+    and the globs selecting the packages in them, see :py:func:`walk_repo`.
+
+    """
+    paths: Tuple[str, ...] = (default_repo_dir,)
+    includes: Tuple[str, ...] = default_repo_includes
+    excludes: Tuple[str, ...] = default_repo_excludes
+
+
+class RepoFiles(NamedTuple):
+    """The files found by :py:func:`walk_repo` with their stat results, in
+    the order of their paths.
+
+    """
+    packages: Dict[str, os.stat_result]
+    metadata: Dict[str, os.stat_result]
+
+
+class Trace:
+    """Measurements of a single invocation, written as one line of JSON via
+    ``--trace``.
+
+    Counters are updated only at a few points per lookup (e.g. once per
+    batch of headers, not per header), and only if tracing is enabled.
+
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.perf_counter()
+        #: e.g. files_visited, headers_read, subprocesses, index_hits
+        self.counters: Dict[str, int] = {}
+        #: package -> winning stage, version and the timing of every stage
+        self.packages: Dict[str, dict] = {}
+        self.resolver: Optional[str] = None
+        self.apply: Optional[dict] = None
+        # counters and stages are also updated by the worker threads
+        self._lock = threading.Lock()
+
+    def count(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def add_stage(
+        self, package: str, stage: str, seconds: float, version
+    ) -> None:
+        with self._lock:
+            entry = self.packages.setdefault(
+                package, {'version': None, 'stage': None, 'stages': []}
+            )
+            entry['stages'].append({
+                'stage': stage,
+                'seconds': seconds,
+                'found': version is not None,
+            })
+            if version is not None:
+                entry['version'] = str(version)
+                entry['stage'] = stage
+
+    def write(
+        self, trace_file: str, error: Optional[BaseException] = None
+    ) -> None:
+        """Append the measurements to `trace_file`, which thus collects the
+        traces of many invocations.
+
+        """
+        data = {
+            'started': self.started,
+            'seconds': time.perf_counter() - self._start,
+            'cwd': os.getcwd(),
+            'resolver': self.resolver,
+            'packages': self.packages,
+            'counters': self.counters,
+            'apply': self.apply,
+            'error': None if error is None else str(error),
+        }
+        import json
+        with open(trace_file, 'a') as trace:
+            trace.write(json.dumps(data) + '\n')
+
+
+#: the trace of the current invocation, `None` unless tracing is enabled
+_trace: Optional[Trace] = None
+
+
+def _trace_count(counter: str, value: int = 1) -> None:
+    if _trace is not None:
+        _trace.count(counter, value)
+
+
+def _run_stage(package: str, stage: str, lookup: Callable[[], Optional[str]]):
+    """Run the version lookup `lookup` of `package` and record it as `stage`
+    in the trace.
+
+    """
+    if _trace is None:
+        return lookup()
+    start = time.perf_counter()
+    version = lookup()
+    _trace.add_stage(package, stage, time.perf_counter() - start, version)
+    return version
+
+
+def read_build_data() -> Dict[str, str]:
+    """Read the variables from the :file:`build.data` of the current build
+    environment, see :py:func:`guess_recipe_filename_from_env`.
+
+    An empty dictionary is returned when not running inside of a build.
+
+    """
+    build_dist = os.getenv("BUILD_DIST")
+    if build_dist is None or build_dist[-5:] != ".dist":
+        return {}
+
+    build_data = {}
+    with open(build_dist[:-5] + ".data") as data:
+        for line in data:
+            # lines are:
+            # FOOBAR='baz'
+            # => need to also remove the ' or " from the second column
+            var, val = line.strip().split("=", 1)
+            build_data[var] = val.replace("'", "").replace('"', '')
+    return build_data
+
+
+def get_default_jobs() -> int:
+    """Return the number of parallel jobs of the current build (the
+    ``BUILD_JOBS`` variable in :file:`build.data`) or the number of CPUs if
+    it is not set.
+
+    """
+    try:
+        return max(int(read_build_data().get("BUILD_JOBS", "")), 1)
+    except ValueError:
+        return os.cpu_count() or 1
 
 
 def guess_recipe_filename_from_env() -> Optional[str]:
@@ -79,21 +578,7 @@ def guess_recipe_filename_from_env() -> Optional[str]:
     already renamed the actual file to :file:`actual_name`.
 
     """
-    build_dist = os.getenv("BUILD_DIST")
-    if build_dist is None or build_dist[-5:] != ".dist":
-        return None
-
-    # Extract the variable RECIPEFILE from `build.data`
-    recipefile = None
-    with open(build_dist[:-5] + ".data") as data:
-        for line in data:
-            # lines are:
-            # FOOBAR='baz'
-            # => need to also remove the ' or " from the second column
-            var, val = line.strip().split("=")
-            if var == "RECIPEFILE":
-                recipefile = val.replace("'", "").replace('"', '')
-
+    recipefile = read_build_data().get("RECIPEFILE")
     if recipefile is None:
         return None
 
@@ -105,179 +590,3103 @@ def main():
     """
     main-entry point for program, expects dict with arguments from docopt()
     """
-    # TODO: probably there is a better way to set the repositories path
-    rpm_dir = './repos'
+    global _trace
+
+    command_args = parse_args(sys.argv[1:])
+
+    if command_args.get('--serve'):
+        import signal
+        # clean up the socket on `kill` as well
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        serve_resolver(
+            get_resolver_socket(command_args.get('--socket')),
+            jobs=get_positive_int_arg(command_args, '--jobs'),
+        )
+        return
+
+    repos = get_repos_from_args(command_args)
+    trace_file = command_args.get('--trace') or os.environ.get('RUPV_TRACE')
+    if not trace_file:
+        replace_package_versions(command_args, repos)
+        return
+
+    _trace = Trace()
+    try:
+        replace_package_versions(command_args, repos)
+    except BaseException as error:
+        _trace.write(trace_file, error)
+        raise
+    else:
+        _trace.write(trace_file)
+    finally:
+        _trace = None
+
+
+def replace_package_versions(command_args, rpm_dir: LocalRepos) -> None:
+    """Resolve the versions of the packages and rewrite the files as given by
+    the docopt `command_args`.
+
+    The versions are resolved once for all files, which are then rewritten
+    by a pool of at most ``--jobs`` threads if all regexes are literals, or
+    one after another in the main thread otherwise.
+
+    """
+    src_files = get_files_from_args(command_args)
+    outdir = command_args['--outdir']
+
+    if not os.path.isdir(outdir):
+        raise Exception('Output directory {0} not found'.format(outdir))
+
+    jobs = get_positive_int_arg(command_args, '--jobs')
+    overlap = get_positive_int_arg(command_args, '--stream-overlap')
+    timeout = get_positive_int_arg(command_args, '--regex-timeout')
+    if timeout is None:
+        timeout = default_regex_timeout
+
+    template = command_args.get('--template')
+    if template is not None and template != 'true':
+        raise Exception(
+            'Invalid template value {0}, only true is allowed'.format(
+                template
+            )
+        )
+    if template:
+        substitutions = get_template_substitutions(src_files, rpm_dir, jobs)
+    else:
+        rules = get_rules_from_args(command_args)
+        versions = resolve_package_versions(
+            list(dict.fromkeys(
+                rule.package for rule in rules if rule.package is not None
+            )),
+            rpm_dir,
+            jobs=jobs,
+        )
+        substitutions = [
+            (
+                rule.regex,
+                rule.replacement if rule.package is None else
+                get_replacement(versions[rule.package], rule.parse_version)
+            )
+            for rule in rules
+        ]
+
+    def apply(src_file: str) -> int:
+        return apply_regexes_to_file(
+            src_file,
+            os.path.join(outdir, os.path.basename(src_file)),
+            substitutions,
+            overlap=overlap,
+            timeout=timeout,
+        )
+
+    # matching a regex holds the GIL, so threads would not speed it up, and
+    # the time budget of regexes is only enforced cheaply (via SIGALRM) in
+    # the main thread: only literal substitutions are spread over threads
+    file_jobs = jobs
+    if any(
+        _regex_literal(re.compile(regex)) is None for regex, _ in substitutions
+    ):
+        file_jobs = 1
+    # os.umask() is not thread safe, determine it before the workers need it
+    _get_umask()
+    start = time.perf_counter()
+    counts = _map_with_pool(apply, src_files, file_jobs)
+    if _trace is not None:
+        _trace.apply = {
+            'files': dict(zip(src_files, counts)),
+            'seconds': time.perf_counter() - start,
+            'matches': sum(counts),
+        }
+    for src_file, count in zip(src_files, counts):
+        print(f'Replaced {count} match(es) in {src_file}')
+
+
+def parse_args(argv: List[str]) -> dict:
+    """Parse the command line arguments `argv` according to the usage in the
+    module docstring, the result is the same as the one of docopt.
+
+    Importing docopt and matching the usage patterns takes longer than a
+    plain replacement, so the usual ``--option=value`` and
+    ``--option value`` arguments are parsed directly. Anything else (e.g.
+    the help, abbreviated options or invalid arguments) is left to docopt.
+
+    """
+    command_args = _parse_args_fast(argv)
+    if command_args is None:
+        import docopt
+        command_args = docopt.docopt(__doc__, argv)
+    return command_args
+
+
+def _parse_args_fast(argv: List[str]) -> Optional[dict]:
+    command_args: dict = {option: None for option in value_options}
+    command_args['--help'] = False
+    command_args.update({option: False for option in flag_options})
+    command_args.update({option: [] for option in repeated_options})
+    given: Set[str] = set()
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg in flag_options:
+            option, value = arg, True
+        elif '=' in arg:
+            option, value = arg.split('=', 1)
+        elif i < len(argv) and not argv[i].startswith('-'):
+            option, value = arg, argv[i]
+            i += 1
+        else:
+            return None
+
+        if value is not True and option not in value_options:
+            return None
+        if option in given and option not in repeated_options:
+            return None
+        given.add(option)
+        if option in repeated_options:
+            command_args[option].append(value)
+        else:
+            command_args[option] = value
+
+    for required, alternatives, optional in usage_patterns:
+        if (
+            given.issuperset(required)
+            and given.issubset(required + alternatives + optional)
+            and len(given.intersection(alternatives)) == bool(alternatives)
+        ):
+            return command_args
+    return None
 
-    command_args = docopt.docopt(__doc__)
 
-    src_file = command_args['--file']
+def get_repos_from_args(command_args) -> LocalRepos:
+    return LocalRepos(
+        tuple(command_args.get('--repo-dir') or (default_repo_dir,)),
+        tuple(command_args.get('--repo-include') or default_repo_includes),
+        tuple(command_args.get('--repo-exclude') or default_repo_excludes),
+    )
+
+
+def get_files_from_args(command_args) -> List[str]:
+    """Return the files to rewrite as given by the ``--file`` arguments,
+    which are expanded if they are globs and no file of that name exists, or
+    the build recipe by default.
+
+    A glob has to match at least one file and the files must have distinct
+    base names, as they are all written to the output directory.
 
-    if src_file is None:
-        src_file = guess_recipe_filename_from_env()
-        if src_file is None:
+    """
+    patterns = command_args.get('--file') or []
+    if not patterns:
+        recipe = guess_recipe_filename_from_env()
+        if recipe is None:
             raise RuntimeError(
                 "No file was provided and could not infer a default build file"
             )
+        patterns = [recipe]
+
+    files: List[str] = []
+    for pattern in patterns:
+        # e.g. `Dockerfile[prod]` is a file name rather than a glob
+        if os.path.isfile(pattern) or not any(
+            char in pattern for char in '*?['
+        ):
+            if not os.path.isfile(pattern):
+                raise RuntimeError('File {0} not found'.format(pattern))
+            files.append(os.path.normpath(pattern))
+            continue
+        import glob
+        matches = sorted(
+            os.path.normpath(path)
+            for path in glob.glob(pattern, recursive=True)
+            if os.path.isfile(path)
+        )
+        if not matches:
+            raise RuntimeError('No file matches {0}'.format(pattern))
+        files.extend(matches)
+
+    names: Dict[str, str] = {}
+    for path in dict.fromkeys(files):
+        name = os.path.basename(path)
+        if name in names:
+            raise Exception(
+                'Files {0} and {1} would both be written to {2}'.format(
+                    names[name], path, name
+                )
+            )
+        names[name] = path
+    return list(names.values())
 
-    if not os.path.isfile(src_file):
-        raise RuntimeError('File {0} not found'.format(src_file))
 
-    if not os.path.isdir(command_args['--outdir']):
+def get_positive_int_arg(command_args, flag: str) -> Optional[int]:
+    value = command_args.get(flag)
+    if value is None:
+        return None
+    if not value.isdigit() or int(value) < 1:
         raise Exception(
-            'Output directory {0} not found'.format(command_args['--outdir'])
+            f"Invalid value '{value}' for {flag} flag. Expected a positive "
+            "number"
         )
+    return int(value)
 
-    filecopy = os.path.join(
-        command_args['--outdir'], os.path.basename(src_file)
-    )
 
-    if command_args['--package']:
-        parse_version = command_args['--parse-version']
-        version = find_package_version(command_args['--package'], rpm_dir)
+def get_rules_from_args(command_args) -> List[Rule]:
+    """Collect the substitution rules from the command line arguments, either
+    from ``--rule``/``--rules`` or from ``--regex`` and ``--package`` or
+    ``--replacement``.
 
-        if parse_version is not None:
-            if parse_version not in allowed_version_regex:
-                raise Exception(
-                    f"Invalid value '{parse_version}' for --parse-version "
-                    f"flag. Expected: {allowed_version_regex}"
-                )
-            else:
-                replacement = find_match_in_version(
-                    version_regex[parse_version], version
-                )
-        else:
-            # drop %RELEASE to keep compatibility
-            replacement = version.rsplit("-", 1)[0]
-    else:
-        replacement = command_args['--replacement']
+    """
+    rules = [parse_rule(rule) for rule in command_args.get('--rule') or []]
+    if command_args.get('--rules'):
+        rules.extend(read_rules_file(command_args['--rules']))
+    if not rules:
+        rules.append(Rule(
+            regex=command_args['--regex'],
+            package=command_args['--package'] or None,
+            replacement=command_args.get('--replacement'),
+            parse_version=command_args.get('--parse-version'),
+        ))
+
+    for rule in rules:
+        if rule.package is not None:
+            check_parse_version(rule.parse_version)
+    return rules
+
+
+def find_template_placeholders(
+    input_file: str
+) -> Dict[str, Tuple[str, Optional[str]]]:
+    """Return all distinct placeholders of the template mode in
+    `input_file`, mapped to their package and the depth of the version.
+
+    The file is read once in chunks, as the placeholders cannot span
+    multiple lines they are searched in blocks of complete lines.
+
+    """
+    placeholders: Dict[str, Tuple[str, Optional[str]]] = {}
+    rest = ''
+    with open(input_file, 'r') as in_file:
+        for chunk in iter(lambda: in_file.read(stream_chunk_size), ''):
+            rest += chunk
+            end = rest.rfind('\n') + 1
+            if end:
+                for match in template_placeholder_regex.finditer(rest, 0, end):
+                    placeholders[match.group(0)] = match.groups()
+                rest = rest[end:]
+    for match in template_placeholder_regex.finditer(rest):
+        placeholders[match.group(0)] = match.groups()
+    return placeholders
+
+
+def get_template_substitutions(
+    input_files: List[str],
+    rpm_dir: Union[str, LocalRepos],
+    jobs: Optional[int] = None,
+) -> List[Tuple[str, Callable[[Match], str]]]:
+    """Resolve the packages of all placeholders in `input_files` (see
+    :py:func:`find_template_placeholders`) and return the substitution
+    replacing all of them in one pass.
 
-    apply_regex_to_file(
-        src_file,
-        filecopy,
-        command_args['--regex'],
-        replacement
+    """
+    placeholders: Dict[str, Tuple[str, Optional[str]]] = {}
+    for input_file in input_files:
+        placeholders.update(find_template_placeholders(input_file))
+    versions = resolve_package_versions(
+        list(dict.fromkeys(package for package, _ in placeholders.values())),
+        rpm_dir,
+        jobs=jobs,
     )
+    replacements = {
+        placeholder: get_replacement(versions[package], parse_version)
+        for placeholder, (package, parse_version) in placeholders.items()
+    }
+    return [(
+        template_placeholder_regex.pattern,
+        lambda match: replacements[match.group(0)],
+    )]
+
+
+def parse_rule(rule: str) -> Rule:
+    """Parse a rule in the form ``regex=REGEX,package=PACKAGE`` into a
+    :py:class:`Rule`.
+
+    Fields are separated by a comma that is followed by the name of a field,
+    so the values may contain commas as well (e.g. ``regex=a{1,2}``).
+
+    """
+    fields = {}
+    for field in re.split(
+        r',(?=(?:{0})=)'.format('|'.join(rule_fields)), rule
+    ):
+        key, sep, value = field.partition('=')
+        if not sep or key not in rule_fields:
+            raise Exception(
+                f"Invalid rule '{rule}': unknown field '{key}'. Expected: "
+                f"{', '.join(rule_fields)}"
+            )
+        fields[key.replace('-', '_')] = value
+
+    if 'regex' not in fields:
+        raise Exception(f"Invalid rule '{rule}': no regex given")
+    if ('package' in fields) == ('replacement' in fields):
+        raise Exception(
+            f"Invalid rule '{rule}': either package or replacement must be "
+            "given"
+        )
+    return Rule(**fields)
+
+
+def read_rules_file(rules_file: str) -> List[Rule]:
+    with open(rules_file) as rules:
+        return [
+            parse_rule(line.strip()) for line in rules
+            if line.strip() and not line.lstrip().startswith('#')
+        ]
+
+
+def check_parse_version(parse_version: Optional[str]) -> None:
+    if (
+        parse_version is not None
+        and parse_version not in allowed_version_regex
+    ):
+        raise Exception(
+            f"Invalid value '{parse_version}' for --parse-version "
+            f"flag. Expected: {allowed_version_regex}"
+        )
+
+
+def get_replacement(version: str, parse_version: Optional[str]) -> str:
+    """Return the replacement string for the package version `version`
+    parsed according to `parse_version`.
+
+    """
+    if parse_version is not None:
+        return find_match_in_version(version_regex[parse_version], version)
+    # drop %RELEASE to keep compatibility
+    return version.rsplit("-", 1)[0]
 
 
 def apply_regex_to_file(input_file, output_file, regex, replacement):
+    apply_regexes_to_file(input_file, output_file, [(regex, replacement)])
+
+
+def apply_regexes_to_file(
+    input_file: str,
+    output_file: str,
+    substitutions: List[Tuple[str, Union[str, Callable[[Match], str]]]],
+    overlap: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> int:
+    """Apply all `substitutions` (pairs of regex and replacement) one after
+    another to the contents of `input_file` and write the result to
+    `output_file`. The number of substitutions is returned. As for
+    :py:func:`re.sub`, a replacement can also be a function of the match.
+
+    If no regex matches, `input_file` is copied without decoding it (see
+    :py:func:`_is_passthrough`). `output_file` is not touched at all if it
+    already has the resulting contents, so that its modification time is
+    preserved.
+
+    Literal regexes (e.g. ``%%VERSION%%``) are replaced without the regex
+    engine and consecutive literal substitutions are combined into a single
+    pass over the contents where this gives the same result (see
+    :py:func:`_combine_literal_substitutions`).
+
+    Files bigger than ``streaming_threshold`` are processed in chunks by
+    :py:func:`substitute_stream` if all regexes permit it, so that the file is
+    never loaded into memory as a whole. The result is the same as for the
+    in-memory substitution, as long as no match of a regex that can match
+    newlines is longer than `overlap` characters.
+
+    If any regex is not a literal, applying them must not take longer than
+    `timeout` seconds (unlimited by default), see
+    :py:func:`_call_with_timeout`. Regexes with nested quantifiers like
+    ``(a+)+`` (see :py:func:`_regex_has_nested_quantifiers`) are rejected
+    without a `timeout`, with one only a warning is printed.
+
+    """
+    if overlap is None:
+        overlap = default_stream_overlap
+    patterns = [(re.compile(regex), repl) for regex, repl in substitutions]
+
+    for pattern, _ in patterns:
+        if _regex_has_nested_quantifiers(pattern):
+            if timeout is None:
+                raise Exception(_nested_quantifiers_message(pattern.pattern))
+            _warn_nested_quantifiers(pattern.pattern)
+
+    if _is_passthrough(input_file, [pattern for pattern, _ in patterns]):
+        if not _same_contents(input_file, output_file):
+            with open(input_file, 'rb') as in_file, _atomic_write(
+                output_file, 'wb'
+            ) as out_file:
+                shutil.copyfileobj(in_file, out_file)
+        return 0
+
+    patterns = _combine_literal_substitutions(patterns)
+    # only regexes can take longer than linear time
+    regexes = [
+        pattern.pattern for pattern, repl in patterns
+        if not isinstance(repl, CombinedLiterals)
+        and _regex_literal(pattern) is None
+    ]
+    if timeout is not None and regexes:
+        return _call_with_timeout(
+            partial(
+                _apply_patterns_to_file, input_file, output_file, patterns,
+                overlap,
+            ),
+            timeout,
+            'Applying the regex(es) {0} to {1} took longer than {2} '
+            'seconds, a regex might backtrack catastrophically'.format(
+                ', '.join(repr(regex) for regex in regexes), input_file,
+                timeout,
+            ),
+        )
+    return _apply_patterns_to_file(input_file, output_file, patterns, overlap)
+
+
+def _apply_patterns_to_file(
+    input_file: str,
+    output_file: str,
+    patterns: List[Tuple[Pattern, Union[str, Callable[[Match], str]]]],
+    overlap: int,
+) -> int:
+    count = [0]
+    if (
+        os.path.getsize(input_file) >= streaming_threshold
+        and all(_regex_is_streamable(pattern) for pattern, _ in patterns)
+    ):
+        with open(input_file, 'r') as in_file:
+            chunks = iter(lambda: in_file.read(stream_chunk_size), '')
+            for pattern, repl in patterns:
+                chunks = substitute_stream(
+                    chunks, pattern, repl, overlap, counter=count
+                )
+            with _atomic_write(output_file) as out_file:
+                for chunk in chunks:
+                    out_file.write(chunk)
+        return count[0]
+
     with open(input_file, 'r') as in_file:
         contents = in_file.read()
 
-    with open(output_file, 'w') as out_file:
-        out_file.write(re.sub(regex, replacement, contents))
+    for pattern, replacement in patterns:
+        contents, matches = _substitution_function(pattern, replacement)(
+            contents
+        )
+        count[0] += matches
 
+    if not _has_contents(output_file, contents):
+        with _atomic_write(output_file) as out_file:
+            out_file.write(contents)
+    return count[0]
 
-def find_package_version(package, rpm_dir):
-    version = None
-    try:
-        version = get_pkg_version(package)
-    except Exception:
-        version = find_package_version_in_local_repos(rpm_dir, package)
 
-    if version is None:
-        version = find_package_version_in_obsinfo('.', package)
+def _is_passthrough(input_file: str, patterns: List[Pattern]) -> bool:
+    """Whether the substitution of `patterns` leaves `input_file` unchanged
+    byte for byte, checked without decoding the file.
 
-    if version is None:
-        version = find_package_version_by_capability(rpm_dir, package)
+    This is only determined for literal patterns that are searched in a
+    memory map of the file, provided that the file is read with an ASCII
+    compatible encoding without shift states (so that the encoded literal is
+    found if and only if the decoded one is) and contains no carriage returns
+    (which are translated when the file is read in text mode).
 
-    if version is None:
-        raise Exception(f'Package {package} version not found')
-    return str(version)
+    """
+    literals = [_regex_literal(pattern) for pattern in patterns]
+    if any(literal is None for literal in literals):
+        return False
+    encoding = codecs.lookup(locale.getpreferredencoding(False)).name
+    if encoding not in ('utf-8', 'ascii', 'latin-1', 'iso8859-1'):
+        return False
 
+    try:
+        with open(input_file, 'rb') as in_file:
+            if os.fstat(in_file.fileno()).st_size == 0:
+                return True
+            with mmap.mmap(
+                in_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as contents:
+                return contents.find(b'\r') == -1 and all(
+                    contents.find(literal.encode(encoding)) == -1
+                    for literal in literals
+                )
+    except (OSError, TypeError, ValueError, UnicodeEncodeError):
+        return False
 
-def find_package_version_in_local_repos(repo_path, package):
-    version = None
-    for root, _, files in os.walk(repo_path):
-        packages = [
-            f for f in files if f.endswith('rpm') and package in f
-        ]
-        for pkg in packages:
-            rpm_file = os.path.join(root, pkg)
-            if get_pkg_name_from_rpm(rpm_file) == package:
-                rpm_ver = get_pkg_version_from_rpm(rpm_file)
-                if version is None or labelCompare(rpm_ver, version) >= 0:
-                    version = rpm_ver
-    return version
 
+def _regex_literal(pattern: Pattern) -> Optional[str]:
+    """Return the string matched by `pattern` if it is a plain literal (e.g.
+    ``%%VERSION%%``), otherwise `None`.
+
+    """
+    if pattern.flags & re.IGNORECASE:
+        return None
+    literal = []
+    for op, av in sre_parse.parse(pattern.pattern, pattern.flags):
+        if op != sre_constants.LITERAL:
+            return None
+        literal.append(chr(av))
+    return ''.join(literal) or None
 
-def find_package_version_by_capability(
-    repo_path: str, capability: str
-) -> Optional[str]:
-    """Find the highest rpm package version of all packages in `repo_path` that
-    have a rpm provides containing the string `capability`.
+
+def _substitution_function(
+    pattern: Pattern, replacement: Union[str, Callable[[Match], str]]
+) -> Callable[[str], Tuple[str, int]]:
+    """Return a function that works like ``pattern.subn(replacement, text)``
+    for a `text`, but which splits the text at a literal `pattern` and joins
+    it with a string `replacement` instead, which also counts the matches
+    in the same pass.
 
     """
-    version = None
-    for root, _, files in os.walk(repo_path):
-        packages = [f for f in files if f.endswith('rpm')]
-        for pkg in packages:
-            rpm_file = os.path.join(root, pkg)
-            for provide in get_pkg_provides_from_rpm(rpm_file):
-                if capability in provide:
-                    rpm_ver = get_pkg_version_from_rpm(rpm_file)
-                    if version is None or labelCompare(rpm_ver, version) >= 0:
-                        version = rpm_ver
-    return version
+    if isinstance(replacement, CombinedLiterals):
+        return replacement.subn
+    literal = None if callable(replacement) else _regex_literal(pattern)
+    if literal is None:
+        return partial(pattern.subn, replacement)
 
+    # every match is the literal, so the template expands to the same string
+    expanded = pattern.sub(replacement, literal)
 
-def find_package_version_in_obsinfo(path, package):
-    version = None
-    for f in os.listdir(path):
-        if f.endswith('obsinfo') and package in f:
-            obsinfo_ver = get_pkg_version_from_obsinfo(f)
-            if version is None or labelCompare(obsinfo_ver, version) >= 0:
-                version = obsinfo_ver
-    return version
+    def subn(text: str) -> Tuple[str, int]:
+        parts = text.split(literal)
+        return expanded.join(parts), len(parts) - 1
+    return subn
 
 
-def find_match_in_version(regexpr, version):
-    search = re.search(regexpr, version)
-    if search is None:
-        return version
-    else:
-        return search.group(1)
+class CombinedLiterals:
+    """Substitutions of literals by strings that are applied in a single pass
+    over the text, with the same result as applying them one after another.
 
+    No literal may contain another one, and no later literal may overlap
+    the non-empty replacement of an earlier one (see
+    :py:func:`_strings_overlap`). So the sequential substitution never
+    creates new matches, neither inside of a replacement nor across its
+    boundaries. Then the single pass only differs if two literals occur at
+    overlapping positions (e.g. ``%%A%%B%%`` for ``%%A%%`` and ``%%B%%``),
+    which is checked for before each pass by searching the strings formed by
+    such overlaps.
 
-def run_command(command: List[str]) -> str:
-    return subprocess.check_output(command).decode()
+    The literals must also start with the same character, as placeholders
+    like ``%%TAG%%`` and ``%%OFFSET%%`` do. The regex engine searches for
+    the common prefix of the alternatives as quickly as :py:meth:`str.split`
+    searches for a literal, but it is slower than a few of these searches for
+    alternatives without one.
 
+    """
 
-def get_pkg_version_from_obsinfo(obsinfo_file: str) -> Optional[str]:
-    regex = re.compile(obsinfo_regex)
-    with open(obsinfo_file) as f:
-        for line in f:
-            match = regex.match(line)
-            if match:
-                return match[1]
-    return None
+    def __init__(self, literals: List[Tuple[str, str]]):
+        #: the (literal, expanded replacement) pairs in their order
+        self.literals = literals
+        self.replacements = dict(literals)
+        self.pattern = re.compile('({0})'.format(
+            '|'.join(re.escape(literal) for literal, _ in literals)
+        ))
+        # the overlaps of two literals by the common suffix of the first one
+        # and prefix of the second one: (firsts, rests of the seconds)
+        overlaps: Dict[str, Tuple[Set[str], Set[str]]] = {}
+        for first, _ in literals:
+            for second, _ in literals:
+                for length in range(1, min(len(first), len(second))):
+                    if first.endswith(second[:length]):
+                        firsts, rests = overlaps.setdefault(
+                            second[:length], (set(), set())
+                        )
+                        firsts.add(first)
+                        rests.add(second[length:])
+        # a literal overlapping itself is matched the same way by the single
+        # pass, it just takes the slow path
+        self.overlap_pattern = re.compile('|'.join(
+            '(?:{0})(?:{1})'.format(
+                '|'.join(re.escape(first) for first in sorted(firsts)),
+                '|'.join(re.escape(rest) for rest in sorted(rests)),
+            )
+            for firsts, rests in overlaps.values()
+        )) if overlaps else None
 
+    @staticmethod
+    def accepts(
+        literals: List[Tuple[str, str]], literal: str, expanded: str
+    ) -> bool:
+        """Whether the substitution of `literal` by `expanded` can be added
+        to the substitutions `literals`.
 
-def get_pkg_name_from_rpm(rpm_file: str) -> str:
-    command = [
-        'rpm', '-qp', '--queryformat', '%{NAME}', rpm_file
-    ]
-    return run_command(command)
+        """
+        return all(
+            previous_expanded
+            and previous[0] == literal[0]
+            and literal not in previous and previous not in literal
+            and not _strings_overlap(literal, previous_expanded)
+            for previous, previous_expanded in literals
+        )
 
+    def __call__(self, match: Match) -> str:
+        return self.replacements[match.group()]
 
-def get_pkg_version_from_rpm(rpm_file: str) -> str:
-    command = [
-        'rpm', '-qp', '--queryformat', '%{VERSION}-%{RELEASE}', rpm_file
-    ]
-    return run_command(command)
+    def subn(self, text: str) -> Tuple[str, int]:
+        if self.overlap_pattern and self.overlap_pattern.search(text):
+            count = 0
+            for literal, expanded in self.literals:
+                parts = text.split(literal)
+                text = expanded.join(parts)
+                count += len(parts) - 1
+            return text, count
+        # every odd part is a match
+        parts = self.pattern.split(text)
+        parts[1::2] = map(self.replacements.__getitem__, parts[1::2])
+        return ''.join(parts), len(parts) // 2
 
 
-def get_pkg_provides_from_rpm(rpm_file: str) -> List[str]:
-    res = subprocess.run(['rpm', '-qP', rpm_file], stdout=subprocess.PIPE)
-    if res.returncode == 0:
-        return res.stdout.decode().strip().splitlines()
-    return []
+def _combine_literal_substitutions(
+    patterns: List[Tuple[Pattern, Union[str, Callable[[Match], str]]]]
+) -> List[Tuple[Pattern, Union[str, Callable[[Match], str]]]]:
+    """Combine runs of consecutive substitutions of literal regexes by
+    strings into a single alternation of the literals, see
+    :py:class:`CombinedLiterals`.
 
+    """
+    combined: List[Tuple[Pattern, Union[str, Callable[[Match], str]]]] = []
+    # the (literal, expanded replacement) pairs of the current run
+    run: List[Tuple[str, str]] = []
+    run_patterns: List[Tuple[Pattern, Union[str, Callable[[Match], str]]]] = []
 
-def get_pkg_version(package: str) -> str:
-    command = [
-        'rpm', '-q', '--queryformat', '%{VERSION}-%{RELEASE}', package
-    ]
-    return run_command(command)
+    def flush():
+        if len(run) > 1:
+            literals = CombinedLiterals(list(run))
+            combined.append((literals.pattern, literals))
+        else:
+            combined.extend(run_patterns)
+        run.clear()
+        run_patterns.clear()
+
+    for pattern, replacement in patterns:
+        literal = None if callable(replacement) else _regex_literal(pattern)
+        # literals spanning lines are left to the streaming substitution
+        if literal is None or '\n' in literal:
+            flush()
+            combined.append((pattern, replacement))
+            continue
+        expanded = pattern.sub(replacement, literal)
+        if not CombinedLiterals.accepts(run, literal, expanded):
+            flush()
+        run.append((literal, expanded))
+        run_patterns.append((pattern, replacement))
+    flush()
+    return combined
+
+
+def _strings_overlap(first: str, second: str) -> bool:
+    """Whether occurrences of `first` and `second` in a text can overlap,
+    i.e. one contains the other or a suffix of one is a prefix of the other.
+
+    """
+    if first in second or second in first:
+        return True
+    return any(
+        first.endswith(second[:length]) or second.endswith(first[:length])
+        for length in range(1, min(len(first), len(second)))
+    )
+
+
+def _same_contents(input_file: str, output_file: str) -> bool:
+    try:
+        return os.path.samefile(input_file, output_file) or filecmp.cmp(
+            input_file, output_file, shallow=False
+        )
+    except OSError:
+        return False
+
+
+def _has_contents(output_file: str, contents: str) -> bool:
+    """Whether `output_file` exists and already has the `contents`, as written
+    by :py:func:`open` in text mode.
+
+    """
+    try:
+        encoded = contents.encode(locale.getpreferredencoding(False))
+        if os.linesep != '\n':
+            encoded = encoded.replace(b'\n', os.linesep.encode())
+        with open(output_file, 'rb') as out_file:
+            return out_file.read(len(encoded) + 1) == encoded
+    except (OSError, UnicodeEncodeError):
+        return False
+
+
+def substitute_stream(
+    chunks: Iterable[str],
+    pattern: Pattern,
+    replacement: Union[str, Callable[[Match], str]],
+    overlap: int,
+    counter: Optional[List[int]] = None,
+) -> Iterator[str]:
+    """Replace all matches of `pattern` in the text consisting of `chunks`
+    with `replacement`, like :py:func:`re.sub` does, yielding the result in
+    chunks.
+
+    Patterns that cannot match a newline are applied to blocks of complete
+    lines, which gives exactly the same result as applying them to the whole
+    text. For all other patterns a window of `overlap` characters at the end
+    of the available text is held back, matches reaching into it are only
+    replaced once more text has been read. Text in front of the current
+    position is kept as context for lookbehind assertions and ``\\b``.
+
+    The pattern must not match the empty string, see
+    :py:func:`_regex_is_streamable`. The number of substitutions is added to
+    the first element of `counter`.
+
+    """
+    if counter is None:
+        counter = [0]
+
+    if _regex_is_line_local(pattern):
+        subn = _substitution_function(pattern, replacement)
+        rest = ''
+        for chunk in chunks:
+            rest += chunk
+            end = rest.rfind('\n') + 1
+            if end:
+                result, matches = subn(rest[:end])
+                counter[0] += matches
+                yield result
+                rest = rest[end:]
+        if rest:
+            result, matches = subn(rest)
+            counter[0] += matches
+            yield result
+        return
+
+    buffer = ''
+    # position in buffer up to which the text has been emitted
+    pos = 0
+    chunks = iter(chunks)
+    eof = False
+    while not eof:
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+        else:
+            buffer += chunk
+
+        limit = len(buffer) if eof else max(len(buffer) - overlap, pos)
+        output = []
+        for match in pattern.finditer(buffer, pos):
+            if not eof and match.end() > limit:
+                limit = min(limit, match.start())
+                break
+            output.append(buffer[pos:match.start()])
+            output.append(
+                replacement(match) if callable(replacement)
+                else match.expand(replacement)
+            )
+            counter[0] += 1
+            pos = match.end()
+        limit = max(limit, pos)
+        output.append(buffer[pos:limit])
+        pos = limit
+        yield ''.join(output)
+
+        # drop everything but the context in front of the current position
+        context_start = max(pos - max(overlap, 1), 0)
+        buffer = buffer[context_start:]
+        pos -= context_start
+
+
+def _iter_regex_nodes(parsed) -> Iterator[tuple]:
+    """Yield all the (opcode, argument) nodes of the parsed regex `parsed`
+    recursively.
+
+    """
+    for op, av in parsed:
+        yield op, av
+        if op == sre_constants.BRANCH:
+            for branch in av[1]:
+                yield from _iter_regex_nodes(branch)
+        elif op == sre_constants.SUBPATTERN:
+            yield from _iter_regex_nodes(av[-1])
+        elif op in _regex_repeat_ops:
+            yield from _iter_regex_nodes(av[2])
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            yield from _iter_regex_nodes(av[1])
+        elif op == sre_constants.GROUPREF_EXISTS:
+            yield from _iter_regex_nodes(av[1])
+            if av[2] is not None:
+                yield from _iter_regex_nodes(av[2])
+        elif op == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            yield from _iter_regex_nodes(av)
+
+
+def _regex_is_streamable(pattern: Pattern) -> bool:
+    """Whether `pattern` can be applied to chunks of a text via
+    :py:func:`substitute_stream`, which is the case if it cannot match the
+    empty string.
+
+    """
+    return sre_parse.parse(pattern.pattern, pattern.flags).getwidth()[0] > 0
+
+
+def _regex_is_line_local(pattern: Pattern) -> bool:
+    """Whether all matches of `pattern` are confined to a single line and do
+    not depend on the surrounding lines, i.e. the pattern cannot match a
+    newline and contains no anchors (besides word boundaries) and no
+    lookaround assertions.
+
+    """
+    if pattern.flags & re.DOTALL:
+        return False
+    parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    newline = ord('\n')
+    for op, av in _iter_regex_nodes(parsed):
+        if op == sre_constants.SUBPATTERN and av[1] & re.DOTALL:
+            return False
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            return False
+        if op == sre_constants.AT and av not in (
+            sre_constants.AT_BOUNDARY, sre_constants.AT_NON_BOUNDARY
+        ):
+            return False
+        if op == sre_constants.LITERAL and av == newline:
+            return False
+        if op == sre_constants.NOT_LITERAL and av != newline:
+            return False
+        if op == sre_constants.IN:
+            for item_op, item_av in av:
+                if item_op == sre_constants.NEGATE:
+                    return False
+                if item_op == sre_constants.LITERAL and item_av == newline:
+                    return False
+                if item_op == sre_constants.RANGE and (
+                    item_av[0] <= newline <= item_av[1]
+                ):
+                    return False
+                if (
+                    item_op == sre_constants.CATEGORY
+                    and item_av in _newline_categories
+                ):
+                    return False
+    return True
+
+
+def _regex_has_nested_quantifiers(pattern: Pattern) -> bool:
+    """Whether `pattern` repeats a part without bound that itself consists of
+    an unbounded repetition (e.g. ``(a+)+``, ``(\\w+\\s?)*`` or
+    ``(?:a|b+)+``). The text matched by the outer repetition can then be
+    split into iterations in exponentially many ways, which are all tried
+    when the rest of the regex does not match.
+
+    """
+    parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    return any(
+        op in _regex_backtracking_repeat_ops
+        and av[1] == sre_constants.MAXREPEAT
+        and _regex_repeats_ambiguously(av[2])
+        for op, av in _iter_regex_nodes(parsed)
+    )
+
+
+def _nested_quantifiers_message(regex: str) -> str:
+    return (
+        "Regex '{0}' nests unbounded quantifiers (like '(a+)+'), which can "
+        "take exponential time when it does not match".format(regex)
+    )
+
+
+@lru_cache(maxsize=None)
+def _warn_nested_quantifiers(regex: str) -> None:
+    """Warn once per regex, it is applied to every file."""
+    print(
+        'Warning: ' + _nested_quantifiers_message(regex), file=sys.stderr
+    )
+
+
+def _regex_repeats_ambiguously(parsed) -> bool:
+    """Whether the parsed regex `parsed` only consists of an unbounded
+    repetition (or an alternation of which a branch does) and of parts that
+    can match the empty string.
+
+    """
+    # the parser state is called `pattern` before Python 3.8
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    items = list(_iter_regex_sequence(parsed))
+    mandatory = [
+        (op, av) for op, av in items
+        if sre_parse.SubPattern(state, [(op, av)]).getwidth()[0] > 0
+    ]
+    if len(mandatory) > 1:
+        return False
+    for op, av in mandatory or items:
+        if (
+            op in _regex_backtracking_repeat_ops
+            and av[1] == sre_constants.MAXREPEAT
+        ):
+            return True
+        if op == sre_constants.BRANCH and any(
+            _regex_repeats_ambiguously(branch) for branch in av[1]
+        ):
+            return True
+    return False
+
+
+def _iter_regex_sequence(parsed) -> Iterator[tuple]:
+    """Yield the (opcode, argument) nodes of the parsed regex `parsed` in
+    sequence, with the contents of groups inlined.
+
+    """
+    for op, av in parsed:
+        if op == sre_constants.SUBPATTERN:
+            yield from _iter_regex_sequence(av[-1])
+        else:
+            yield op, av
+
+
+def _call_with_timeout(func: Callable[[], int], timeout: float, error: str):
+    """Return the result of `func`, unless it takes longer than `timeout`
+    seconds, which raises an exception with the message `error`.
+
+    In the main thread, `func` is interrupted by ``SIGALRM`` (the regex
+    engine checks for signals while matching). Other threads cannot be
+    interrupted, so there `func` runs in a forked process that is killed
+    once the time is up. Without either, `func` is called without a limit.
+
+    """
+    import signal
+    if (
+        threading.current_thread() is threading.main_thread()
+        and hasattr(signal, 'setitimer')
+        and signal.getsignal(signal.SIGALRM) in (signal.SIG_DFL, None)
+        and signal.getitimer(signal.ITIMER_REAL)[0] == 0
+    ):
+        def expire(signum, frame):
+            raise Exception(error)
+
+        previous = signal.signal(signal.SIGALRM, expire)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return func()
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    import multiprocessing
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return func()
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+
+    def run():
+        try:
+            result = (True, func())
+        except BaseException as exc:
+            result = (False, exc)
+        try:
+            sender.send(result)
+        except Exception:
+            # e.g. an exception that cannot be pickled
+            sender.send((False, Exception(str(result[1]))))
+
+    process = context.Process(target=run, daemon=True)
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            process.kill()
+            raise Exception(error)
+        try:
+            succeeded, result = receiver.recv()
+        except EOFError:
+            process.join()
+            raise RuntimeError(
+                'Worker failed with exit code {0}'.format(process.exitcode)
+            ) from None
+    finally:
+        process.join()
+        receiver.close()
+    if not succeeded:
+        raise result
+    return result
+
+
+@contextmanager
+def _atomic_write(
+    output_file: str, open_mode: str = 'w'
+) -> Iterator[Union[TextIO, BinaryIO]]:
+    """Open a temporary file next to `output_file` for writing (in text or
+    binary `open_mode`), which replaces `output_file` once it has been written
+    successfully, unless `output_file` already has the same contents.
+
+    The temporary file gets the permissions of the existing `output_file` or
+    the default permissions for new files.
+
+    """
+    fd, tmp_file = tempfile.mkstemp(
+        prefix='.' + os.path.basename(output_file) + '.',
+        dir=os.path.dirname(output_file) or '.',
+    )
+    try:
+        try:
+            mode = os.stat(output_file).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~_get_umask()
+        os.chmod(tmp_file, mode)
+        with os.fdopen(fd, open_mode) as out_file:
+            yield out_file
+        if _same_contents(tmp_file, output_file):
+            os.unlink(tmp_file)
+        else:
+            os.replace(tmp_file, output_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+
+@lru_cache(maxsize=None)
+def _get_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def find_package_version(package, rpm_dir, jobs: Optional[int] = None):
+    """Find the version of `package` (a name, a capability or a versioned
+    dependency). `rpm_dir` is a directory or the :py:class:`LocalRepos`
+    that are searched besides the installed packages.
+
+    Inside of a build, the result (also if no version is found) is recorded
+    in the :py:class:`BuildLock` and later invocations take it from there.
+
+    """
+    lock = get_build_lock()
+    if lock is not None:
+        entry = lock.get(package, rpm_dir)
+        if entry is not None:
+            _trace_count('lock_hits')
+            version = _run_stage(package, 'lock', lambda: entry[0])
+            if version is None:
+                raise Exception(f'Package {package} version not found')
+            return version
+        _trace_count('lock_misses')
+
+    dependency = parse_dependency(package)
+    if dependency.flags:
+        version, stage = _run_stages(
+            format_dependency(*dependency),
+            _get_dependency_stages(dependency, rpm_dir, jobs),
+        )
+    else:
+        version, stage = _run_stages(package, (
+            ('rpmdb', lambda: get_pkg_version(package)),
+            ('local_repos', lambda: find_package_version_in_local_repos(
+                rpm_dir, package, jobs=jobs
+            )),
+            ('obsinfo', lambda: find_package_version_in_obsinfo(
+                '.', package
+            )),
+            ('rpmdb_capability', lambda: get_installed_version_by_capability(
+                package
+            )),
+            ('local_repos_capability', lambda: (
+                find_package_version_by_capability(rpm_dir, package, jobs=jobs)
+            )),
+        ))
+
+    if lock is not None:
+        lock.set(package, rpm_dir, version, stage)
+    if version is None:
+        raise Exception(f'Package {package} version not found')
+    return version
+
+
+def _run_stages(
+    package: str,
+    stages: Iterable[Tuple[str, Callable[[], Optional[str]]]],
+) -> Tuple[Optional[str], Optional[str]]:
+    """Run the lookups of `stages` until one finds a version, return it
+    together with the name of that stage.
+
+    """
+    for stage, lookup in stages:
+        version = _run_stage(package, stage, lookup)
+        if version is not None:
+            return str(version), stage
+    return None, None
+
+
+def find_package_version_in_local_repos(
+    repo_path, package, jobs: Optional[int] = None
+):
+    return get_repo_catalog(repo_path, jobs=jobs).find_version(package)
+
+
+def find_package_version_by_capability(
+    repo_path: str, capability: str, jobs: Optional[int] = None
+) -> Optional[str]:
+    """Find the highest rpm package version of all packages in `repo_path` that
+    have a rpm provides containing the string `capability`.
+
+    The package headers are read by up to `jobs` parallel workers, see
+    :py:func:`read_rpm_headers`.
+
+    """
+    return get_repo_catalog(
+        repo_path, jobs=jobs
+    ).find_version_by_capability(capability)
+
+
+def find_package_version_by_dependency(
+    dependency: Dependency,
+    rpm_dir: Union[str, LocalRepos],
+    jobs: Optional[int] = None,
+) -> str:
+    """Find the highest version of the packages satisfying the versioned
+    `dependency`, among the installed packages, the packages in `rpm_dir`
+    and finally the `*.obsinfo` files.
+
+    """
+    package = format_dependency(*dependency)
+    version, _ = _run_stages(
+        package, _get_dependency_stages(dependency, rpm_dir, jobs)
+    )
+    if version is None:
+        raise Exception(f'Package {package} version not found')
+    return version
+
+
+def _get_dependency_stages(
+    dependency: Dependency,
+    rpm_dir: Union[str, LocalRepos],
+    jobs: Optional[int],
+) -> Tuple[Tuple[str, Callable[[], Optional[str]]], ...]:
+    def find_in_obsinfo() -> Optional[str]:
+        version = find_package_version_in_obsinfo('.', dependency.name)
+        if version is not None and dependency_satisfies(
+            Dependency(dependency.name, RPMSENSE_EQUAL, version), dependency
+        ):
+            return version
+        return None
+
+    return (
+        ('rpmdb_dependency', lambda: get_installed_version_by_dependency(
+            dependency
+        )),
+        ('local_repos_dependency', lambda: get_repo_catalog(
+            rpm_dir, jobs=jobs
+        ).find_version_by_dependency(dependency)),
+        ('obsinfo', find_in_obsinfo),
+    )
+
+
+def find_highest_version(versions: Iterable[str]) -> Optional[str]:
+    """Return the highest of the `[EPOCH:]VERSION-RELEASE` strings in
+    `versions` without its epoch, or `None` if it is empty.
+
+    The versions are compared via their :py:func:`evr_key`, of equal
+    versions the last one is returned.
+
+    """
+    version = key = None
+    for candidate in versions:
+        candidate_key = evr_key(candidate)
+        if version is None or candidate_key >= key:
+            version, key = candidate, candidate_key
+    if version is None:
+        return None
+    return strip_epoch(version)
+
+
+def find_package_version_in_obsinfo(path, package):
+    return find_highest_version(
+        get_pkg_version_from_obsinfo(f) for f in os.listdir(path)
+        if f.endswith('obsinfo') and package in f
+    )
+
+
+def find_match_in_version(regexpr, version):
+    search = re.search(regexpr, version)
+    if search is None:
+        return version
+    else:
+        return search.group(1)
+
+
+def run_command(command: List[str]) -> str:
+    _trace_count('subprocesses')
+    return subprocess.check_output(command).decode()
+
+
+def get_pkg_version_from_obsinfo(obsinfo_file: str) -> Optional[str]:
+    regex = re.compile(obsinfo_regex)
+    with open(obsinfo_file) as f:
+        for line in f:
+            match = regex.match(line)
+            if match:
+                return match[1]
+    return None
+
+
+_thread_local = threading.local()
+
+
+def _get_transaction_set() -> "rpm.TransactionSet":
+    """Return the transaction set used to read package headers.
+
+    It is created only once per thread (transaction sets must not be shared
+    between threads) and configured to skip the signature and digest
+    verification, the build environment usually does not even have the
+    signing keys imported.
+
+    """
+    transaction_set = getattr(_thread_local, 'transaction_set', None)
+    if transaction_set is None:
+        transaction_set = rpm.TransactionSet()
+        transaction_set.setVSFlags(
+            rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS
+        )
+        _thread_local.transaction_set = transaction_set
+    return transaction_set
+
+
+def _to_str(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode()
+    return str(value)
+
+
+def format_dependency(name: str, flags: int, version: str) -> str:
+    """Format a dependency the same way as :command:`rpm -qP` does, e.g.
+    ``httpd = 2.4.58-1.1``.
+
+    """
+    sense = ''
+    if flags & RPMSENSE_LESS:
+        sense += '<'
+    if flags & RPMSENSE_GREATER:
+        sense += '>'
+    if flags & RPMSENSE_EQUAL:
+        sense += '='
+    if sense and version:
+        return f'{name} {sense} {version}'
+    return name
+
+
+def parse_dependency(dependency: str) -> Dependency:
+    """Parse a dependency expression like ``httpd >= 2.4`` (the operator has
+    to be separated by whitespace, as in rpm spec files) or a plain name.
+
+    """
+    fields = dependency.split()
+    if len(fields) == 1:
+        return Dependency(fields[0])
+    if len(fields) == 3 and fields[1] in dependency_operators:
+        return Dependency(
+            fields[0], dependency_operators[fields[1]], fields[2]
+        )
+    raise Exception(
+        f"Invalid dependency '{dependency}'. Expected 'NAME' or "
+        "'NAME OPERATOR VERSION', e.g. 'httpd >= 2.4'"
+    )
+
+
+def _parse_provide(provide: str) -> Dependency:
+    """Parse a provide formatted by :py:func:`format_dependency`."""
+    fields = provide.split(' ', 2)
+    if len(fields) == 3 and fields[1] in dependency_operators:
+        return Dependency(
+            fields[0], dependency_operators[fields[1]], fields[2]
+        )
+    return Dependency(provide)
+
+
+def parse_evr(evr: str) -> Tuple[Optional[str], str, Optional[str]]:
+    """Split `[EPOCH:]VERSION[-RELEASE]` into its parts."""
+    epoch = release = None
+    if ':' in evr:
+        epoch, evr = evr.split(':', 1)
+    if '-' in evr:
+        evr, release = evr.rsplit('-', 1)
+    return epoch, evr, release
+
+
+def strip_epoch(evr: str) -> str:
+    epoch, separator, version_release = evr.partition(':')
+    if separator and epoch.isdigit():
+        return version_release
+    return evr
+
+
+@lru_cache(maxsize=None)
+def version_key(version: str) -> tuple:
+    """Return a key of the version (or release) string `version` that orders
+    the same way as rpm's ``rpmvercmp``.
+
+    ``rpmvercmp`` compares the alphanumeric segments of both strings pairwise,
+    all other characters only separate segments. Numeric segments compare by
+    their value and are newer than alphabetic ones, which compare like
+    ``strcmp``. ``~`` sorts before anything, even the end of the string, and
+    ``^`` sorts after the end of the string but before any other segment.
+    Each segment is thus mapped to a rank and its value, followed by the
+    rank of the end of the string.
+
+    """
+    key = []
+    for segment in _version_segment_regex.findall(version):
+        if segment == '~':
+            key.append((0,))
+        elif segment == '^':
+            key.append((2,))
+        elif segment.isdigit():
+            key.append((4, int(segment)))
+        else:
+            key.append((3, segment))
+    key.append((1,))
+    return tuple(key)
+
+
+@lru_cache(maxsize=None)
+def evr_key(evr: str) -> tuple:
+    """Return the key of a `[EPOCH:]VERSION[-RELEASE]` string, a missing
+    epoch counts as 0.
+
+    """
+    epoch, version, release = parse_evr(evr)
+    return (
+        version_key(epoch or '0'), version_key(version),
+        version_key(release or ''),
+    )
+
+
+def label_key(
+    label: Tuple[Optional[str], Optional[str], Optional[str]]
+) -> tuple:
+    """Return the key of an `(epoch, version, release)` tuple that orders
+    like ``rpm.labelCompare``, which puts missing values before any others.
+
+    """
+    return tuple(
+        (0,) if value is None else (1, version_key(value))
+        for value in label
+    )
+
+
+def label_compare(
+    label1: Tuple[Optional[str], Optional[str], Optional[str]],
+    label2: Tuple[Optional[str], Optional[str], Optional[str]],
+) -> int:
+    """Compare two `(epoch, version, release)` tuples like
+    ``rpm.labelCompare`` does, without requiring the rpm bindings.
+
+    """
+    key1, key2 = label_key(label1), label_key(label2)
+    return (key1 > key2) - (key1 < key2)
+
+
+def compare_evrs(evr1: str, evr2: str) -> int:
+    """Compare two `[EPOCH:]VERSION[-RELEASE]` strings the way rpm does for
+    dependency ranges: a missing epoch is 0 and the releases are only taken
+    into account if both have one.
+
+    """
+    epoch1, version1, release1 = parse_evr(evr1)
+    epoch2, version2, release2 = parse_evr(evr2)
+    if release1 is None or release2 is None:
+        release1 = release2 = None
+    return label_compare(
+        (epoch1 or '0', version1, release1),
+        (epoch2 or '0', version2, release2),
+    )
+
+
+def dependency_satisfies(provide: Dependency, require: Dependency) -> bool:
+    """Whether the provide `provide` satisfies the requirement `require`,
+    i.e. both have the same name and their version ranges overlap.
+    Unversioned provides and requirements match any version.
+
+    """
+    if provide.name != require.name:
+        return False
+    provide_sense = provide.flags & RPMSENSE_SENSEMASK
+    require_sense = require.flags & RPMSENSE_SENSEMASK
+    if not (provide_sense and provide.evr and require_sense and require.evr):
+        return True
+
+    sense = compare_evrs(provide.evr, require.evr)
+    if sense < 0:
+        return bool(
+            provide_sense & RPMSENSE_GREATER or require_sense & RPMSENSE_LESS
+        )
+    if sense > 0:
+        return bool(
+            provide_sense & RPMSENSE_LESS or require_sense & RPMSENSE_GREATER
+        )
+    return bool(provide_sense & require_sense)
+
+
+def header_satisfies(header: RpmHeader, require: Dependency) -> bool:
+    """Whether one of the provides of the package `header` satisfies
+    `require`.
+
+    """
+    return any(
+        dependency_satisfies(_parse_provide(provide), require)
+        for provide in header.provides
+    )
+
+
+def parse_rpm_header(rpm_file: str) -> Optional[RpmHeader]:
+    """Read the header of `rpm_file` without librpm.
+
+    The file is memory mapped and only the lead, the signature header and
+    the main header are looked at, of the latter only the tags needed for
+    :py:class:`RpmHeader` are decoded. The payload is never touched, so
+    reading the header of a huge package is as cheap as the one of a tiny
+    package. `None` is returned if the file is not a rpm package or uses a
+    layout that is not understood here.
+
+    """
+    try:
+        with open(rpm_file, 'rb') as rpm_fd, mmap.mmap(
+            rpm_fd.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            tags = _parse_rpm_header_tags(data)
+    except (OSError, ValueError, struct.error, UnicodeDecodeError):
+        return None
+
+    if not all(
+        tags.get(tag) for tag in
+        (RPMTAG_NAME, RPMTAG_VERSION, RPMTAG_RELEASE, RPMTAG_ARCH)
+    ):
+        return None
+    epoch = tags.get(RPMTAG_EPOCH)
+    return RpmHeader(
+        name=tags[RPMTAG_NAME][0],
+        epoch=None if not epoch else str(epoch[0]),
+        version=tags[RPMTAG_VERSION][0],
+        release=tags[RPMTAG_RELEASE][0],
+        arch=tags[RPMTAG_ARCH][0],
+        provides=[
+            format_dependency(name, flags, version)
+            for name, flags, version in zip(
+                tags.get(RPMTAG_PROVIDENAME, []),
+                tags.get(RPMTAG_PROVIDEFLAGS, []),
+                tags.get(RPMTAG_PROVIDEVERSION, []),
+            )
+        ],
+    )
+
+
+def _parse_rpm_header_tags(data: mmap.mmap) -> Dict[int, list]:
+    if data[:4] != RPM_LEAD_MAGIC:
+        raise ValueError('Not a rpm package')
+    _, _, _, signature_end = _parse_rpm_header_index(data, RPM_LEAD_SIZE)
+    # the signature header is padded to a multiple of 8 bytes
+    count, index, store, end = _parse_rpm_header_index(
+        data, signature_end + (-signature_end % 8)
+    )
+
+    entries = {}
+    for offset in range(index, store, 16):
+        tag, tag_type, tag_offset, tag_count = struct.unpack_from(
+            '>4I', data, offset
+        )
+        # entries appended to the header later on replace the original ones
+        if tag in _rpm_header_tags:
+            entries[tag] = (tag_type, store + tag_offset, tag_count)
+    return {
+        tag: _decode_rpm_tag(data, end, *entry)
+        for tag, entry in entries.items()
+    }
+
+
+def _parse_rpm_header_index(
+    data: mmap.mmap, offset: int
+) -> Tuple[int, int, int, int]:
+    """Return the number of index entries, the offsets of the index and of
+    the data store and the end of the header starting at `offset`.
+
+    """
+    if data[offset:offset + 4] != RPM_HEADER_MAGIC:
+        raise ValueError(f'No rpm header at offset {offset}')
+    count, length = struct.unpack_from('>2I', data, offset + 8)
+    # the same limits as rpm's hdrchkTags and hdrchkData
+    if count & 0xff000000 or length & 0xc0000000:
+        raise ValueError(f'Invalid rpm header at offset {offset}')
+    index = offset + 16
+    store = index + 16 * count
+    end = store + length
+    if end > len(data):
+        raise ValueError('Truncated rpm header')
+    return count, index, store, end
+
+
+def _decode_rpm_tag(
+    data: mmap.mmap, end: int, tag_type: int, offset: int, count: int
+) -> list:
+    if tag_type == RPM_INT32_TYPE:
+        if offset + 4 * count > end:
+            raise ValueError('Truncated rpm header')
+        return list(struct.unpack_from(f'>{count}I', data, offset))
+    if tag_type not in (
+        RPM_STRING_TYPE, RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE
+    ):
+        raise ValueError(f'Unexpected rpm tag type {tag_type}')
+    strings = []
+    for _ in range(count):
+        null = data.find(b'\0', offset, end)
+        if null < 0:
+            raise ValueError('Truncated rpm header')
+        strings.append(data[offset:null].decode())
+        offset = null + 1
+    return strings
+
+
+def read_rpm_header(rpm_file: str) -> Optional[RpmHeader]:
+    """Read the header of `rpm_file` in-process.
+
+    The header is parsed by :py:func:`parse_rpm_header`, the rpm bindings
+    are only used for packages it does not understand. All the tags required
+    for the version lookups are extracted in one go, `None` is returned if
+    the file is not a readable rpm package.
+
+    """
+    header = parse_rpm_header(rpm_file)
+    if header is not None:
+        return header
+    try:
+        transaction_set = _get_transaction_set()
+    except ImportError:
+        # no rpm bindings, the rpm binary might still be able to read it
+        return None
+    try:
+        with open(rpm_file, 'rb') as rpm_fd:
+            hdr = transaction_set.hdrFromFdno(rpm_fd.fileno())
+    except (OSError, rpm.error):
+        return None
+    return _rpm_header_from_hdr(hdr)
+
+
+def _rpm_header_from_hdr(hdr: "rpm.hdr") -> RpmHeader:
+    epoch = hdr[rpm.RPMTAG_EPOCH]
+    return RpmHeader(
+        name=_to_str(hdr[rpm.RPMTAG_NAME]),
+        epoch=None if epoch is None else _to_str(epoch),
+        version=_to_str(hdr[rpm.RPMTAG_VERSION]),
+        release=_to_str(hdr[rpm.RPMTAG_RELEASE]),
+        arch=_to_str(hdr[rpm.RPMTAG_ARCH]),
+        provides=[
+            format_dependency(_to_str(name), flags, _to_str(version))
+            for name, flags, version in zip(
+                hdr[rpm.RPMTAG_PROVIDENAME],
+                hdr[rpm.RPMTAG_PROVIDEFLAGS],
+                hdr[rpm.RPMTAG_PROVIDEVERSION],
+            )
+        ],
+    )
+
+
+def _map_with_pool(func, items: list, jobs: Optional[int]) -> list:
+    """Apply `func` to all `items` using a pool of at most `jobs` threads
+    (defaults to :py:func:`get_default_jobs`), the results are returned in
+    the order of `items`.
+
+    """
+    if not items:
+        return []
+    if jobs is None:
+        jobs = get_default_jobs()
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        return [func(item) for item in items]
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items))
+
+
+def read_rpm_headers(
+    rpm_files: List[str], jobs: Optional[int] = None
+) -> List[Optional[RpmHeader]]:
+    """Read the headers of all `rpm_files` via :py:func:`read_rpm_header`.
+
+    The headers are read by a pool of at most `jobs` threads (defaults to
+    :py:func:`get_default_jobs`). The result is in the same order as
+    `rpm_files`, independently of the order in which the workers finish.
+
+    Packages that the rpm bindings fail to read are queried again in batches
+    via :py:func:`query_rpm_headers`, as the :command:`rpm` binary of the
+    build root might be able to read them.
+
+    """
+    _trace_count('headers_read', len(rpm_files))
+    headers = _map_with_pool(read_rpm_header, rpm_files, jobs)
+    failed = [i for i, header in enumerate(headers) if header is None]
+    if failed:
+        _trace_count('headers_queried', len(failed))
+        queried = query_rpm_headers([rpm_files[i] for i in failed], jobs)
+        for i, header in zip(failed, queried):
+            headers[i] = header
+    return headers
+
+
+def _get_max_args_length() -> int:
+    """Return the number of bytes that can be used for the arguments of a
+    child process.
+
+    Only half of ``ARG_MAX`` is used, the environment counts against the
+    limit as well and the environment of the child might be bigger.
+
+    """
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        # the minimum guaranteed by POSIX
+        arg_max = 4096
+    return arg_max // 2 - sum(
+        len(key) + len(val) + 2 for key, val in os.environ.items()
+    )
+
+
+def _split_into_chunks(
+    rpm_files: List[str], jobs: Optional[int] = None
+) -> List[List[str]]:
+    """Split `rpm_files` into chunks that can be passed to a single
+    :command:`rpm` invocation without exceeding ``ARG_MAX``.
+
+    The files are spread over at least `jobs` chunks (if there are enough
+    files), so that the chunks can be queried in parallel.
+
+    """
+    if jobs is None:
+        jobs = get_default_jobs()
+    max_files = max(-(-len(rpm_files) // max(jobs, 1)), 1)
+    max_length = _get_max_args_length() - sum(
+        len(arg) + 1 for arg in rpm_query_command
+    )
+
+    chunks: List[List[str]] = []
+    chunk: List[str] = []
+    length = 0
+    for rpm_file in rpm_files:
+        # the argument itself, its terminating null byte and its pointer
+        arg_length = len(os.fsencode(rpm_file)) + 1 + 8
+        if chunk and (
+            len(chunk) == max_files or length + arg_length > max_length
+        ):
+            chunks.append(chunk)
+            chunk, length = [], 0
+        chunk.append(rpm_file)
+        length += arg_length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _parse_rpm_query_output(output: str) -> List[RpmHeader]:
+    headers = []
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if fields[0] == rpm_query_record_marker:
+            name, epoch, version, release, arch = fields[1:6]
+            headers.append(RpmHeader(
+                name=name,
+                epoch=None if epoch == '(none)' else epoch,
+                version=version,
+                release=release,
+                arch=arch,
+                provides=[],
+            ))
+        elif headers and len(fields) == 3:
+            name, flags, version = fields
+            headers[-1].provides.append(
+                format_dependency(name, int(flags), version)
+            )
+    return headers
+
+
+def _query_rpm_headers_chunk(
+    rpm_files: List[str]
+) -> List[Optional[RpmHeader]]:
+    _trace_count('subprocesses')
+    try:
+        res = subprocess.run(
+            rpm_query_command + rpm_files,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        # no rpm binary in the build root
+        return [None] * len(rpm_files)
+    headers = _parse_rpm_query_output(res.stdout.decode())
+    if res.returncode == 0 and len(headers) == len(rpm_files):
+        return headers
+
+    # rpm only tells us that some of the files could not be queried, but not
+    # which ones => bisect the chunk until the broken ones are found
+    if len(rpm_files) == 1:
+        return [None]
+    middle = len(rpm_files) // 2
+    return (
+        _query_rpm_headers_chunk(rpm_files[:middle])
+        + _query_rpm_headers_chunk(rpm_files[middle:])
+    )
+
+
+def query_rpm_headers(
+    rpm_files: List[str], jobs: Optional[int] = None
+) -> List[Optional[RpmHeader]]:
+    """Query the headers of all `rpm_files` via the :command:`rpm` binary.
+
+    This is the fallback for build roots in which the rpm bindings cannot
+    read the packages. Instead of invoking :command:`rpm` for every single
+    package, the files are queried in as few invocations as ``ARG_MAX``
+    permits, which are run by up to `jobs` parallel workers. The result is in
+    the same order as `rpm_files`, `None` is returned for files that are no
+    valid rpm packages.
+
+    """
+    chunks = _split_into_chunks(rpm_files, jobs)
+    return [
+        header
+        for headers in _map_with_pool(_query_rpm_headers_chunk, chunks, jobs)
+        for header in headers
+    ]
+
+
+def _read_rpm_header_or_fail(rpm_file: str) -> RpmHeader:
+    header = read_rpm_headers([rpm_file], jobs=1)[0]
+    if header is None:
+        raise RuntimeError(f'Could not read the rpm header of {rpm_file}')
+    return header
+
+
+def parse_rpm_filename(filename: str) -> Optional[RpmFilename]:
+    """Parse a file name following the ``name-version-release.arch.rpm``
+    scheme, `None` is returned for other file names.
+
+    """
+    match = rpm_filename_regex.match(filename)
+    if match is None:
+        return None
+    return RpmFilename(*match.groups())
+
+
+def get_pkg_name_from_rpm(rpm_file: str) -> str:
+    return _read_rpm_header_or_fail(rpm_file).name
+
+
+def get_pkg_version_from_rpm(rpm_file: str) -> str:
+    return _read_rpm_header_or_fail(rpm_file).version_release
+
+
+def get_pkg_provides_from_rpm(rpm_file: str) -> List[str]:
+    header = read_rpm_headers([rpm_file], jobs=1)[0]
+    if header is None:
+        return []
+    return header.provides
+
+
+def get_local_repos(repos: Union[str, LocalRepos]) -> LocalRepos:
+    """Return `repos`, a single repository directory is turned into
+    :py:class:`LocalRepos` with the default globs.
+
+    """
+    if isinstance(repos, str):
+        return LocalRepos((repos,))
+    return repos
+
+
+@lru_cache(maxsize=None)
+def _compile_globs(globs: Tuple[str, ...]) -> Pattern:
+    import fnmatch
+    return re.compile('|'.join(
+        fnmatch.translate(glob) for glob in globs
+    ) or '(?!)')
+
+
+def walk_repo(
+    repo_path: str,
+    includes: Tuple[str, ...] = default_repo_includes,
+    excludes: Tuple[str, ...] = default_repo_excludes,
+    seen: Optional[Set[Tuple[int, int]]] = None,
+) -> RepoFiles:
+    """Return the packages and the repository metadata in the directory tree
+    of `repo_path`.
+
+    Packages are the files whose path relative to `repo_path` matches one of
+    the `includes` and none of the `excludes` globs. Repository metadata
+    are libsolv's :file:`.solv` files and the :file:`repomd.xml` of the
+    :file:`repodata` directories, which are not walked any further.
+
+    The tree is walked via :py:func:`os.scandir`, the stat results of its
+    entries are returned for later use. Symbolic links to directories are
+    followed, but every file and directory is only visited once, even if it
+    is reachable via multiple paths (symbolic or hard links): the device and
+    inode numbers of all visited files are kept in `seen`, which can be
+    shared between the walks of several repositories.
+
+    """
+    include = _compile_globs(tuple(includes))
+    exclude = _compile_globs(tuple(excludes))
+    if seen is None:
+        seen = set()
+    files = RepoFiles({}, {})
+    visited = 0
+
+    def walk(directory: str, prefix: str) -> None:
+        nonlocal visited
+        try:
+            with os.scandir(directory) as scanner:
+                entries = sorted(scanner, key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                # e.g. a dangling symbolic link
+                continue
+            key = (stat.st_dev, stat.st_ino)
+            relpath = prefix + entry.name
+            if entry.is_dir():
+                if key in seen:
+                    continue
+                seen.add(key)
+                if entry.name in repo_metadata_dirs:
+                    metadata_file = os.path.join(
+                        entry.path, repo_metadata_dirs[entry.name]
+                    )
+                    try:
+                        files.metadata[metadata_file] = os.stat(metadata_file)
+                    except OSError:
+                        pass
+                else:
+                    walk(entry.path, relpath + '/')
+                continue
+
+            visited += 1
+            if entry.name.endswith('.solv'):
+                found = files.metadata
+            elif include.match(relpath) and not exclude.match(relpath):
+                found = files.packages
+            else:
+                continue
+            # the globs are matched first, a file that is excluded via one
+            # path can still be found via another one
+            if key not in seen:
+                seen.add(key)
+                found[entry.path] = stat
+
+    try:
+        stat = os.stat(repo_path)
+    except OSError:
+        stat = None
+    if stat is not None and (stat.st_dev, stat.st_ino) not in seen:
+        seen.add((stat.st_dev, stat.st_ino))
+        walk(repo_path, '')
+    _trace_count('files_visited', visited)
+    return RepoFiles(
+        dict(sorted(files.packages.items())),
+        dict(sorted(files.metadata.items())),
+    )
+
+
+class RepoIndex:
+    """Persistent cache of the rpm headers found in a repository directory.
+
+    The headers are stored in the file :file:`.rupv-index` in the root of the
+    repository, keyed by the path of the package relative to the repository
+    root, its size and its modification time. Only packages that are new or
+    were modified since the index has been written are read again, entries of
+    packages that disappeared are dropped when the index is saved.
+
+    The index is written via :py:mod:`marshal`, which is considerably faster
+    to load than json or pickle for the flat tuples that are stored. An
+    unreadable or outdated index is silently discarded.
+
+    """
+
+    def __init__(self, repo_path: str):
+        self.repo_path = repo_path
+        self.index_file = os.path.join(repo_path, repo_index_filename)
+        self._entries: Dict[str, tuple] = {}
+        self._seen: Set[str] = set()
+        self._dirty = False
+        self.load()
+
+    def load(self) -> None:
+        import marshal
+        try:
+            with open(self.index_file, 'rb') as index_file:
+                data = marshal.load(index_file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if (
+            isinstance(data, tuple) and len(data) == 2
+            and data[0] == REPO_INDEX_FORMAT and isinstance(data[1], dict)
+        ):
+            self._entries = data[1]
+
+    def save(self) -> None:
+        """Write the index back to disk if it changed, failures to write it
+        (e.g. a read-only repository) are ignored.
+
+        """
+        for relpath in list(self._entries):
+            if relpath not in self._seen and not os.path.exists(
+                os.path.join(self.repo_path, relpath)
+            ):
+                del self._entries[relpath]
+                self._dirty = True
+
+        if not self._dirty:
+            return
+
+        import marshal
+        try:
+            fd, tmp_file = tempfile.mkstemp(
+                prefix=repo_index_filename + '.', dir=self.repo_path
+            )
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as index_file:
+                marshal.dump((REPO_INDEX_FORMAT, self._entries), index_file)
+            # mkstemp creates the file readable by the owner only
+            os.chmod(tmp_file, 0o666 & ~_get_umask())
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            os.unlink(tmp_file)
+            return
+        self._dirty = False
+
+    def get_header(self, rpm_file: str) -> Optional[RpmHeader]:
+        """Return the header of `rpm_file`, which must reside inside the
+        repository, reading it only if it is not cached yet or has changed.
+
+        """
+        return self.get_headers([rpm_file], jobs=1)[0]
+
+    def get_headers(
+        self,
+        rpm_files: List[str],
+        jobs: Optional[int] = None,
+        read_headers: Optional[
+            Callable[[List[str], Optional[int]], List[Optional[RpmHeader]]]
+        ] = None,
+        stats: Optional[Dict[str, os.stat_result]] = None,
+    ) -> List[Optional[RpmHeader]]:
+        """Return the headers of all `rpm_files` in the same order, the ones
+        that are not cached yet are read by up to `jobs` parallel workers via
+        `read_headers` (defaults to :py:func:`read_rpm_headers`). The stat
+        results in `stats` (e.g. from :py:func:`walk_repo`) are used instead
+        of calling stat on the files again.
+
+        """
+        if read_headers is None:
+            read_headers = read_rpm_headers
+        if stats is None:
+            stats = {}
+        headers: List[Optional[RpmHeader]] = [None] * len(rpm_files)
+        missing = []
+        for i, rpm_file in enumerate(rpm_files):
+            stat = stats.get(rpm_file)
+            if stat is None:
+                try:
+                    stat = os.stat(rpm_file)
+                except OSError:
+                    continue
+
+            relpath = os.path.relpath(rpm_file, self.repo_path)
+            self._seen.add(relpath)
+            entry = self._entries.get(relpath)
+            if (
+                entry is not None and entry[0] == stat.st_size
+                and entry[1] == stat.st_mtime_ns
+            ):
+                if entry[2] is not None:
+                    headers[i] = RpmHeader(
+                        *entry[2][:-1], list(entry[2][-1])
+                    )
+            else:
+                missing.append((i, relpath, stat))
+
+        _trace_count('index_hits', len(rpm_files) - len(missing))
+        _trace_count('index_misses', len(missing))
+        for (i, relpath, stat), header in zip(missing, read_headers(
+            [rpm_files[i] for i, _, _ in missing], jobs
+        )):
+            headers[i] = header
+            self._entries[relpath] = (
+                stat.st_size,
+                stat.st_mtime_ns,
+                None if header is None else (
+                    header[:-1] + (tuple(header.provides),)
+                ),
+            )
+            self._dirty = True
+        return headers
+
+
+_repo_indexes: Dict[str, RepoIndex] = {}
+
+
+def get_repo_index(repo_path: str) -> RepoIndex:
+    """Return the :py:class:`RepoIndex` of `repo_path`, it is loaded only once
+    per process.
+
+    """
+    key = os.path.abspath(repo_path)
+    if key not in _repo_indexes:
+        _repo_indexes[key] = RepoIndex(repo_path)
+    return _repo_indexes[key]
+
+
+class RepoCatalog:
+    """In-memory catalog of all packages in the local repositories.
+
+    The repositories are walked exactly once (see :py:func:`walk_repo`) and
+    every package header is read at most once (through the
+    :py:class:`RepoIndex` of the repository containing it). The catalog maps
+    the package names and the provides of all packages to the versions of
+    the packages, so that all the lookups of the fallback chain in
+    :py:func:`find_package_version` are answered from a single scan.
+
+    The headers are only read when needed: lookups by name first narrow the
+    packages down by their file names (see :py:func:`parse_rpm_filename`),
+    only the lookups by capability require all headers.
+
+    If the repository contains repository metadata (:file:`repodata` or
+    libsolv's :file:`.solv` files), the headers of the packages that the
+    metadata covers are taken from it instead of opening the packages, see
+    :py:func:`read_repo_metadata`.
+
+    """
+
+    def __init__(
+        self, repo_path: Union[str, LocalRepos], jobs: Optional[int] = None
+    ):
+        self.repos = get_local_repos(repo_path)
+        self.jobs = jobs
+        #: all rpm files in the repositories, sorted by their path
+        self.rpm_files: List[str] = []
+        #: package name -> versions of all packages with that name
+        self.packages: Dict[str, List[str]] = {}
+        #: provides (as printed by :command:`rpm -qP`) of all packages
+        self.capabilities = CapabilityIndex()
+        #: repository metadata found in the repository, see
+        #: :py:func:`read_repo_metadata`
+        self.metadata_files: List[str] = []
+        self._metadata: Optional[Dict[str, Tuple[int, RpmHeader]]] = None
+        self._headers: Dict[str, Optional[RpmHeader]] = {}
+        #: rpm file -> its stat result and the repository containing it
+        self._stats: Dict[str, os.stat_result] = {}
+        self._roots: Dict[str, str] = {}
+        self._complete = False
+        # the packages of a template are resolved by parallel workers
+        self._lock = threading.RLock()
+
+    def scan(self) -> None:
+        """Collect all rpm files and all repository metadata in the
+        repositories.
+
+        The files are sorted by their path, so that the result of the lookups
+        does not depend on the order of the directory entries. A package
+        linked into multiple repositories or directories is only collected
+        once.
+
+        """
+        rpm_files = []
+        metadata_files = []
+        seen: Set[Tuple[int, int]] = set()
+        for root in self.repos.paths:
+            files = walk_repo(
+                root, self.repos.includes, self.repos.excludes, seen
+            )
+            self._stats.update(files.packages)
+            self._roots.update(dict.fromkeys(files.packages, root))
+            rpm_files.extend(files.packages)
+            metadata_files.extend(files.metadata)
+        self.rpm_files = sorted(rpm_files)
+        self.metadata_files = sorted(metadata_files)
+
+    def _group_by_root(self, rpm_files: List[str]) -> Dict[str, List[str]]:
+        groups: Dict[str, List[str]] = {}
+        for rpm_file in rpm_files:
+            groups.setdefault(self._roots[rpm_file], []).append(rpm_file)
+        return groups
+
+    def _read_headers(
+        self, rpm_files: List[str], jobs: Optional[int]
+    ) -> List[Optional[RpmHeader]]:
+        """Take the headers of `rpm_files` from the repository metadata if
+        it covers them (with a matching file size), read the others.
+
+        """
+        if self._metadata is None:
+            self._metadata = {}
+            for metadata_file in self.metadata_files:
+                self._metadata.update(read_repo_metadata(metadata_file))
+
+        headers: List[Optional[RpmHeader]] = [None] * len(rpm_files)
+        missing = []
+        for i, rpm_file in enumerate(rpm_files):
+            entry = self._metadata.get(os.path.normpath(rpm_file))
+            if entry is not None and (
+                entry[0] == self._stats[rpm_file].st_size
+            ):
+                headers[i] = entry[1]
+                continue
+            missing.append(i)
+
+        _trace_count('headers_from_metadata', len(rpm_files) - len(missing))
+        for i, header in zip(missing, read_rpm_headers(
+            [rpm_files[i] for i in missing], jobs
+        )):
+            headers[i] = header
+        return headers
+
+    def get_headers(
+        self, rpm_files: List[str]
+    ) -> List[Optional[RpmHeader]]:
+        """Return the headers of `rpm_files`, the ones that are not in the
+        :py:class:`RepoIndex` yet are read by up to ``jobs`` parallel
+        workers.
+
+        """
+        with self._lock:
+            missing = [f for f in rpm_files if f not in self._headers]
+            for root, files in self._group_by_root(missing).items():
+                index = get_repo_index(root)
+                for rpm_file, header in zip(files, index.get_headers(
+                    files, jobs=self.jobs, read_headers=self._read_headers,
+                    stats=self._stats,
+                )):
+                    self._headers[rpm_file] = header
+                index.save()
+            return [self._headers[rpm_file] for rpm_file in rpm_files]
+
+    def load(self) -> None:
+        """Add the headers of all packages in the repository."""
+        with self._lock:
+            if self._complete:
+                return
+            for header in self.get_headers(self.rpm_files):
+                if header is not None:
+                    self.add(header)
+            self._complete = True
+
+    def add(self, header: RpmHeader) -> None:
+        version = header.evr
+        self.packages.setdefault(header.name, []).append(version)
+        for provide in header.provides:
+            self.capabilities.add(provide, version)
+
+    def find_version(self, package: str) -> Optional[str]:
+        """Return the highest version of the packages named `package`.
+
+        Unless all headers have been loaded already, only the headers of
+        the files whose names do not follow the
+        ``name-version-release.arch.rpm`` scheme are read, plus the headers
+        of the files named after `package`. All of the latter are read, as
+        the epoch, which takes precedence over the version, is not part of
+        the file name.
+
+        """
+        if self._complete:
+            return find_highest_version(self.packages.get(package, []))
+
+        rpm_files = []
+        for rpm_file in self.rpm_files:
+            nevra = parse_rpm_filename(os.path.basename(rpm_file))
+            if nevra is None or nevra.name == package:
+                rpm_files.append(rpm_file)
+
+        return find_highest_version(
+            header.evr
+            for header in self.get_headers(rpm_files)
+            if header is not None and header.name == package
+        )
+
+    def find_version_by_capability(
+        self, capability: str, exact: bool = False
+    ) -> Optional[str]:
+        """Return the highest version of the packages with a provides
+        containing `capability`, or with a provides named `capability` if
+        `exact` is set.
+
+        """
+        self.load()
+        if exact:
+            return find_highest_version(
+                self.capabilities.find_exact(capability)
+            )
+
+        with self._lock:
+            return find_highest_version(self.capabilities.find(capability))
+
+    def find_version_by_dependency(
+        self, dependency: Dependency
+    ) -> Optional[str]:
+        """Return the highest version of the packages with a provides that
+        satisfies `dependency`.
+
+        """
+        self.load()
+        return find_highest_version(
+            self.capabilities.find_satisfying(dependency)
+        )
+
+
+class CapabilityIndex:
+    """Index over the provides of a set of packages.
+
+    Every distinct provide (formatted like the output of :command:`rpm -qP`)
+    is stored once together with the versions of the packages that have it.
+    :py:meth:`find_exact` looks provides up by their name via a hash table.
+    :py:meth:`find` returns the provides that contain a substring. A single
+    search just scans all provides, which takes a few milliseconds even for
+    large repositories. Only once an index answered
+    :py:data:`trigram_index_queries` searches (e.g. in the long running
+    resolver service) an index of the trigrams of all provides is built in
+    memory: from then on, only the provides that contain all trigrams of the
+    searched string have to be checked. The trigram index is never stored,
+    loading it would take far longer than the scans it saves.
+
+    """
+
+    def __init__(self):
+        self.provides: List[str] = []
+        #: versions of the packages with the provide of the same position
+        self.versions: List[List[str]] = []
+        self._ids: Dict[str, int] = {}
+        self._names: Dict[str, List[int]] = {}
+        self._trigrams: Optional[Dict[str, List[int]]] = None
+        self._queries = 0
+
+    def add(self, provide: str, version: str) -> None:
+        provide_id = self._ids.get(provide)
+        if provide_id is None:
+            provide_id = self._ids[provide] = len(self.provides)
+            self.provides.append(provide)
+            self.versions.append([])
+            self._names.setdefault(
+                provide.split(' ', 1)[0], []
+            ).append(provide_id)
+            self._trigrams = None
+        self.versions[provide_id].append(version)
+
+    def find_exact(self, name: str) -> List[str]:
+        """Return the versions of the packages with a provides named
+        `name`.
+
+        """
+        return [
+            version
+            for provide_id in self._names.get(name, [])
+            for version in self.versions[provide_id]
+        ]
+
+    def find_satisfying(self, dependency: Dependency) -> List[str]:
+        """Return the versions of the packages with a provides that
+        satisfies `dependency`.
+
+        """
+        return [
+            version
+            for provide_id in self._names.get(dependency.name, [])
+            if dependency_satisfies(
+                _parse_provide(self.provides[provide_id]), dependency
+            )
+            for version in self.versions[provide_id]
+        ]
+
+    def find(self, capability: str) -> List[str]:
+        """Return the versions of the packages with a provides containing
+        the string `capability`.
+
+        """
+        self._queries += 1
+        if len(capability) < 3 or (
+            self._trigrams is None and self._queries <= trigram_index_queries
+        ):
+            candidates: Iterable[int] = range(len(self.provides))
+        else:
+            trigrams = self._get_trigrams()
+            postings = sorted(
+                (trigrams.get(trigram, []) for trigram in
+                 _get_trigrams(capability)),
+                key=len,
+            )
+            matches = set(postings[0])
+            for posting in postings[1:]:
+                if not matches:
+                    break
+                matches.intersection_update(posting)
+            candidates = sorted(matches)
+
+        return [
+            version
+            for provide_id in candidates
+            if capability in self.provides[provide_id]
+            for version in self.versions[provide_id]
+        ]
+
+    def _get_trigrams(self) -> Dict[str, List[int]]:
+        if self._trigrams is None:
+            trigrams: Dict[str, List[int]] = {}
+            for provide_id, provide in enumerate(self.provides):
+                for trigram in _get_trigrams(provide):
+                    trigrams.setdefault(trigram, []).append(provide_id)
+            self._trigrams = trigrams
+            _trace_count('trigram_indexes')
+        return self._trigrams
+
+
+def _get_trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def read_repo_metadata(
+    metadata_file: str
+) -> Dict[str, Tuple[int, RpmHeader]]:
+    """Read the packages from the repository metadata `metadata_file`, which
+    is either the :file:`repodata/repomd.xml` of a rpm-md repository or a
+    libsolv :file:`.solv` file.
+
+    The result maps the normalized paths of the packages to their file size
+    and their header, unreadable metadata is ignored.
+
+    """
+    from xml.etree import ElementTree
+    try:
+        if metadata_file.endswith('.solv'):
+            return _read_solv_metadata(metadata_file)
+        return _read_rpmmd_metadata(metadata_file)
+    except (OSError, EOFError, ValueError, ElementTree.ParseError):
+        return {}
+
+
+def _open_compressed(path: str) -> BinaryIO:
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    if path.endswith('.xz'):
+        import lzma
+        return lzma.open(path, 'rb')
+    if path.endswith('.bz2'):
+        import bz2
+        return bz2.open(path, 'rb')
+    if path.endswith('.zst'):
+        # zstandard is an optional dependency
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+def _read_rpmmd_metadata(
+    repomd_file: str
+) -> Dict[str, Tuple[int, RpmHeader]]:
+    """Stream-parse the primary metadata that is referenced from the
+    :file:`repomd.xml` `repomd_file`.
+
+    The packages are processed one at a time and discarded afterwards, so
+    that the primary metadata is never loaded into memory as a whole.
+
+    """
+    from xml.etree import ElementTree
+    base = os.path.dirname(os.path.dirname(repomd_file))
+    primary = None
+    for data in ElementTree.parse(repomd_file).getroot().iter(
+        f'{{{repomd_namespace}}}data'
+    ):
+        location = data.find(f'{{{repomd_namespace}}}location')
+        if data.get('type') == 'primary' and location is not None:
+            primary = os.path.join(base, location.get('href'))
+    if primary is None:
+        return {}
+
+    try:
+        primary_file = _open_compressed(primary)
+    except ImportError:
+        return {}
+
+    package_tag = f'{{{rpmmd_common_namespace}}}package'
+    packages = {}
+    with primary_file:
+        context = ElementTree.iterparse(primary_file, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or elem.tag != package_tag:
+                continue
+            if elem.get('type', 'rpm') == 'rpm':
+                package = _parse_rpmmd_package(elem)
+                # packages with incomplete metadata are read from the rpm
+                if package is not None:
+                    path, size, header = package
+                    packages[os.path.normpath(os.path.join(base, path))] = (
+                        size, header
+                    )
+            root.clear()
+    return packages
+
+
+def _parse_rpmmd_package(package) -> Optional[Tuple[str, int, RpmHeader]]:
+    """Return the location, the size and the header of the `package`
+    element of the primary metadata, or None if any of them is missing.
+
+    """
+    common = f'{{{rpmmd_common_namespace}}}'
+    rpm_ns = f'{{{rpmmd_rpm_namespace}}}'
+    name = package.findtext(common + 'name')
+    version = package.find(common + 'version')
+    location = package.find(common + 'location')
+    size = package.find(common + 'size')
+    if (
+        not name or version is None
+        or version.get('ver') is None or version.get('rel') is None
+        or location is None or location.get('href') is None
+        or size is None or not (size.get('package') or '').isdigit()
+    ):
+        return None
+    epoch = version.get('epoch')
+
+    provides = []
+    for entry in package.iterfind(
+        f'{common}format/{rpm_ns}provides/{rpm_ns}entry'
+    ):
+        if entry.get('name') is None:
+            continue
+        evr = entry.get('ver', '')
+        if entry.get('epoch') not in (None, '0'):
+            evr = f"{entry.get('epoch')}:{evr}"
+        if entry.get('rel'):
+            evr = f"{evr}-{entry.get('rel')}"
+        provides.append(format_dependency(
+            entry.get('name'),
+            rpmmd_dependency_flags.get(entry.get('flags'), 0),
+            evr,
+        ))
+
+    return (
+        location.get('href'),
+        int(size.get('package')),
+        RpmHeader(
+            name=name,
+            epoch=None if epoch in (None, '0') else epoch,
+            version=version.get('ver'),
+            release=version.get('rel'),
+            arch=package.findtext(common + 'arch'),
+            provides=provides,
+        ),
+    )
+
+
+def _read_solv_metadata(solv_file: str) -> Dict[str, Tuple[int, RpmHeader]]:
+    """Read the packages from a libsolv :file:`.solv` file, the package
+    locations are relative to the directory of the file.
+
+    Requires the optional libsolv bindings, an empty result is returned if
+    they are not available.
+
+    """
+    try:
+        import solv
+    except ImportError:
+        return {}
+
+    pool = solv.Pool()
+    repo = pool.add_repo(os.path.basename(solv_file))
+    solv_fp = solv.xfopen(solv_file)
+    if solv_fp is None:
+        return {}
+    try:
+        if not repo.add_solv(solv_fp):
+            return {}
+    finally:
+        solv_fp.close()
+
+    base = os.path.dirname(solv_file)
+    packages = {}
+    for solvable in repo.solvables_iter():
+        location, _ = solvable.lookup_location()
+        if not location:
+            continue
+        epoch, _, version_release = solvable.evr.rpartition(':')
+        version, _, release = version_release.rpartition('-')
+        packages[os.path.normpath(os.path.join(base, location))] = (
+            solvable.lookup_num(solv.SOLVABLE_DOWNLOADSIZE),
+            RpmHeader(
+                name=solvable.name,
+                epoch=epoch if epoch not in ('', '0') else None,
+                version=version,
+                release=release,
+                arch=solvable.arch,
+                provides=[
+                    str(dep) for dep in
+                    solvable.lookup_deparray(solv.SOLVABLE_PROVIDES)
+                ],
+            ),
+        )
+    return packages
+
+
+_repo_catalogs: Dict[LocalRepos, RepoCatalog] = {}
+_repo_catalogs_lock = threading.Lock()
+
+
+def _get_repo_catalog_key(repos: Union[str, LocalRepos]) -> LocalRepos:
+    repos = get_local_repos(repos)
+    return repos._replace(
+        paths=tuple(os.path.abspath(path) for path in repos.paths)
+    )
+
+
+def get_repo_catalog(
+    repo_path: Union[str, LocalRepos], jobs: Optional[int] = None
+) -> RepoCatalog:
+    """Return the :py:class:`RepoCatalog` of the repository directory or the
+    :py:class:`LocalRepos` `repo_path`, the repositories are scanned only
+    once per process.
+
+    """
+    key = _get_repo_catalog_key(repo_path)
+    with _repo_catalogs_lock:
+        if key in _repo_catalogs:
+            _trace_count('catalog_hits')
+        else:
+            _trace_count('catalog_misses')
+            catalog = RepoCatalog(repo_path, jobs=jobs)
+            catalog.scan()
+            _repo_catalogs[key] = catalog
+        return _repo_catalogs[key]
+
+
+_rpmdb_transaction_set = None
+_rpmdb_lock = threading.Lock()
+
+
+def query_rpmdb(tag: str, value: str) -> List[RpmHeader]:
+    """Return the headers of all installed packages whose `tag` (``name`` or
+    ``providename``) equals `value`.
+
+    The rpm database is opened only once per process via the rpm bindings.
+    If they are not installed or the database cannot be opened that way,
+    :command:`rpm -q` is used instead. If
+    none of the :py:data:`rpmdb_paths` exists, nothing is installed.
+
+    """
+    global _rpmdb_transaction_set
+    if not any(os.path.isdir(path) for path in rpmdb_paths):
+        # e.g. outside of a build root, there is no need to load librpm
+        return []
+    _trace_count('rpmdb_queries')
+    try:
+        with _rpmdb_lock:
+            if _rpmdb_transaction_set is None:
+                _rpmdb_transaction_set = rpm.TransactionSet()
+            return [
+                _rpm_header_from_hdr(hdr)
+                for hdr in _rpmdb_transaction_set.dbMatch(tag, value)
+            ]
+    except ImportError:
+        # no python bindings in the build root, `rpm.error` cannot be
+        # evaluated either
+        return _query_rpmdb_cli(tag, value)
+    except rpm.error:
+        return _query_rpmdb_cli(tag, value)
+
+
+def _query_rpmdb_cli(tag: str, value: str) -> List[RpmHeader]:
+    command = ['rpm', '-q', '--queryformat', rpm_query_format]
+    if tag == 'providename':
+        command.append('--whatprovides')
+    _trace_count('subprocesses')
+    try:
+        res = subprocess.run(
+            command + [value],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return []
+    # rpm fails if no package matches
+    if res.returncode != 0:
+        return []
+    return _parse_rpm_query_output(res.stdout.decode())
+
+
+def get_pkg_version(package: str) -> Optional[str]:
+    """Return the highest version of the installed packages named `package`,
+    or `None` if it is not installed.
+
+    """
+    return find_highest_version(
+        header.evr for header in query_rpmdb('name', package)
+    )
+
+
+def get_installed_version_by_capability(capability: str) -> Optional[str]:
+    """Return the highest version of the installed packages that provide
+    `capability`, or `None` if there are none.
+
+    """
+    return find_highest_version(
+        header.evr for header in query_rpmdb('providename', capability)
+    )
+
+
+def get_installed_version_by_dependency(
+    dependency: Dependency
+) -> Optional[str]:
+    """Return the highest version of the installed packages that have a
+    provides satisfying `dependency`, or `None` if there are none.
+
+    """
+    return find_highest_version(
+        header.evr
+        for header in query_rpmdb('providename', dependency.name)
+        if header_satisfies(header, dependency)
+    )
+
+
+class BuildLock:
+    """The versions resolved during the current build.
+
+    The service is usually run several times per build for the same
+    packages (e.g. once per version format). The first run records the full
+    version of every package, together with the lookup stage that found it
+    or the fact that none was found, in the file :file:`.rupv-lock` next to
+    the :file:`build.data` of the build. The following runs take the version
+    from there instead of querying the rpm database and walking the
+    repositories again, so all of them agree on the same version.
+
+    Every entry carries a :py:meth:`fingerprint` of the build, the local
+    repositories, the `*.obsinfo` files and the rpm database and is only
+    used as long as the fingerprint matches. Failures to write the file are
+    ignored.
+
+    """
+
+    def __init__(self, lock_file: str, build_data_file: str):
+        self.lock_file = lock_file
+        self.build_data_file = build_data_file
+        #: (working directory, repositories, package) -> entry
+        self._entries: Dict[Tuple[str, LocalRepos, str], dict] = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        import json
+        try:
+            with open(self.lock_file) as lock_file:
+                data = json.load(lock_file)
+            if data['format'] != BUILD_LOCK_FORMAT:
+                return
+            for entry in data['entries']:
+                key = (
+                    entry['cwd'],
+                    LocalRepos(*(tuple(value) for value in entry['repos'])),
+                    entry['package'],
+                )
+                self._entries[key] = entry
+        except (OSError, ValueError, KeyError, TypeError):
+            self._entries = {}
+
+    def fingerprint(self, repos: LocalRepos) -> str:
+        """Return a fingerprint of the build, the entries of the root
+        directories of `repos`, the `*.obsinfo` files in the current
+        directory and the rpm database.
+
+        Only a few files are looked at, so that it is cheap to compute: a new
+        build rewrites :file:`build.data`, and installing packages changes
+        the rpm database. Adding or removing packages changes the
+        modification time of their directory, which is only looked at for
+        the directories right below the repository roots; changes further
+        down within the same build are not noticed.
+
+        """
+        paths = [self.build_data_file]
+        for root in repos.paths:
+            try:
+                with os.scandir(root) as scanner:
+                    # the header index is written by the lookups themselves
+                    paths.extend(
+                        entry.path for entry in scanner
+                        if not entry.name.startswith(repo_index_filename)
+                    )
+            except OSError:
+                pass
+        paths.extend(
+            os.path.join(rpmdb_path, rpmdb_file)
+            for rpmdb_path in rpmdb_paths for rpmdb_file in rpmdb_files
+        )
+
+        stats = []
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats.append(
+                (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            )
+        obsinfo_signature = get_obsinfo_signature(os.getcwd())
+        import hashlib
+        return hashlib.sha256(
+            repr((stats, obsinfo_signature)).encode()
+        ).hexdigest()
+
+    def _get_key(
+        self, package: str, repos: Union[str, LocalRepos]
+    ) -> Tuple[str, LocalRepos, str]:
+        return (os.getcwd(), _get_repo_catalog_key(repos), package)
+
+    def get(
+        self, package: str, repos: Union[str, LocalRepos]
+    ) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """Return the recorded version of `package` and the stage that found
+        it (both `None` if no version was found), or `None` if there is no
+        valid entry.
+
+        """
+        key = self._get_key(package, repos)
+        entry = self._entries.get(key)
+        if entry is None or entry['fingerprint'] != self.fingerprint(key[1]):
+            return None
+        return entry['version'], entry['stage']
+
+    def set(
+        self,
+        package: str,
+        repos: Union[str, LocalRepos],
+        version: Optional[str],
+        stage: Optional[str],
+    ) -> None:
+        """Record the result of the lookup of `package` and write the lock
+        file.
+
+        """
+        key = self._get_key(package, repos)
+        entry = {
+            'cwd': key[0],
+            'repos': key[1],
+            'package': package,
+            'version': version,
+            'stage': stage,
+            'fingerprint': self.fingerprint(key[1]),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self.save()
+
+    def save(self) -> None:
+        import json
+        directory = os.path.dirname(self.lock_file) or '.'
+        try:
+            fd, tmp_file = tempfile.mkstemp(
+                prefix=build_lock_filename + '.', dir=directory
+            )
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'w') as lock_file:
+                json.dump({
+                    'format': BUILD_LOCK_FORMAT,
+                    'entries': list(self._entries.values()),
+                }, lock_file, indent=1)
+            # mkstemp creates the file readable by the owner only
+            os.chmod(tmp_file, 0o666 & ~_get_umask())
+            os.replace(tmp_file, self.lock_file)
+        except OSError:
+            os.unlink(tmp_file)
+
+
+_build_locks: Dict[str, BuildLock] = {}
+_build_locks_lock = threading.Lock()
+
+
+def get_build_lock() -> Optional[BuildLock]:
+    """Return the :py:class:`BuildLock` of the current build, or `None` when
+    not running inside of a build (see
+    :py:func:`guess_recipe_filename_from_env`).
+
+    """
+    build_dist = os.getenv("BUILD_DIST")
+    if build_dist is None or build_dist[-5:] != ".dist":
+        return None
+    lock_file = os.path.join(
+        os.path.dirname(build_dist), build_lock_filename
+    )
+    with _build_locks_lock:
+        if lock_file not in _build_locks:
+            _build_locks[lock_file] = BuildLock(
+                lock_file, build_dist[:-5] + ".data"
+            )
+        return _build_locks[lock_file]
+
+
+def get_resolver_socket(socket_path: Optional[str] = None) -> str:
+    if socket_path is None:
+        socket_path = os.environ.get('RUPV_SOCKET', default_resolver_socket)
+    return socket_path
+
+
+def resolve_package_versions(
+    packages: List[str],
+    rpm_dir: Union[str, LocalRepos],
+    jobs: Optional[int] = None,
+) -> Dict[str, str]:
+    """Return the versions of all `packages`, see
+    :py:func:`find_package_version`.
+
+    They are taken from the resolver daemon if one is listening on
+    :py:func:`get_resolver_socket`, otherwise they are resolved in-process
+    by up to `jobs` parallel workers.
+
+    """
+    if not packages:
+        return {}
+    versions = query_resolver(get_resolver_socket(), packages, rpm_dir, jobs)
+    if _trace is not None:
+        _trace.resolver = 'in-process' if versions is None else 'daemon'
+    if versions is None:
+        versions = dict(zip(packages, _map_with_pool(
+            lambda package: find_package_version(package, rpm_dir, jobs=jobs),
+            packages, jobs,
+        )))
+    return versions
+
+
+def query_resolver(
+    socket_path: str,
+    packages: List[str],
+    rpm_dir: Union[str, LocalRepos],
+    jobs: Optional[int] = None,
+    timeout: float = default_resolver_timeout,
+) -> Optional[Dict[str, str]]:
+    """Ask the resolver daemon listening on `socket_path` for the versions of
+    `packages`, returns `None` if no daemon is listening or it does not
+    reply within `timeout` seconds.
+
+    """
+    import json
+    import socket
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except OSError:
+        return None
+    with client:
+        # a hanging daemon raises socket.timeout, an OSError
+        client.settimeout(timeout)
+        try:
+            client.connect(socket_path)
+        except OSError:
+            return None
+        request = {
+            'cwd': os.getcwd(),
+            'repos': _get_repo_catalog_key(rpm_dir),
+            'packages': packages,
+            'jobs': jobs,
+        }
+        try:
+            client.sendall(json.dumps(request).encode() + b'\n')
+            with client.makefile('rb') as reader:
+                response = json.loads(reader.readline())
+        except (OSError, ValueError):
+            # e.g. the daemon has been stopped in the meantime
+            return None
+    if 'error' in response:
+        raise Exception(response['error'])
+    return response['versions']
+
+
+def get_repo_signature(repo_path: Union[str, LocalRepos]) -> str:
+    """Return a signature of the packages and the repository metadata in the
+    repository directory or the :py:class:`LocalRepos` `repo_path`, which
+    changes whenever one of them is added, removed or modified.
+
+    """
+    import hashlib
+    repos = get_local_repos(repo_path)
+    digest = hashlib.sha256()
+    seen: Set[Tuple[int, int]] = set()
+    for root in repos.paths:
+        files = walk_repo(root, repos.includes, repos.excludes, seen)
+        for path, stat in {**files.packages, **files.metadata}.items():
+            digest.update(
+                repr((path, stat.st_size, stat.st_mtime_ns)).encode()
+            )
+    return digest.hexdigest()
+
+
+def get_obsinfo_signature(path: str) -> tuple:
+    """Return a signature of the `*.obsinfo` files in the directory `path`."""
+    signature = []
+    for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+        if entry.name.endswith('obsinfo'):
+            stat = entry.stat()
+            signature.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+def get_rpmdb_signature() -> tuple:
+    """Return a signature of the files of the rpm database, which changes
+    whenever packages are installed, upgraded or removed.
+
+    """
+    signature = []
+    for rpmdb_path in rpmdb_paths:
+        for rpmdb_file in rpmdb_files:
+            path = os.path.join(rpmdb_path, rpmdb_file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature.append(
+                (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            )
+    return tuple(signature)
+
+
+class PackageResolver:
+    """Resolves package versions for the resolver daemon and keeps the
+    results as long as the repositories, the `*.obsinfo` files and the rpm
+    database they are based on do not change.
+
+    The rpm database handle, the repository catalogs and the header indexes
+    are kept by the module level caches, the catalog of a repository is
+    dropped once any of its files changes and the rpm database is opened
+    again once it changes.
+
+    """
+
+    def __init__(self, jobs: Optional[int] = None):
+        self.jobs = jobs
+        #: (working directory, repositories, package) -> version
+        self._versions: Dict[Tuple[str, LocalRepos, str], str] = {}
+        self._repo_signatures: Dict[LocalRepos, str] = {}
+        self._obsinfo_signatures: Dict[str, tuple] = {}
+        self._rpmdb_signature: Optional[tuple] = None
+
+    def invalidate(self, cwd: str, rpm_dir: LocalRepos) -> None:
+        """Drop everything that has been resolved from `rpm_dir` or the
+        `*.obsinfo` files in `cwd` if these changed, and everything if the
+        rpm database changed.
+
+        """
+        global _rpmdb_transaction_set
+        rpmdb_signature = get_rpmdb_signature()
+        if self._rpmdb_signature != rpmdb_signature:
+            self._rpmdb_signature = rpmdb_signature
+            # every lookup may have fallen back to the rpm database
+            self._versions = {}
+            with _rpmdb_lock:
+                _rpmdb_transaction_set = None
+
+        repo_signature = get_repo_signature(rpm_dir)
+        if self._repo_signatures.get(rpm_dir) != repo_signature:
+            self._repo_signatures[rpm_dir] = repo_signature
+            _repo_catalogs.pop(rpm_dir, None)
+            self._versions = {
+                key: version for key, version in self._versions.items()
+                if key[1] != rpm_dir
+            }
+
+        obsinfo_signature = get_obsinfo_signature(cwd)
+        if self._obsinfo_signatures.get(cwd) != obsinfo_signature:
+            self._obsinfo_signatures[cwd] = obsinfo_signature
+            self._versions = {
+                key: version for key, version in self._versions.items()
+                if key[0] != cwd
+            }
+
+    def resolve(
+        self,
+        cwd: str,
+        rpm_dir: LocalRepos,
+        packages: List[str],
+        jobs: Optional[int] = None,
+    ) -> Dict[str, str]:
+        """Return the versions of `packages` as seen from the working
+        directory `cwd`, the paths of `rpm_dir` have to be absolute.
+
+        The requests are handled one at a time, as the working directory of
+        the process is switched to `cwd`.
+
+        """
+        os.chdir(cwd)
+        self.invalidate(cwd, rpm_dir)
+        versions = {}
+        for package in packages:
+            key = (cwd, rpm_dir, package)
+            if key not in self._versions:
+                self._versions[key] = find_package_version(
+                    package, rpm_dir, jobs=jobs or self.jobs
+                )
+            versions[package] = self._versions[key]
+        return versions
+
+
+def _handle_resolver_request(request, client_address, server) -> None:
+    """Handle one request of :py:func:`query_resolver` on the connection
+    `request`, one JSON object per line in both directions.
+
+    """
+    import json
+    try:
+        with request.makefile('rb') as reader:
+            query = json.loads(reader.readline())
+        response = {'versions': server.resolver.resolve(
+            query['cwd'],
+            LocalRepos(*(tuple(value) for value in query['repos'])),
+            query['packages'],
+            jobs=query.get('jobs'),
+        )}
+    except Exception as error:
+        response = {'error': str(error)}
+    request.sendall(json.dumps(response).encode() + b'\n')
+
+
+def make_resolver_server(
+    socket_path: str, jobs: Optional[int] = None
+) -> 'socketserver.UnixStreamServer':
+    """Create the server of the resolver daemon listening on `socket_path`.
+
+    A socket left behind by a daemon that is not running anymore is
+    replaced.
+
+    """
+    import socket
+    import socketserver
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with probe:
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise Exception(
+                    f'A resolver is already listening on {socket_path}'
+                )
+    server = socketserver.UnixStreamServer(
+        socket_path, _handle_resolver_request
+    )
+    server.resolver = PackageResolver(jobs=jobs)
+    return server
+
+
+def serve_resolver(socket_path: str, jobs: Optional[int] = None) -> None:
+    """Run the resolver daemon on `socket_path` until it is interrupted."""
+    # the resolver switches the working directory
+    socket_path = os.path.abspath(socket_path)
+    server = make_resolver_server(socket_path, jobs=jobs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
 
 
 def init(__name__):
@@ -1,13 +1,81 @@
+import gzip
+import json
+import marshal
+import os
+import random
+import re
+import socket
+import subprocess
 import sys
+import threading
+import time
 from unittest.mock import patch, mock_open, call
 
+import docopt
+import pytest
+import rpm
+
+import rpmgen
+
 from replace_using_package_version.replace_using_package_version import (
+    CapabilityIndex,
+    Dependency,
+    RPMSENSE_EQUAL,
+    RPMSENSE_GREATER,
+    RPMSENSE_LESS,
+    LocalRepos,
+    RepoCatalog,
+    RepoIndex,
+    RpmFilename,
+    RpmHeader,
+    Rule,
+    _build_locks,
+    _combine_literal_substitutions,
+    _repo_catalogs,
+    _regex_has_nested_quantifiers,
+    _regex_is_line_local,
+    _repo_indexes,
+    _split_into_chunks,
     apply_regex_to_file,
+    apply_regexes_to_file,
+    compare_evrs,
+    dependency_satisfies,
     find_package_version,
+    find_package_version_by_capability,
+    find_package_version_in_local_repos,
+    find_highest_version,
     find_match_in_version,
+    find_template_placeholders,
+    get_files_from_args,
+    label_compare,
+    format_dependency,
     main,
+    make_resolver_server,
+    parse_args,
+    parse_dependency,
+    parse_rpm_filename,
+    parse_rpm_header,
+    parse_rule,
+    get_build_lock,
+    get_default_jobs,
+    get_installed_version_by_capability,
+    get_pkg_name_from_rpm,
+    get_pkg_version,
+    get_pkg_version_from_rpm,
+    get_repo_index,
+    guess_recipe_filename_from_env,
+    query_rpm_headers,
+    query_resolver,
+    query_rpmdb,
+    read_rpm_header,
+    read_rpm_headers,
+    resolve_package_versions,
+    rpm_query_command,
     run_command,
+    substitute_stream,
     init,
+    version_key,
+    walk_repo,
     version_regex
 )
 
@@ -16,21 +84,51 @@ open_to_patch = '{0}.open'.format(
 )
 
 
+@pytest.fixture(autouse=True)
+def clear_repo_caches():
+    _repo_indexes.clear()
+    _repo_catalogs.clear()
+    _build_locks.clear()
+    yield
+    _repo_indexes.clear()
+    _repo_catalogs.clear()
+    _build_locks.clear()
+
+
+def make_repo(tmp_path, files):
+    """Create a repository directory below `tmp_path` with the given files.
+
+    The values of `files` are the headers that `read_rpm_header` should
+    return for them, the returned dictionary maps the full paths to these
+    headers and can be used as the side effect of a mocked `read_rpm_header`.
+
+    """
+    repo = tmp_path / 'repos'
+    headers = {}
+    for name, header in files.items():
+        path = repo / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(name.encode())
+        headers[str(path)] = header
+    return str(repo), headers
+
+
 class TestRegexReplacePackageVersion(object):
-    @patch(open_to_patch, new_callable=mock_open, read_data=(
-        'This is a new line\n'
-        'this is another new line\n'
-        'and yet another line\n'
-    ))
-    def test_apply_regex_to_file(self, mock_file):
-        apply_regex_to_file('input', 'output', 'another', 'CHANGED')
-        mock_file.assert_has_calls([call('input', 'r')])
-        handler = mock_file()
-        handler.write.assert_called_once_with((
+    def test_apply_regex_to_file(self, tmp_path):
+        (tmp_path / 'input').write_text(
+            'This is a new line\n'
+            'this is another new line\n'
+            'and yet another line\n'
+        )
+        apply_regex_to_file(
+            str(tmp_path / 'input'), str(tmp_path / 'output'),
+            'another', 'CHANGED'
+        )
+        assert (tmp_path / 'output').read_text() == (
             'This is a new line\n'
             'this is CHANGED new line\n'
             'and yet CHANGED line\n'
-        ))
+        )
 
     def test_find_match_in_version(self):
         match = find_match_in_version(version_regex['major'], '0.0.1')
@@ -126,115 +224,1297 @@ class TestRegexReplacePackageVersion(object):
         )
         assert match == '3.14.1+git5.g9265358-150700.0.1.1'
 
-    @patch('subprocess.check_output')
-    def test_find_package_version(self, mock_run):
-        mock_run.return_value = b'2.3.1'
-        assert find_package_version('package', '/foo') == '2.3.1'
-        mock_run.assert_called_once_with([
-            'rpm', '-q', '--queryformat',
-            '%{VERSION}-%{RELEASE}', 'package'
-        ])
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpmdb'
+    ))
+    def test_find_package_version(self, mock_query_rpmdb):
+        mock_query_rpmdb.return_value = [
+            RpmHeader('package', None, '2.3.1', '1.1', 'noarch', []),
+            RpmHeader('package', None, '2.3.10', '1.1', 'noarch', []),
+        ]
+        assert find_package_version('package', '/foo') == '2.3.10-1.1'
+        mock_query_rpmdb.assert_called_once_with('name', 'package')
 
-    @patch('subprocess.check_output')
-    @patch('os.walk')
-    def test_find_package_version_rpm_not_installed(self, mock_walk, mock_run):
-        mock_walk.return_value = [
-            ('/foo', ['bar', 'zez'], ['baz']),
-            ('/foo/bar', [], ['spam', 'package.rpm']),
-            ('/foo/zez', [], ['package.rpm', 'somefile'])
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpmdb'
+    ))
+    def test_find_package_version_rpm_not_installed(
+        self, mock_query_rpmdb, mock_read_header, tmp_path
+    ):
+        repo, headers = make_repo(tmp_path, {
+            'baz': None,
+            'bar/spam': None,
+            'bar/package.rpm': RpmHeader(
+                'package', None, '2.3.1', '0', 'noarch', []
+            ),
+            'zez/package.rpm': RpmHeader(
+                'package', None, '2.2.4', '0', 'noarch', []
+            ),
+            'zez/somefile': None,
+        })
+        mock_read_header.side_effect = headers.get
+        mock_query_rpmdb.return_value = []
+
+        assert find_package_version('package', repo) == '2.3.1-0'
+        mock_read_header.assert_has_calls([
+            call(os.path.join(repo, 'bar/package.rpm')),
+            call(os.path.join(repo, 'zez/package.rpm')),
+        ], any_order=True)
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpmdb'
+    ))
+    def test_find_package_version_not_found(
+        self, mock_query_rpmdb, mock_read_header, tmp_path
+    ):
+        header = RpmHeader(
+            'not_matching_name', None, '1.0', '0', 'noarch', ['something']
+        )
+        repo, headers = make_repo(tmp_path, {
+            'baz': None,
+            'bar/package.rpm': header,
+            'zez/package.rpm': header,
+        })
+        mock_read_header.side_effect = headers.get
+        mock_query_rpmdb.return_value = []
+
+        with pytest.raises(Exception) as e:
+            find_package_version('package', repo)
+        assert 'Package package version not found' in str(e.value)
+        # the name and the provides lookups share one scan of the repository
+        assert mock_read_header.call_count == 2
+        mock_read_header.assert_has_calls([
+            call(os.path.join(repo, 'bar/package.rpm')),
+            call(os.path.join(repo, 'zez/package.rpm')),
+        ], any_order=True)
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpmdb'
+    ))
+    def test_find_package_version_in_obsinfo(
+        self, mock_query_rpmdb, mock_read_header, tmp_path, monkeypatch
+    ):
+        repo, headers = make_repo(tmp_path, {
+            'bar/package.rpm': RpmHeader(
+                'not_matching_name', None, '1.0', '0', 'noarch', []
+            ),
+        })
+        (tmp_path / 'somefile').write_text('')
+        (tmp_path / 'package.obsinfo').write_text('version: 2.2.1\n')
+        monkeypatch.chdir(tmp_path)
+        mock_read_header.side_effect = headers.get
+        mock_query_rpmdb.return_value = []
+
+        assert find_package_version('package', repo) == '2.2.1'
+        mock_read_header.assert_called_once_with(
+            os.path.join(repo, 'bar/package.rpm')
+        )
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpmdb'
+    ))
+    def test_find_package_version_by_capability(
+        self, mock_query_rpmdb, mock_read_header, tmp_path
+    ):
+        repo, headers = make_repo(tmp_path, {
+            'apache2.rpm': RpmHeader(
+                'apache2', None, '2.4.58', '1.1', 'x86_64',
+                ['apache2 = 2.4.58-1.1', 'httpd = 2.4.58-1.1']
+            ),
+            'apache2-old.rpm': RpmHeader(
+                'apache2', None, '2.4.51', '3.1', 'x86_64',
+                ['apache2 = 2.4.51-3.1', 'httpd = 2.4.51-3.1']
+            ),
+            'nginx.rpm': RpmHeader(
+                'nginx', None, '1.25.3', '1.1', 'x86_64',
+                ['nginx = 1.25.3-1.1']
+            ),
+        })
+        mock_read_header.side_effect = headers.get
+        mock_query_rpmdb.return_value = []
+
+        assert find_package_version('httpd', repo) == '2.4.58-1.1'
+
+    def test_capability_index(self, monkeypatch):
+        index = CapabilityIndex()
+        provides = [
+            ('apache2 = 2.4.58-1.1', '2.4.58-1.1'),
+            ('httpd = 2.4.58-1.1', '2.4.58-1.1'),
+            ('httpd = 2.4.51-3.1', '2.4.51-3.1'),
+            ('mod_ssl(x86-64) = 2.4.58-1.1', '2.4.58-1.1'),
+            ('libssl.so.3()(64bit)', '3.1.4-2.1'),
+            ('config(httpd)', '2.4.58-1.1'),
         ]
-        outputs = [b'2.3.1', b'package', b'2.2.4', b'package']
-
-        def cmd_output(command):
-            if '-q' in command:
-                raise Exception('rpm not installed')
-            return outputs.pop()
-
-        mock_run.side_effect = cmd_output
-        assert find_package_version('package', '/foo') == '2.3.1'
-        mock_run.assert_has_calls([
-            call([
-                'rpm', '-qp', '--queryformat',
-                '%{NAME}', '/foo/bar/package.rpm'
-            ]),
-            call([
-                'rpm', '-qp', '--queryformat',
-                '%{VERSION}-%{RELEASE}', '/foo/bar/package.rpm'
-            ]),
-        ])
+        for provide, version in provides:
+            index.add(provide, version)
+        for capability in (
+            'httpd', 'ssl', 'so.3', 'd = 2', 'x86-64', 'h', ' = ',
+            'missing', 'httpx', '(64bit)',
+        ):
+            assert index.find(capability) == [
+                version for provide, version in provides
+                if capability in provide
+            ]
 
-    @patch('subprocess.check_output')
-    @patch('os.walk')
-    def test_find_package_version_not_found(self, mock_walk, mock_run):
-        mock_walk.return_value = [
-            ('/foo', ['bar', 'zez'], ['baz']),
-            ('/foo/bar', [], ['spam', 'package.rpm']),
-            ('/foo/zez', [], ['package.rpm', 'somefile'])
+        assert index.find_exact('httpd') == ['2.4.58-1.1', '2.4.51-3.1']
+        assert index.find_exact('http') == []
+
+        # repeated searches are answered by a trigram index
+        module = sys.modules[CapabilityIndex.__module__]
+        monkeypatch.setattr(module, 'trigram_index_queries', 2)
+        with patch.object(
+            CapabilityIndex, '_get_trigrams', autospec=True,
+            side_effect=CapabilityIndex._get_trigrams,
+        ) as mock_get_trigrams:
+            index = CapabilityIndex()
+            for provide, version in provides:
+                index.add(provide, version)
+            assert index.find('ssl.so') == ['3.1.4-2.1']
+            assert index.find('httpd') == ['2.4.58-1.1', '2.4.51-3.1',
+                                           '2.4.58-1.1']
+            mock_get_trigrams.assert_not_called()
+            for capability in ('ssl.so', 'httpd', '(64bit)', 'missing'):
+                assert index.find(capability) == [
+                    version for provide, version in provides
+                    if capability in provide
+                ]
+            assert mock_get_trigrams.called
+            # new provides invalidate the trigram index
+            index.add('libssl.so.1.1()(64bit)', '1.1.1w-1.1')
+            assert index.find('ssl.so') == ['3.1.4-2.1', '1.1.1w-1.1']
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    def test_capability_index_is_not_stored(self, mock_read_header, tmp_path):
+        repo, headers = make_repo(tmp_path, {
+            'foo.rpm': RpmHeader(
+                'foo', None, '1.0', '1', 'noarch', ['foo = 1.0-1']
+            ),
+        })
+        mock_read_header.side_effect = headers.get
+
+        assert find_package_version_by_capability(repo, 'foo') == '1.0-1'
+        module = sys.modules[CapabilityIndex.__module__]
+        with open(os.path.join(repo, '.rupv-index'), 'rb') as index_file:
+            data = marshal.load(index_file)
+        assert data == (module.REPO_INDEX_FORMAT, data[1])
+        assert list(data[1]) == ['foo.rpm']
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpm_headers'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    def test_repo_index(
+        self, mock_read_header, mock_query_headers, tmp_path
+    ):
+        mock_query_headers.side_effect = lambda files, jobs: [None] * len(
+            files
+        )
+        repo, headers = make_repo(tmp_path, {
+            'a/foo.rpm': RpmHeader(
+                'foo', None, '1.0', '1', 'noarch', ['foo = 1.0-1']
+            ),
+            'b/bar.rpm': RpmHeader(
+                'bar', '2', '3.0', '1', 'noarch', ['bar = 2:3.0-1']
+            ),
+            'broken.rpm': None,
+        })
+        mock_read_header.side_effect = headers.get
+
+        assert find_package_version_by_capability(repo, 'bar') == '3.0-1'
+        assert mock_read_header.call_count == 3
+        assert os.path.isfile(os.path.join(repo, '.rupv-index'))
+        # the index is shared by everybody who can read the repository
+        umask = os.umask(0)
+        os.umask(umask)
+        assert os.stat(
+            os.path.join(repo, '.rupv-index')
+        ).st_mode & 0o777 == 0o666 & ~umask
+
+        # a new process only reads the packages that changed
+        _repo_indexes.clear()
+        _repo_catalogs.clear()
+        mock_read_header.reset_mock()
+        assert find_package_version_in_local_repos(repo, 'foo') == '1.0-1'
+        mock_read_header.assert_not_called()
+
+        _repo_indexes.clear()
+        _repo_catalogs.clear()
+        foo_rpm = os.path.join(repo, 'a/foo.rpm')
+        os.utime(foo_rpm, ns=(0, 0))
+        assert find_package_version_in_local_repos(repo, 'foo') == '1.0-1'
+        mock_read_header.assert_called_once_with(foo_rpm)
+
+        # removed packages are dropped from the index
+        os.unlink(os.path.join(repo, 'b/bar.rpm'))
+        _repo_indexes.clear()
+        index = get_repo_index(repo)
+        index.save()
+        _repo_indexes.clear()
+        assert sorted(get_repo_index(repo)._entries) == [
+            'a/foo.rpm', 'broken.rpm'
         ]
-        outputs = [b'another_non_matching_name', b'not_matching_name']
 
-        def cmd_output(command):
-            if '-q' in command:
-                raise Exception('rpm not installed')
-            return outputs.pop()
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    def test_repo_catalog(self, mock_read_header, tmp_path):
+        repo, headers = make_repo(tmp_path, {
+            'python311-3.11.7-1.1.x86_64.rpm': RpmHeader(
+                'python311', None, '3.11.7', '1.1', 'x86_64',
+                ['python311 = 3.11.7-1.1', 'python3 = 3.11.7']
+            ),
+            'python311-3.11.10-1.1.x86_64.rpm': RpmHeader(
+                'python311', None, '3.11.10', '1.1', 'x86_64',
+                ['python311 = 3.11.10-1.1', 'python3 = 3.11.10']
+            ),
+            'python311-base-3.11.10-1.1.x86_64.rpm': RpmHeader(
+                'python311-base', None, '3.11.10', '1.1', 'x86_64', []
+            ),
+            'python312-3.12.1-2.1.x86_64.rpm': RpmHeader(
+                'python312', None, '3.12.1', '2.1', 'x86_64',
+                ['python312 = 3.12.1-2.1', 'python3 = 3.12.1']
+            ),
+        })
+        mock_read_header.side_effect = headers.get
+        catalog = RepoCatalog(repo, jobs=1)
+        catalog.scan()
+
+        # only the headers of the python311 packages are read
+        assert catalog.find_version('python311') == '3.11.10-1.1'
+        assert sorted(mock_read_header.call_args_list) == [
+            call(os.path.join(repo, 'python311-3.11.10-1.1.x86_64.rpm')),
+            call(os.path.join(repo, 'python311-3.11.7-1.1.x86_64.rpm')),
+        ]
+        assert catalog.find_version('python3') is None
+        assert mock_read_header.call_count == 2
 
-        mock_run.side_effect = cmd_output
-        try:
-            find_package_version('package', '/foo') == '2.3.1'
-        except Exception as e:
-            assert 'Package package version not found' in str(e)
-        mock_run.assert_has_calls([
-            call([
-                'rpm', '-qp', '--queryformat',
-                '%{NAME}', '/foo/bar/package.rpm'
-            ]),
-            call([
-                'rpm', '-qp', '--queryformat',
-                '%{NAME}', '/foo/zez/package.rpm'
-            ])
+        assert catalog.find_version_by_capability('python3') == '3.12.1-2.1'
+        assert catalog.find_version_by_capability('python2') is None
+        assert mock_read_header.call_count == 4
+        assert catalog.find_version('python311') == '3.11.10-1.1'
+        assert mock_read_header.call_count == 4
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    def test_repo_catalog_misleading_file_names(
+        self, mock_read_header, tmp_path
+    ):
+        repo, headers = make_repo(tmp_path, {
+            # the version in the file name does not match the header
+            'foo-2.0-1.noarch.rpm': RpmHeader(
+                'foo', None, '1.0', '1', 'noarch', []
+            ),
+            'foo-1.5-1.noarch.rpm': RpmHeader(
+                'foo', None, '1.5', '1', 'noarch', []
+            ),
+            'foo-1.0-1.noarch.rpm': RpmHeader(
+                'foo', None, '1.0', '1', 'noarch', []
+            ),
+            # file names without an architecture are always read
+            'foo.rpm': RpmHeader('foo', None, '1.2', '1', 'noarch', []),
+            'bar.rpm': RpmHeader('bar', None, '3.0', '1', 'noarch', []),
+        })
+        mock_read_header.side_effect = headers.get
+        catalog = RepoCatalog(repo, jobs=1)
+        catalog.scan()
+
+        assert catalog.find_version('foo') == '1.5-1'
+        assert mock_read_header.call_count == 5
+
+    def test_walk_repo(self, tmp_path):
+        repo, _ = make_repo(tmp_path, {
+            'x86_64/foo-1.0-1.x86_64.rpm': None,
+            'x86_64/foo-debuginfo-1.0-1.x86_64.rpm': None,
+            'x86_64/foo-debugsource-1.0-1.x86_64.rpm': None,
+            'src/foo-1.0-1.src.rpm': None,
+            'nosrc/bar-1.0-1.nosrc.rpm': None,
+            'repodata/repomd.xml': None,
+            'repodata/old/baz-1.0-1.noarch.rpm': None,
+            'repo.solv': None,
+            'README': None,
+        })
+        # the same packages linked into another project
+        os.makedirs(os.path.join(repo, 'project'))
+        os.symlink('../x86_64', os.path.join(repo, 'project', 'x86_64'))
+        os.link(
+            os.path.join(repo, 'x86_64', 'foo-1.0-1.x86_64.rpm'),
+            os.path.join(repo, 'project', 'foo.rpm'),
+        )
+        os.symlink('..', os.path.join(repo, 'project', 'loop'))
+        os.symlink('missing', os.path.join(repo, 'dangling.rpm'))
+
+        files = walk_repo(repo)
+        assert list(files.packages) == [
+            os.path.join(repo, 'project', 'foo.rpm'),
+        ]
+        assert list(files.metadata) == [
+            os.path.join(repo, 'repo.solv'),
+            os.path.join(repo, 'repodata', 'repomd.xml'),
+        ]
+        assert files.packages[
+            os.path.join(repo, 'project', 'foo.rpm')
+        ].st_size == len('x86_64/foo-1.0-1.x86_64.rpm')
+
+        # an excluded file is still found via another path, the directory
+        # linked into the project is only walked once
+        files = walk_repo(repo, ('*/*.rpm',), ('*.src.rpm', '*/foo.rpm'))
+        assert list(files.packages) == [
+            os.path.join(repo, 'nosrc', 'bar-1.0-1.nosrc.rpm'),
+        ] + [
+            os.path.join(repo, 'project', 'x86_64', name) for name in (
+                'foo-1.0-1.x86_64.rpm',
+                'foo-debuginfo-1.0-1.x86_64.rpm',
+                'foo-debugsource-1.0-1.x86_64.rpm',
+            )
+        ]
+
+        # every file is only found once across multiple walks
+        seen = set()
+        assert walk_repo(repo, seen=seen).packages
+        assert not walk_repo(
+            os.path.join(repo, 'x86_64'), seen=seen
+        ).packages
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    def test_repo_catalog_multiple_repos(self, mock_read_header, tmp_path):
+        repo1, headers = make_repo(tmp_path / 'one', {
+            'foo-1.0-1.noarch.rpm': RpmHeader(
+                'foo', None, '1.0', '1', 'noarch', ['foo = 1.0-1']
+            ),
+        })
+        repo2, headers2 = make_repo(tmp_path / 'two', {
+            'foo-2.0-1.noarch.rpm': RpmHeader(
+                'foo', None, '2.0', '1', 'noarch', ['foo = 2.0-1']
+            ),
+            'foo-debuginfo-3.0-1.noarch.rpm': RpmHeader(
+                'foo-debuginfo', None, '3.0', '1', 'noarch', ['foo-debug']
+            ),
+        })
+        headers.update(headers2)
+        mock_read_header.side_effect = headers.get
+
+        repos = LocalRepos((repo1, repo2))
+        assert find_package_version('foo', repos) == '2.0-1'
+        assert find_package_version_by_capability(repos, 'foo') == '2.0-1'
+        assert find_package_version_by_capability(repos, 'debug') is None
+        # every repository keeps its own header index
+        assert os.path.exists(os.path.join(repo1, '.rupv-index'))
+        assert os.path.exists(os.path.join(repo2, '.rupv-index'))
+        assert mock_read_header.call_count == 2
+
+        _repo_catalogs.clear()
+        _repo_indexes.clear()
+        assert find_package_version_by_capability(
+            repos._replace(excludes=()), 'debug'
+        ) == '3.0-1'
+        assert mock_read_header.call_count == 3
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    def test_repo_catalog_epoch(self, mock_read_header, tmp_path):
+        repo, headers = make_repo(tmp_path, {
+            'foo-2.0-1.noarch.rpm': RpmHeader(
+                'foo', None, '2.0', '1', 'noarch', []
+            ),
+            'foo-1.0-1.noarch.rpm': RpmHeader(
+                'foo', '1', '1.0', '1', 'noarch', []
+            ),
+        })
+        mock_read_header.side_effect = headers.get
+        catalog = RepoCatalog(repo, jobs=1)
+        catalog.scan()
+
+        # the epoch is not part of the file name but wins over the version
+        assert catalog.find_version('foo') == '1.0-1'
+        catalog.load()
+        assert catalog.find_version('foo') == '1.0-1'
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    def test_repo_catalog_repodata(self, mock_read_header, tmp_path):
+        repo, headers = make_repo(tmp_path, {
+            'x86_64/apache2-2.4.58-1.1.x86_64.rpm': None,
+            'noarch/apache2-doc-2.4.58-1.1.noarch.rpm': None,
+            'x86_64/nginx-1.25.3-1.1.x86_64.rpm': RpmHeader(
+                'nginx', None, '1.25.3', '1.1', 'x86_64',
+                ['nginx = 1.25.3-1.1', 'httpd']
+            ),
+        })
+        mock_read_header.side_effect = headers.get
+        apache2_size = len('x86_64/apache2-2.4.58-1.1.x86_64.rpm')
+        (tmp_path / 'repos' / 'repodata').mkdir()
+        (tmp_path / 'repos' / 'repodata' / 'repomd.xml').write_text(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<repomd xmlns="http://linux.duke.edu/metadata/repo">\n'
+            '  <data type="primary">\n'
+            '    <location href="repodata/abc-primary.xml.gz"/>\n'
+            '  </data>\n'
+            '</repomd>\n'
+        )
+        with gzip.open(
+            tmp_path / 'repos' / 'repodata' / 'abc-primary.xml.gz', 'wt'
+        ) as primary:
+            primary.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+                'xmlns:rpm="http://linux.duke.edu/metadata/rpm" '
+                'packages="4">\n'
+                '<package type="rpm">\n'
+                '  <name>apache2</name>\n'
+                '  <arch>x86_64</arch>\n'
+                '  <version epoch="0" ver="2.4.58" rel="1.1"/>\n'
+                f'  <size package="{apache2_size}" installed="1" '
+                'archive="1"/>\n'
+                '  <location href="x86_64/apache2-2.4.58-1.1.x86_64.rpm"/>\n'
+                '  <format>\n'
+                '    <rpm:provides>\n'
+                '      <rpm:entry name="apache2" flags="EQ" epoch="0" '
+                'ver="2.4.58" rel="1.1"/>\n'
+                '      <rpm:entry name="httpd" flags="EQ" epoch="0" '
+                'ver="2.4.58" rel="1.1"/>\n'
+                '      <rpm:entry name="config(apache2)"/>\n'
+                '    </rpm:provides>\n'
+                '  </format>\n'
+                '</package>\n'
+                '<package type="rpm">\n'
+                '  <name>apache2-doc</name>\n'
+                '  <arch>noarch</arch>\n'
+                '  <version epoch="1" ver="2.4.58" rel="1.1"/>\n'
+                '  <size package="1"/>\n'
+                '  <location '
+                'href="noarch/apache2-doc-2.4.58-1.1.noarch.rpm"/>\n'
+                '</package>\n'
+                # incomplete packages are skipped
+                '<package type="rpm">\n'
+                '  <name>nginx</name>\n'
+                '  <arch>x86_64</arch>\n'
+                '  <version epoch="0" ver="1.25.3" rel="1.1"/>\n'
+                '  <location href="x86_64/nginx-1.25.3-1.1.x86_64.rpm"/>\n'
+                '</package>\n'
+                '<package type="rpm">\n'
+                '  <name>broken</name>\n'
+                '  <version ver="1.0" rel="1"/>\n'
+                '  <size package="1"/>\n'
+                '</package>\n'
+                '</metadata>\n'
+            )
+
+        catalog = RepoCatalog(repo, jobs=1)
+        catalog.scan()
+        assert catalog.find_version('apache2') == '2.4.58-1.1'
+        mock_read_header.assert_not_called()
+        assert catalog._headers[os.path.join(
+            repo, 'x86_64/apache2-2.4.58-1.1.x86_64.rpm'
+        )] == RpmHeader(
+            'apache2', None, '2.4.58', '1.1', 'x86_64',
+            ['apache2 = 2.4.58-1.1', 'httpd = 2.4.58-1.1', 'config(apache2)']
+        )
+
+        # packages that are not covered by the metadata or whose size does
+        # not match are read
+        assert catalog.find_version_by_capability('httpd') == '2.4.58-1.1'
+        mock_read_header.assert_has_calls([
+            call(os.path.join(
+                repo, 'noarch/apache2-doc-2.4.58-1.1.noarch.rpm'
+            )),
+            call(os.path.join(repo, 'x86_64/nginx-1.25.3-1.1.x86_64.rpm')),
+        ], any_order=True)
+        assert mock_read_header.call_count == 2
+
+    def test_parse_rpm_filename(self):
+        nevra = parse_rpm_filename('hello-world-1.1.2.P3-1.x86_64.rpm')
+        assert nevra == RpmFilename('hello-world', '1.1.2.P3', '1', 'x86_64')
+        assert nevra.version_release == '1.1.2.P3-1'
+        assert parse_rpm_filename(
+            'apache2-2.4.58-150600.5.3.1.x86_64.rpm'
+        ) == RpmFilename('apache2', '2.4.58', '150600.5.3.1', 'x86_64')
+        assert parse_rpm_filename('package.rpm') is None
+        assert parse_rpm_filename('foo-1.0.noarch.rpm') is None
+
+    def test_find_highest_version(self):
+        assert find_highest_version([]) is None
+        assert find_highest_version(
+            ['1.0-1', '1.10-1', '1.9-5']
+        ) == '1.10-1'
+        # the epoch takes precedence but is not returned
+        assert find_highest_version(
+            ['1.10-1', '1:1.0-1', '0:1.9-5']
+        ) == '1.0-1'
+        assert find_highest_version(['0:1.0-1', '1.0-1']) == '1.0-1'
+
+    # taken from the rpmvercmp tests of rpm
+    @pytest.mark.parametrize('version1,version2,expected', [
+        ('1.0', '1.0', 0),
+        ('1.0', '2.0', -1),
+        ('2.0.1', '2.0.1a', -1),
+        ('5.5p1', '5.5p10', -1),
+        ('10xyz', '10.1xyz', -1),
+        ('xyz10', 'xyz10.1', -1),
+        ('xyz.4', '8', -1),
+        ('5.5p1', '5.5p1', 0),
+        ('10.0001', '10.1', 0),
+        ('10.0001', '10.0039', -1),
+        ('4_0', '4.0', 0),
+        ('2_0', '2_0', 0),
+        ('1.0a', '1.0.a', 0),
+        ('a+', 'a_', 0),
+        ('+', '_', 0),
+        ('1.0', '1.0~rc1', 1),
+        ('1.0~rc1', '1.0~rc2', -1),
+        ('1.0~rc1~git123', '1.0~rc1', -1),
+        ('1.0^', '1.0', 1),
+        ('1.0^', '1.0.1', -1),
+        ('1.0^git1', '1.0^git2', -1),
+        ('1.0^git1~pre', '1.0^git1', -1),
+        ('1.0^20160101', '1.0.1', -1),
+        ('6.0.rc1', '6.0', 1),
+        ('1b.fc17', '1.fc17', -1),
+        ('2a', '2.0', -1),
+        ('1.0', '1.fc4', 1),
+    ])
+    def test_version_key(self, version1, version2, expected):
+        key1, key2 = version_key(version1), version_key(version2)
+        assert (key1 > key2) - (key1 < key2) == expected
+        assert label_compare(
+            (None, version1, None), (None, version2, None)
+        ) == expected
+
+    def test_label_compare(self):
+        assert label_compare(('1', '1.0', '1'), (None, '2.0', '1')) == 1
+        assert label_compare((None, '1.0', '1'), ('0', '1.0', '1')) == -1
+        assert label_compare(('0', '1.0', None), ('0', '1.0', '')) == -1
+        assert compare_evrs('1.0', '0:1.0-5') == 0
+        assert compare_evrs('1:1.0', '2.0-5') == 1
+
+    def test_label_compare_matches_rpm(self):
+        rng = random.Random(0)
+        segments = ['0', '1', '01', '2', '10', 'a', 'b', 'rc', 'git']
+        separators = ['', '.', '_', '+', '~', '^']
+
+        def make_version():
+            return ''.join(
+                rng.choice(separators) + rng.choice(segments)
+                for _ in range(rng.randint(0, 4))
+            ) + rng.choice(separators)
+
+        for _ in range(2000):
+            label1 = tuple(make_version() for _ in range(3))
+            label2 = tuple(make_version() for _ in range(3))
+            assert label_compare(label1, label2) == rpm.labelCompare(
+                label1, label2
+            ), (label1, label2)
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    def test_read_rpm_headers(self, mock_read_header):
+        def read_header(rpm_file):
+            # finish the first files last
+            time.sleep(0.001 * (10 - int(rpm_file[:-4])))
+            return RpmHeader(rpm_file, None, '1', '1', 'noarch', [])
+
+        mock_read_header.side_effect = read_header
+        rpm_files = [f'{i}.rpm' for i in range(10)]
+        for jobs in (1, 4):
+            assert [
+                header.name for header in read_rpm_headers(rpm_files, jobs)
+            ] == rpm_files
+        assert read_rpm_headers([]) == []
+
+    def test_get_default_jobs(self, tmp_path, monkeypatch):
+        (tmp_path / 'build.data').write_text(
+            'RECIPEFILE="_service:Dockerfile"\n'
+            'BUILD_JOBS="12"\n'
+            "BUILD_DIST='/.build/build.dist'\n"
+        )
+        monkeypatch.setenv('BUILD_DIST', str(tmp_path / 'build.dist'))
+        assert get_default_jobs() == 12
+        assert guess_recipe_filename_from_env() == 'Dockerfile'
+
+        monkeypatch.delenv('BUILD_DIST')
+        assert get_default_jobs() == (os.cpu_count() or 1)
+
+    @patch('subprocess.run')
+    def test_query_rpm_headers(self, mock_run):
+        queried = {
+            'apache2.rpm': (
+                '@@rupv@@\tapache2\t(none)\t2.4.58\t1.1\tx86_64\n'
+                'apache2\t8\t2.4.58-1.1\n'
+                'httpd\t8\t2.4.58-1.1\n'
+                'config(apache2)\t0\t\n'
+            ),
+            'nginx.rpm': (
+                '@@rupv@@\tnginx\t1\t1.25.3\t1.1\tx86_64\n'
+                'nginx\t8\t1:1.25.3-1.1\n'
+            ),
+        }
+
+        def rpm_query(command, **kwargs):
+            files = command[len(rpm_query_command):]
+            output = ''.join(queried.get(f, '') for f in files)
+            returncode = 0 if all(f in queried for f in files) else 1
+            return subprocess.CompletedProcess(
+                command, returncode, output.encode()
+            )
+
+        mock_run.side_effect = rpm_query
+        assert query_rpm_headers(
+            ['nginx.rpm', 'apache2.rpm'], jobs=1
+        ) == [
+            RpmHeader(
+                'nginx', '1', '1.25.3', '1.1', 'x86_64',
+                ['nginx = 1:1.25.3-1.1']
+            ),
+            RpmHeader(
+                'apache2', None, '2.4.58', '1.1', 'x86_64', [
+                    'apache2 = 2.4.58-1.1', 'httpd = 2.4.58-1.1',
+                    'config(apache2)'
+                ]
+            ),
+        ]
+        mock_run.assert_called_once()
+
+        # a broken file is found by bisecting the chunk
+        mock_run.reset_mock()
+        headers = query_rpm_headers(
+            ['nginx.rpm', 'broken.rpm', 'apache2.rpm'], jobs=1
+        )
+        assert [h and h.name for h in headers] == ['nginx', None, 'apache2']
+        assert mock_run.call_count == 5
+
+        mock_run.side_effect = FileNotFoundError('rpm')
+        assert query_rpm_headers(['nginx.rpm'], jobs=1) == [None]
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version._get_max_args_length'
+    ))
+    def test_split_into_chunks(self, mock_max_length):
+        command_length = sum(len(arg) + 1 for arg in rpm_query_command)
+        # every file takes 5 + 1 + 8 bytes
+        mock_max_length.return_value = command_length + 3 * 14
+        rpm_files = [f'{i}.rpm' for i in range(7)]
+        assert _split_into_chunks(rpm_files, jobs=1) == [
+            rpm_files[0:3], rpm_files[3:6], rpm_files[6:]
+        ]
+        mock_max_length.return_value = 2 ** 20
+        assert _split_into_chunks(rpm_files, jobs=2) == [
+            rpm_files[0:4], rpm_files[4:]
+        ]
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpm_headers'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    def test_read_rpm_headers_cli_fallback(
+        self, mock_read_header, mock_query_headers
+    ):
+        header = RpmHeader('foo', None, '1', '1', 'noarch', [])
+        mock_read_header.side_effect = lambda f: header if f == 'a' else None
+        mock_query_headers.return_value = [None, header]
+        assert read_rpm_headers(['a', 'b', 'c'], jobs=1) == [
+            header, None, header
+        ]
+        mock_query_headers.assert_called_once_with(['b', 'c'], 1)
+
+    def test_repo_index_invalid_file(self, tmp_path):
+        (tmp_path / '.rupv-index').write_bytes(b'garbage')
+        assert RepoIndex(str(tmp_path))._entries == {}
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.get_repo_catalog'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpmdb'
+    ))
+    def test_find_package_version_installed_capability(
+        self, mock_query_rpmdb, mock_get_catalog, tmp_path, monkeypatch
+    ):
+        monkeypatch.chdir(tmp_path)
+        mock_get_catalog.return_value = RepoCatalog('repos')
+        installed = {
+            ('providename', 'httpd'): [RpmHeader(
+                'apache2', None, '2.4.58', '1.1', 'x86_64', ['httpd']
+            )],
+        }
+        mock_query_rpmdb.side_effect = lambda tag, value: installed.get(
+            (tag, value), []
+        )
+        assert find_package_version('httpd', 'repos') == '2.4.58-1.1'
+        mock_query_rpmdb.assert_has_calls([
+            call('name', 'httpd'), call('providename', 'httpd')
         ])
 
-    @patch("builtins.open", new_callable=mock_open, read_data="version: 2.2.1")
     @patch((
         'replace_using_package_version.'
-        'replace_using_package_version.run_command'
+        'replace_using_package_version.find_package_version'
     ))
-    @patch('os.listdir')
-    @patch('os.walk')
-    def test_find_package_version_in_obsinfo(
-        self, mock_walk, mock_listdir, mock_run, mock_file
+    def test_resolver_daemon(
+        self, mock_find_pkg, tmp_path, monkeypatch
+    ):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'repos').mkdir()
+        (tmp_path / 'repos' / 'foo.rpm').write_bytes(b'foo')
+        (tmp_path / 'rpmdb').mkdir()
+        (tmp_path / 'rpmdb' / 'rpmdb.sqlite').write_bytes(b'db')
+        module = sys.modules[make_resolver_server.__module__]
+        monkeypatch.setattr(module, 'rpmdb_paths', (str(tmp_path / 'rpmdb'),))
+        socket_path = str(tmp_path / 'rupv.sock')
+        monkeypatch.setenv('RUPV_SOCKET', socket_path)
+        mock_find_pkg.side_effect = lambda package, rpm_dir, jobs: {
+            'foo': '1.0-1', 'bar': '2.0-1'
+        }[package]
+
+        # without a daemon the versions are resolved in-process
+        assert query_resolver(socket_path, ['foo'], 'repos') is None
+        assert resolve_package_versions(['foo'], 'repos') == {
+            'foo': '1.0-1'
+        }
+        assert mock_find_pkg.call_count == 1
+
+        server = make_resolver_server(socket_path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            mock_find_pkg.reset_mock()
+            repos = LocalRepos((str(tmp_path / 'repos'),))
+            for _ in range(2):
+                assert resolve_package_versions(['foo', 'bar'], 'repos') == {
+                    'foo': '1.0-1', 'bar': '2.0-1'
+                }
+            assert mock_find_pkg.call_args_list == [
+                call('foo', repos, jobs=None), call('bar', repos, jobs=None)
+            ]
+
+            # changes of the repository invalidate the cached versions
+            (tmp_path / 'repos' / 'bar.rpm').write_bytes(b'bar')
+            assert resolve_package_versions(['foo'], 'repos') == {
+                'foo': '1.0-1'
+            }
+            assert mock_find_pkg.call_count == 3
+
+            # as do changes of the rpm database, which is opened again
+            monkeypatch.setattr(module, '_rpmdb_transaction_set', object())
+            (tmp_path / 'rpmdb' / 'rpmdb.sqlite').write_bytes(b'new db')
+            assert resolve_package_versions(['foo'], 'repos') == {
+                'foo': '1.0-1'
+            }
+            assert mock_find_pkg.call_count == 4
+            assert module._rpmdb_transaction_set is None
+
+            with pytest.raises(Exception, match="'baz'"):
+                resolve_package_versions(['baz'], 'repos')
+
+            with pytest.raises(Exception, match='already listening'):
+                make_resolver_server(socket_path)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        # a stale socket is replaced
+        make_resolver_server(socket_path).server_close()
+
+        # a daemon that does not reply is given up on
+        os.unlink(socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as hanging:
+            hanging.bind(socket_path)
+            hanging.listen()
+            assert query_resolver(
+                socket_path, ['foo'], 'repos', timeout=0.1
+            ) is None
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpmdb'
+    ))
+    @patch('docopt.docopt')
+    def test_main_trace(
+        self, mock_docopt, mock_query_rpmdb, mock_read_header, tmp_path,
+        monkeypatch
+    ):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv('RUPV_SOCKET', str(tmp_path / 'rupv.sock'))
+        _, headers = make_repo(tmp_path, {
+            'x86_64/foo-1.0-1.x86_64.rpm': RpmHeader(
+                'foo', None, '1.0', '1', 'x86_64', ['foo = 1.0-1']
+            ),
+        })
+        mock_read_header.side_effect = lambda f: headers.get(
+            os.path.abspath(f)
+        )
+        mock_query_rpmdb.return_value = []
+        (tmp_path / 'Dockerfile').write_text('FROM foo:%%VERSION%%\n')
+        (tmp_path / 'out').mkdir()
+        mock_docopt.return_value = {
+            '--package': 'foo',
+            '--file': ['Dockerfile'],
+            '--outdir': 'out',
+            '--regex': '%%VERSION%%',
+            '--trace': 'trace.json',
+        }
+        main()
+
+        mock_docopt.return_value['--package'] = 'bar'
+        with pytest.raises(Exception, match='Package bar version not found'):
+            main()
+
+        traces = [
+            json.loads(line)
+            for line in (tmp_path / 'trace.json').read_text().splitlines()
+        ]
+        assert len(traces) == 2
+        assert traces[0]['error'] is None
+        assert traces[0]['resolver'] == 'in-process'
+        assert traces[0]['packages']['foo']['version'] == '1.0-1'
+        assert traces[0]['packages']['foo']['stage'] == 'local_repos'
+        assert [
+            stage['stage'] for stage in traces[0]['packages']['foo']['stages']
+        ] == ['rpmdb', 'local_repos']
+        assert traces[0]['counters']['files_visited'] == 1
+        assert traces[0]['counters']['headers_read'] == 1
+        assert traces[0]['counters']['index_misses'] == 1
+        assert traces[0]['apply']['matches'] == 1
+
+        assert traces[1]['error'] == 'Package bar version not found'
+        assert traces[1]['packages']['bar']['version'] is None
+        assert len(traces[1]['packages']['bar']['stages']) == 5
+
+    def test_parse_dependency(self):
+        assert parse_dependency('httpd') == Dependency('httpd')
+        assert parse_dependency(' httpd  >=  2.4 ') == Dependency(
+            'httpd', RPMSENSE_GREATER | RPMSENSE_EQUAL, '2.4'
+        )
+        assert parse_dependency('python3dist(foo) < 3') == Dependency(
+            'python3dist(foo)', RPMSENSE_LESS, '3'
+        )
+        for dependency in ('httpd >=', 'httpd => 2 4', 'httpd ~ 2', ''):
+            with pytest.raises(Exception, match='Invalid dependency'):
+                parse_dependency(dependency)
+
+    @pytest.mark.parametrize('provide,require,expected', [
+        ('httpd = 2.4.58-1.1', 'httpd >= 2.4', True),
+        ('httpd = 2.4.58-1.1', 'httpd < 2.4', False),
+        ('httpd = 2.4.58-1.1', 'httpd < 2.5', True),
+        ('httpd = 2.4.58-1.1', 'httpd > 2.4.58', False),
+        ('httpd = 2.4.58-1.1', 'httpd = 2.4.58', True),
+        ('httpd = 2.4.58-1.1', 'httpd <= 2.4.58-1.0', False),
+        ('httpd = 2.4.58-1.1', 'httpd <= 2.4.58-1.1', True),
+        ('httpd = 1:2.4', 'httpd > 3', True),
+        ('httpd = 2.4', 'httpd > 0:2.3', True),
+        ('httpd = 2.4', 'httpd < 1:1.0', True),
+        ('httpd >= 2.4', 'httpd > 3', True),
+        ('httpd >= 2.4', 'httpd < 2.4', False),
+        ('httpd < 2.4', 'httpd <= 2.4', True),
+        ('httpd', 'httpd > 3', True),
+        ('httpd = 2.4', 'httpd', True),
+        ('apache2 = 2.4', 'httpd', False),
+    ])
+    def test_dependency_satisfies(self, provide, require, expected):
+        assert dependency_satisfies(
+            parse_dependency(provide), parse_dependency(require)
+        ) is expected
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpmdb'
+    ))
+    def test_find_package_version_by_dependency(
+        self, mock_query_rpmdb, mock_read_header, tmp_path, monkeypatch
+    ):
+        monkeypatch.chdir(tmp_path)
+        repo, headers = make_repo(tmp_path, {
+            'apache2-2.4.58.rpm': RpmHeader(
+                'apache2', None, '2.4.58', '1.1', 'x86_64',
+                ['apache2 = 2.4.58-1.1', 'httpd = 2.4.58-1.1']
+            ),
+            'apache2-2.4.51.rpm': RpmHeader(
+                'apache2', None, '2.4.51', '3.1', 'x86_64',
+                ['apache2 = 2.4.51-3.1', 'httpd = 2.4.51-3.1']
+            ),
+            'apache2-2.2.rpm': RpmHeader(
+                'apache2', None, '2.2.34', '2.1', 'x86_64',
+                ['apache2 = 2.2.34-2.1', 'httpd = 2.2.34-2.1']
+            ),
+        })
+        mock_read_header.side_effect = headers.get
+        mock_query_rpmdb.return_value = []
+
+        assert find_package_version('httpd >= 2.4', repo) == '2.4.58-1.1'
+        assert find_package_version('httpd < 2.4.58', repo) == '2.4.51-3.1'
+        assert find_package_version('httpd < 2.4', repo) == '2.2.34-2.1'
+        assert find_package_version('apache2 = 2.4.51', repo) == (
+            '2.4.51-3.1'
+        )
+        with pytest.raises(Exception, match='httpd > 3 version not found'):
+            find_package_version('httpd > 3', repo)
+
+        # installed packages take precedence
+        mock_query_rpmdb.return_value = [RpmHeader(
+            'apache2', None, '2.4.55', '1.1', 'x86_64',
+            ['apache2 = 2.4.55-1.1', 'httpd = 2.4.55-1.1']
+        )]
+        assert find_package_version('httpd >= 2.4', repo) == '2.4.55-1.1'
+        assert find_package_version('httpd < 2.4', repo) == '2.2.34-2.1'
+        mock_query_rpmdb.assert_called_with('providename', 'httpd')
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.read_rpm_header'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.query_rpmdb'
+    ))
+    def test_build_lock(
+        self, mock_query_rpmdb, mock_read_header, tmp_path, monkeypatch
     ):
-        mock_walk.return_value = [
-            ('/foo', ['bar', 'zez'], ['baz']),
-            ('/foo/bar', [], ['spam', 'package.rpm']),
-            ('/foo/zez', [], ['package.rpm', 'somefile'])
+        monkeypatch.chdir(tmp_path)
+        build_dir = tmp_path / '.build'
+        build_dir.mkdir()
+        (build_dir / 'build.data').write_text('BUILD_JOBS="1"\n')
+        monkeypatch.setenv('BUILD_DIST', str(build_dir / 'build.dist'))
+        repo, headers = make_repo(tmp_path, {
+            'x86_64/foo-1.0-1.x86_64.rpm': RpmHeader(
+                'foo', None, '1.0', '1', 'x86_64', ['foo = 1.0-1']
+            ),
+        })
+        mock_read_header.side_effect = headers.get
+        mock_query_rpmdb.return_value = []
+
+        assert find_package_version('foo', repo) == '1.0-1'
+        with pytest.raises(Exception, match='bar version not found'):
+            find_package_version('bar', repo)
+        assert mock_read_header.call_count == 1
+        calls = mock_query_rpmdb.call_count
+
+        lock = json.loads((build_dir / '.rupv-lock').read_text())
+        assert [
+            (entry['package'], entry['version'], entry['stage'])
+            for entry in lock['entries']
+        ] == [('foo', '1.0-1', 'local_repos'), ('bar', None, None)]
+        umask = os.umask(0)
+        os.umask(umask)
+        assert os.stat(
+            build_dir / '.rupv-lock'
+        ).st_mode & 0o777 == 0o666 & ~umask
+
+        # later invocations take the versions and failures from the lock
+        _build_locks.clear()
+        _repo_catalogs.clear()
+        assert find_package_version('foo', repo) == '1.0-1'
+        with pytest.raises(Exception, match='bar version not found'):
+            find_package_version('bar', repo)
+        assert mock_query_rpmdb.call_count == calls
+        assert mock_read_header.call_count == 1
+
+        # but not if an obsinfo file was added
+        (tmp_path / 'bar.obsinfo').write_text('version: 3.0\n')
+        assert get_build_lock().get('bar', repo) is None
+        os.unlink(tmp_path / 'bar.obsinfo')
+
+        # nor if the packages changed
+        os.makedirs(os.path.join(repo, 'noarch'))
+        headers[os.path.join(repo, 'noarch', 'bar-2.0-1.noarch.rpm')] = (
+            RpmHeader('bar', None, '2.0', '1', 'noarch', [])
+        )
+        (tmp_path / 'repos' / 'noarch' / 'bar-2.0-1.noarch.rpm').write_bytes(
+            b'bar'
+        )
+        assert find_package_version('bar', repo) == '2.0-1'
+
+        # nor in another build
+        stat = os.stat(build_dir / 'build.data')
+        os.utime(build_dir / 'build.data', ns=(
+            stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9
+        ))
+        _repo_catalogs.clear()
+        mock_query_rpmdb.return_value = [
+            RpmHeader('foo', None, '1.1', '1', 'x86_64', [])
         ]
-        mock_listdir.return_value = ['somefile', 'package.obsinfo']
-        outputs = ['another_non_matching_name', 'not_matching_name']
-
-        def cmd_output(command):
-            if '-q' in command:
-                raise Exception('rpm not installed')
-            return outputs.pop()
-
-        mock_run.side_effect = cmd_output
-
-        assert find_package_version('package', '/foo') == '2.2.1'
-
-        mock_run.assert_has_calls([
-            call([
-                'rpm', '-qp', '--queryformat',
-                '%{NAME}', '/foo/bar/package.rpm'
-            ]),
-            call([
-                'rpm', '-qp', '--queryformat',
-                '%{NAME}', '/foo/zez/package.rpm'
-            ])
+        assert find_package_version('foo', repo) == '1.1-1'
+
+    @patch('subprocess.run')
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.rpm.TransactionSet'
+    ))
+    def test_query_rpmdb(self, mock_ts, mock_run, monkeypatch, tmp_path):
+        module = sys.modules[query_rpmdb.__module__]
+        monkeypatch.setattr(module, '_rpmdb_transaction_set', None)
+        monkeypatch.setattr(module, 'rpmdb_paths', (str(tmp_path),))
+        mock_ts.return_value.dbMatch.return_value = [{
+            rpm.RPMTAG_NAME: 'zypper',
+            rpm.RPMTAG_EPOCH: None,
+            rpm.RPMTAG_VERSION: '1.14.68',
+            rpm.RPMTAG_RELEASE: '1.1',
+            rpm.RPMTAG_ARCH: 'x86_64',
+            rpm.RPMTAG_PROVIDENAME: ['zypper'],
+            rpm.RPMTAG_PROVIDEFLAGS: [RPMSENSE_EQUAL],
+            rpm.RPMTAG_PROVIDEVERSION: ['1.14.68-1.1'],
+        }]
+        assert get_pkg_version('zypper') == '1.14.68-1.1'
+        assert get_installed_version_by_capability('zypper') == '1.14.68-1.1'
+        mock_ts.return_value.dbMatch.assert_has_calls([
+            call('name', 'zypper'), call('providename', 'zypper')
         ])
+        # the rpm database is only opened once
+        mock_ts.assert_called_once_with()
+        mock_run.assert_not_called()
+
+        # fall back to rpm -q if the database cannot be opened
+        mock_ts.return_value.dbMatch.side_effect = rpm.error('no db')
+        mock_run.return_value = subprocess.CompletedProcess(
+            [], 0, b'@@rupv@@\tzypper\t(none)\t1.14.68\t1.1\tx86_64\n'
+        )
+        assert get_installed_version_by_capability('zypper') == '1.14.68-1.1'
+        assert mock_run.call_args[0][0][-2:] == ['--whatprovides', 'zypper']
+
+        mock_run.return_value = subprocess.CompletedProcess(
+            [], 1, b'package foo is not installed\n'
+        )
+        assert get_pkg_version('foo') is None
+
+        # fall back to rpm -q if the rpm bindings are not installed
+        monkeypatch.setattr(module, '_rpmdb_transaction_set', None)
+        monkeypatch.setattr(module, 'rpm', module._LazyModule('no_such_rpm'))
+        mock_run.return_value = subprocess.CompletedProcess(
+            [], 0, b'@@rupv@@\tzypper\t(none)\t1.14.68\t1.1\tx86_64\n'
+        )
+        assert get_pkg_version('zypper') == '1.14.68-1.1'
+        assert mock_run.call_args[0][0][-1] == 'zypper'
+
+        # without a rpm database nothing is installed
+        mock_run.reset_mock()
+        monkeypatch.setattr(module, 'rpmdb_paths', (str(tmp_path / 'no'),))
+        assert get_pkg_version('zypper') is None
+        mock_run.assert_not_called()
+
+    @pytest.mark.parametrize('argv,parsed_directly', [
+        (['--regex=a', '--outdir', 'o', '--replacement', 'x'], True),
+        (['--outdir=o', '--regex', '%%A%%', '--package=httpd >= 2.4',
+          '--parse-version=minor', '--file=Dockerfile', '--jobs=2',
+          '--trace', 't.json', '--stream-overlap=10'], True),
+        (['--outdir=o', '--rule=regex=a,package=b', '--rule',
+          'regex=c,replacement=d', '--file=f'], True),
+        (['--outdir=o', '--rules=rules.txt'], True),
+        (['--outdir=o', '--rules=r', '--repo-dir=a', '--repo-dir', 'b',
+          '--repo-include=*.rpm', '--repo-exclude=*-32bit-*'], True),
+        (['--serve', '--socket=s.sock'], True),
+        (['--outdir=o', '--template=true', '--file=Dockerfile'], True),
+        (['--outdir=o', '--template=true', '--regex=a'], False),
+        (['--outdir=o', '--rules=rules.txt', '--regex='], False),
+        (['--regex=a', '--outdir=o', '--replacement=x', '--package=y'],
+         False),
+        (['--regex=a', '--outdir=o'], False),
+        (['--regex=a', '--outdir=o', '--replacement=x', '--replacement=y'],
+         False),
+        (['--regex=a', '--outdir=o', '--replacement', '-x'], False),
+        (['--reg=a', '--outdir=o', '--replacement=x'], False),
+        (['--serve', '--outdir=o'], False),
+        (['--regex=a', '--outdir=o', '--package=p', '--file=a',
+          '--file=charts/*.yaml'], True),
+        (['--outdir=o', '--rule=r', '--regex-timeout=5'], True),
+        (['--outdir', 'out', '--template', 'true', '--file', 'Dockerfile',
+          '--regex-timeout', '5'], True),
+        (['--serve=yes'], False),
+        (['-h'], False),
+        ([], False),
+    ])
+    def test_parse_args(self, argv, parsed_directly):
+        module = sys.modules[parse_args.__module__]
+        try:
+            expected = docopt.docopt(module.__doc__, argv)
+        except (docopt.DocoptExit, SystemExit):
+            expected = None
+        fast = module._parse_args_fast(argv)
+        if parsed_directly:
+            assert fast == expected
+        else:
+            assert fast is None
+
+    def test_startup(self, tmp_path):
+        """Replacements and obsinfo lookups do not load librpm, nor docopt."""
+        (tmp_path / 'Dockerfile').write_text('FROM foo:%%VERSION%%\n')
+        (tmp_path / 'foo.obsinfo').write_text('version: 1.2.3\n')
+        (tmp_path / 'out').mkdir()
+        (tmp_path / 'rpmdb').mkdir()
+        script = (
+            'import os, sys, time\n'
+            'start = time.perf_counter()\n'
+            'import replace_using_package_version.'
+            'replace_using_package_version as module\n'
+            'module.rpmdb_paths = (os.environ["RPMDB"],)\n'
+            'if os.environ.get("NO_RPM"):\n'
+            '    sys.modules["rpm"] = None\n'
+            'module.main()\n'
+            'print(time.perf_counter() - start)\n'
+            'assert sys.modules.get("rpm") is None, "rpm was imported"\n'
+            'assert "docopt" not in sys.modules, "docopt was imported"\n'
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root, RUPV_SOCKET='rupv.sock')
+        for arg, extra_env in (
+            ('--replacement=1.2.3', {'RPMDB': 'no-rpmdb'}),
+            ('--package=foo', {'RPMDB': 'no-rpmdb'}),
+            # a rpm database without the rpm bindings (and without the rpm
+            # binary) still falls back to the obsinfo file
+            ('--package=foo', {'RPMDB': 'rpmdb', 'NO_RPM': '1', 'PATH': ''}),
+        ):
+            process = subprocess.run(
+                [sys.executable, '-c', script, '--regex=%%VERSION%%',
+                 '--outdir=out', '--file=Dockerfile', arg],
+                cwd=str(tmp_path), env=dict(env, **extra_env),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+            assert process.returncode == 0, process.stderr.decode()
+            assert (tmp_path / 'out' / 'Dockerfile').read_text() == (
+                'FROM foo:1.2.3\n'
+            )
+            # generous, it only catches imports of heavy modules
+            assert float(process.stdout.decode().splitlines()[-1]) < 1
+
+    def test_format_dependency(self):
+        assert format_dependency('httpd', 0, '') == 'httpd'
+        assert format_dependency(
+            'httpd', RPMSENSE_EQUAL, '2.4.58-1.1'
+        ) == 'httpd = 2.4.58-1.1'
+        assert format_dependency(
+            'foo', RPMSENSE_GREATER | RPMSENSE_EQUAL, '1.0'
+        ) == 'foo >= 1.0'
+        assert format_dependency('bar', RPMSENSE_LESS, '2') == 'bar < 2'
 
+    def test_parse_rpm_header(self, tmp_path):
+        package = rpmgen.Package(
+            'apache2', 1, '2.4.58', '1.1', 'x86_64', [
+                ('apache2', RPMSENSE_EQUAL, '1:2.4.58-1.1'),
+                ('httpd', RPMSENSE_EQUAL, '2.4.58'),
+                ('config(apache2)', 0, ''),
+            ]
+        )
+        rpm_file = tmp_path / package.filename
+        rpmgen.write_package(str(rpm_file), package)
+        # the payload is never read
+        with open(rpm_file, 'ab') as payload:
+            payload.write(b'\0' * 1024 * 1024)
+
+        header = parse_rpm_header(str(rpm_file))
+        assert header == RpmHeader(
+            'apache2', '1', '2.4.58', '1.1', 'x86_64', [
+                'apache2 = 1:2.4.58-1.1', 'httpd = 2.4.58', 'config(apache2)'
+            ]
+        )
+        assert read_rpm_header(str(rpm_file)) == header
+        assert get_pkg_name_from_rpm(str(rpm_file)) == 'apache2'
+        assert get_pkg_version_from_rpm(str(rpm_file)) == '2.4.58-1.1'
+
+        rpmgen.write_package(
+            str(rpm_file), package._replace(epoch=None, provides=[])
+        )
+        assert parse_rpm_header(str(rpm_file)) == RpmHeader(
+            'apache2', None, '2.4.58', '1.1', 'x86_64', []
+        )
+
+    def test_parse_rpm_header_invalid(self, tmp_path):
+        package = rpmgen.Package('foo', None, '1.0', '1', 'noarch', [])
+        rpm_file = tmp_path / package.filename
+        rpmgen.write_package(str(rpm_file), package)
+        data = rpm_file.read_bytes()
+
+        for contents in (b'', b'garbage', data[:200], data[:-1]):
+            rpm_file.write_bytes(contents)
+            assert parse_rpm_header(str(rpm_file)) is None
+        assert parse_rpm_header(str(tmp_path / 'missing.rpm')) is None
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.parse_rpm_header'
+    ), return_value=None)
     @patch((
         'replace_using_package_version.'
-        'replace_using_package_version.apply_regex_to_file'
+        'replace_using_package_version._get_transaction_set'
+    ))
+    @patch(open_to_patch, new_callable=mock_open)
+    def test_read_rpm_header(self, mock_file, mock_get_ts, mock_parse):
+        tags = {
+            rpm.RPMTAG_NAME: 'apache2',
+            rpm.RPMTAG_EPOCH: None,
+            rpm.RPMTAG_VERSION: '2.4.58',
+            rpm.RPMTAG_RELEASE: b'1.1',
+            rpm.RPMTAG_ARCH: 'x86_64',
+            rpm.RPMTAG_PROVIDENAME: ['apache2', 'httpd', 'config(apache2)'],
+            rpm.RPMTAG_PROVIDEFLAGS: [RPMSENSE_EQUAL, RPMSENSE_EQUAL, 0],
+            rpm.RPMTAG_PROVIDEVERSION: ['2.4.58-1.1', '2.4.58-1.1', ''],
+        }
+        mock_get_ts.return_value.hdrFromFdno.return_value = tags
+
+        header = read_rpm_header('apache2.rpm')
+        mock_file.assert_called_once_with('apache2.rpm', 'rb')
+        assert header == RpmHeader(
+            'apache2', None, '2.4.58', '1.1', 'x86_64',
+            ['apache2 = 2.4.58-1.1', 'httpd = 2.4.58-1.1', 'config(apache2)']
+        )
+        assert header.version_release == '2.4.58-1.1'
+
+        mock_get_ts.return_value.hdrFromFdno.side_effect = rpm.error('bad')
+        assert read_rpm_header('apache2.rpm') is None
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.apply_regexes_to_file'
     ))
     @patch((
         'replace_using_package_version.'
@@ -251,7 +1531,7 @@ class TestRegexReplacePackageVersion(object):
         mock_isfile.return_value = True
         mock_docopt.return_value = {
             '--package': 'package',
-            '--file': 'file',
+            '--file': ['file'],
             '--outdir': 'outdir',
             '--regex': 'regex',
             '--parse-version': 'minor'
@@ -259,10 +1539,11 @@ class TestRegexReplacePackageVersion(object):
         mock_find_pkg.return_value = '0.0.1'
         main()
         mock_find_pkg.assert_called_once_with(
-            'package', './repos'
+            'package', LocalRepos(('./repos',)), jobs=None
         )
         mock_apply_regex.assert_called_once_with(
-            'file', 'outdir/file', 'regex', '0.0'
+            'file', 'outdir/file', [('regex', '0.0')], overlap=None,
+            timeout=120,
         )
 
     @patch((
@@ -271,7 +1552,7 @@ class TestRegexReplacePackageVersion(object):
     ))
     @patch((
         'replace_using_package_version.'
-        'replace_using_package_version.apply_regex_to_file'
+        'replace_using_package_version.apply_regexes_to_file'
     ))
     @patch((
         'replace_using_package_version.'
@@ -288,7 +1569,7 @@ class TestRegexReplacePackageVersion(object):
         mock_isfile.return_value = True
         mock_docopt.return_value = {
             '--package': 'package',
-            '--file': 'file',
+            '--file': ['file'],
             '--outdir': 'outdir',
             '--regex': 'regex',
             '--parse-version': 'minor'
@@ -297,10 +1578,11 @@ class TestRegexReplacePackageVersion(object):
         mock_match_version.return_value = '0.0'
         main()
         mock_find_pkg.assert_called_once_with(
-            'package', './repos'
+            'package', LocalRepos(('./repos',)), jobs=None
         )
         mock_apply_regex.assert_called_once_with(
-            'file', 'outdir/file', 'regex', '0.0'
+            'file', 'outdir/file', [('regex', '0.0')], overlap=None,
+            timeout=120,
         )
         mock_match_version.assert_called_once_with(
             version_regex['minor'], '0.0.1'
@@ -321,7 +1603,7 @@ class TestRegexReplacePackageVersion(object):
         mock_isfile.return_value = True
         mock_docopt.return_value = {
             '--package': 'package',
-            '--file': 'file',
+            '--file': ['file'],
             '--outdir': 'outdir',
             '--regex': 'regex',
             '--parse-version': 'invalid-value'
@@ -338,7 +1620,7 @@ class TestRegexReplacePackageVersion(object):
 
     @patch((
         'replace_using_package_version.'
-        'replace_using_package_version.apply_regex_to_file'
+        'replace_using_package_version.apply_regexes_to_file'
     ))
     @patch('docopt.docopt')
     @patch('os.path.isdir')
@@ -350,32 +1632,598 @@ class TestRegexReplacePackageVersion(object):
         mock_isfile.return_value = True
         mock_docopt.return_value = {
             '--replacement': 'replacement',
-            '--file': 'file',
+            '--file': ['file'],
             '--outdir': 'outdir',
             '--regex': 'regex',
             '--package': None
         }
         main()
         mock_apply_regex.assert_called_once_with(
-            'file', 'outdir/file', 'regex', 'replacement'
+            'file', 'outdir/file', [('regex', 'replacement')],
+            overlap=None, timeout=120,
         )
 
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.apply_regexes_to_file'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.find_package_version'
+    ))
+    @patch('docopt.docopt')
+    @patch('os.path.isdir')
+    @patch('os.path.isfile')
+    def test_main_package_jobs(
+        self, mock_isfile, mock_isdir, mock_docopt,
+        mock_find_pkg, mock_apply_regex
+    ):
+        mock_isdir.return_value = True
+        mock_isfile.return_value = True
+        mock_docopt.return_value = {
+            '--package': 'package',
+            '--file': ['file'],
+            '--outdir': 'outdir',
+            '--regex': 'regex',
+            '--parse-version': None,
+            '--jobs': '16',
+        }
+        mock_find_pkg.return_value = '0.0.1-1'
+        main()
+        mock_find_pkg.assert_called_once_with(
+            'package', LocalRepos(('./repos',)), jobs=16
+        )
+
+        mock_docopt.return_value['--jobs'] = '0'
+        with pytest.raises(Exception) as e:
+            main()
+        assert "Invalid value '0' for --jobs flag." in str(e.value)
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.apply_regexes_to_file'
+    ))
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.find_package_version'
+    ))
+    @patch('docopt.docopt')
+    @patch('os.path.isdir')
+    @patch('os.path.isfile')
+    def test_main_rules(
+        self, mock_isfile, mock_isdir, mock_docopt,
+        mock_find_pkg, mock_apply_regex, tmp_path
+    ):
+        rules_file = tmp_path / 'rules'
+        rules_file.write_text(
+            '# all placeholders of the Dockerfile\n'
+            '\n'
+            'regex=%%OFFSET%%,package=mariadb,parse-version=offset\n'
+            'regex=%%NAME%%,replacement=mariadb\n'
+        )
+        mock_isdir.return_value = True
+        mock_isfile.return_value = True
+        mock_docopt.return_value = {
+            '--file': ['file'],
+            '--outdir': 'outdir',
+            '--regex': None,
+            '--package': None,
+            '--replacement': None,
+            '--parse-version': None,
+            '--rule': [
+                'regex=%%TAG%%,package=mariadb,parse-version=minor',
+                'regex=[0-9]{1,2}\\.x,package=httpd',
+            ],
+            '--rules': str(rules_file),
+        }
+        versions = {
+            'mariadb': '10.11.6+git5.g123-1.1',
+            'httpd': '2.4.58-1.1',
+        }
+        mock_find_pkg.side_effect = lambda pkg, rpm_dir, jobs: versions[pkg]
+        main()
+        # every package is only resolved once
+        mock_find_pkg.assert_has_calls([
+            call('mariadb', LocalRepos(('./repos',)), jobs=None),
+            call('httpd', LocalRepos(('./repos',)), jobs=None),
+        ], any_order=True)
+        assert mock_find_pkg.call_count == 2
+        mock_apply_regex.assert_called_once_with('file', 'outdir/file', [
+            ('%%TAG%%', '10.11'),
+            ('[0-9]{1,2}\\.x', '2.4.58'),
+            ('%%OFFSET%%', '5'),
+            ('%%NAME%%', 'mariadb'),
+        ], overlap=None, timeout=120)
+
+    def test_find_template_placeholders(self, tmp_path):
+        template = tmp_path / 'Dockerfile'
+        template.write_text(
+            'FROM mariadb:%%pkg:mariadb:minor%%\n'
+            'LABEL version="%%pkg:mariadb%%" offset="%%pkg:mariadb:offset%%"\n'
+            'RUN cpan %%pkg:perl(Foo::Bar):major%% %%pkg:httpd >= 2.4%%\n'
+            '%%pkg:mariadb:minor%% %%pkg:%% %%pkg:a\nb%% %%pkg:foo:bar%%'
+        )
+        assert find_template_placeholders(str(template)) == {
+            '%%pkg:mariadb:minor%%': ('mariadb', 'minor'),
+            '%%pkg:mariadb%%': ('mariadb', None),
+            '%%pkg:mariadb:offset%%': ('mariadb', 'offset'),
+            '%%pkg:perl(Foo::Bar):major%%': ('perl(Foo::Bar)', 'major'),
+            '%%pkg:httpd >= 2.4%%': ('httpd >= 2.4', None),
+            '%%pkg:foo:bar%%': ('foo:bar', None),
+        }
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.find_package_version'
+    ))
+    @patch('docopt.docopt')
+    def test_main_template(
+        self, mock_docopt, mock_find_pkg, tmp_path, monkeypatch
+    ):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'out').mkdir()
+        (tmp_path / 'Dockerfile').write_text(
+            'FROM mariadb:%%pkg:mariadb:minor%%\n'
+            'LABEL version="%%pkg:mariadb%%" offset="%%pkg:mariadb:offset%%"\n'
+            'RUN zypper in apache2=%%pkg:httpd:release%%\n'
+        )
+        mock_docopt.return_value = {
+            '--file': ['Dockerfile'],
+            '--outdir': 'out',
+            '--template': 'true',
+            '--jobs': '2',
+        }
+        versions = {
+            'mariadb': '10.11.6+git5.g123-1.1',
+            'httpd': '2.4.58-1.1',
+        }
+        mock_find_pkg.side_effect = lambda pkg, rpm_dir, jobs: versions[pkg]
+        main()
+
+        # every package is only resolved once
+        assert sorted(mock_find_pkg.call_args_list) == [
+            call('httpd', LocalRepos(('./repos',)), jobs=2),
+            call('mariadb', LocalRepos(('./repos',)), jobs=2),
+        ]
+        assert (tmp_path / 'out' / 'Dockerfile').read_text() == (
+            'FROM mariadb:10.11\n'
+            'LABEL version="10.11.6+git5.g123" offset="5"\n'
+            'RUN zypper in apache2=2.4.58-1.1\n'
+        )
+
+        mock_find_pkg.side_effect = Exception(
+            'Package httpd version not found'
+        )
+        with pytest.raises(Exception, match='httpd version not found'):
+            main()
+
+    def test_substitute_stream_function(self):
+        pattern = re.compile(r'%%pkg:(\w+)%%')
+        chunks = ['a %%pkg:foo%% %%pk', 'g:bar%% b\n', 'c %%pkg:foo%%']
+        assert ''.join(substitute_stream(
+            chunks, pattern, lambda match: match.group(1).upper(), 4
+        )) == 'a FOO BAR b\nc FOO'
+
+    def test_parse_rule(self):
+        assert parse_rule('regex=%%V%%,package=foo') == Rule(
+            regex='%%V%%', package='foo'
+        )
+        assert parse_rule(
+            'regex=a{1,2},b,replacement=x,y,parse-version=minor'
+        ) == Rule(
+            regex='a{1,2},b', replacement='x,y', parse_version='minor'
+        )
+        for rule, error in (
+            ('package=foo', 'no regex given'),
+            ('regex=a', 'either package or replacement must be given'),
+            (
+                'regex=a,package=foo,replacement=b',
+                'either package or replacement must be given'
+            ),
+            ('foo=bar,regex=a,package=foo', "unknown field 'foo'"),
+            ('something', "unknown field 'something'"),
+        ):
+            with pytest.raises(Exception) as e:
+                parse_rule(rule)
+            assert error in str(e.value)
+
+    def test_apply_regexes_to_file(self, tmp_path):
+        (tmp_path / 'input').write_text(
+            'LABEL VERSION=%%VERSION%%\n'
+            'LABEL RELEASE=%%RELEASE%%\n'
+        )
+        assert apply_regexes_to_file(
+            str(tmp_path / 'input'), str(tmp_path / 'output'), [
+                ('%%RELEASE%%', '%%VERSION%%-1'), ('%%VERSION%%', '1.2.3')
+            ]
+        ) == 3
+        # the substitutions are applied one after another
+        assert (tmp_path / 'output').read_text() == (
+            'LABEL VERSION=1.2.3\n'
+            'LABEL RELEASE=1.2.3-1\n'
+        )
+
+    @pytest.mark.parametrize('regex', ['%%VERSION%%', r'%%V\w+%%'])
+    def test_apply_regexes_to_file_unchanged(self, regex, tmp_path):
+        input_file = tmp_path / 'input'
+        output_file = tmp_path / 'output'
+        input_file.write_bytes(b'no placeholders\n\xc3\xa4\n')
+
+        # the file is copied if there is no match
+        assert apply_regexes_to_file(
+            str(input_file), str(output_file), [(regex, '1.0')]
+        ) == 0
+        assert output_file.read_bytes() == input_file.read_bytes()
+
+        # a different output is replaced atomically, keeping its permissions
+        output_file.write_text('old contents')
+        output_file.chmod(0o640)
+        with patch('os.replace', side_effect=OSError):
+            with pytest.raises(OSError):
+                apply_regexes_to_file(
+                    str(input_file), str(output_file), [(regex, '1.0')]
+                )
+        assert output_file.read_text() == 'old contents'
+        assert sorted(os.listdir(tmp_path)) == ['input', 'output']
+        inode = output_file.stat().st_ino
+        assert apply_regexes_to_file(
+            str(input_file), str(output_file), [(regex, '1.0')]
+        ) == 0
+        assert output_file.read_bytes() == input_file.read_bytes()
+        assert output_file.stat().st_ino != inode
+        assert output_file.stat().st_mode & 0o777 == 0o640
+        assert sorted(os.listdir(tmp_path)) == ['input', 'output']
+
+        # an existing output with the same contents is not touched
+        os.utime(output_file, ns=(0, 0))
+        assert apply_regexes_to_file(
+            str(input_file), str(output_file), [(regex, '1.0')]
+        ) == 0
+        assert output_file.stat().st_mtime_ns == 0
+
+        input_file.write_text('VERSION=%%VERSION%%\n')
+        output_file.write_text('VERSION=1.0\n')
+        os.utime(output_file, ns=(0, 0))
+        assert apply_regexes_to_file(
+            str(input_file), str(output_file), [(regex, '1.0')]
+        ) == 1
+        assert output_file.stat().st_mtime_ns == 0
+
+        # in place substitution without a match
+        os.utime(input_file, ns=(0, 0))
+        assert apply_regexes_to_file(
+            str(input_file), str(input_file), [('%%NOPE%%', '1.0')]
+        ) == 0
+        assert input_file.stat().st_mtime_ns == 0
+
+    def test_apply_regexes_to_file_carriage_returns(self, tmp_path):
+        (tmp_path / 'input').write_bytes(b'foo\r\nbar\r\n')
+        apply_regexes_to_file(
+            str(tmp_path / 'input'), str(tmp_path / 'output'),
+            [('%%VERSION%%', '1.0')]
+        )
+        # carriage returns are translated when reading in text mode
+        assert (tmp_path / 'output').read_bytes() == b'foo\nbar\n'
+
+    @pytest.mark.parametrize('regex,replacement', [
+        ('%%VERSION%%', '1.2.3'),
+        (r'\bab\b', r'\g<0>!'),
+        (r'foo\s*bar', 'X'),
+        (r'(?m)^bar', 'B'),
+        (r'(?<=foo)bar', 'Q'),
+        (r'(?s)foo.{0,10}bar', 'Z'),
+        (r'a$', 'E'),
+        (r'\Aba.', 'S'),
+    ])
+    def test_apply_regexes_to_file_streaming(
+        self, regex, replacement, tmp_path, monkeypatch
+    ):
+        module = sys.modules[apply_regexes_to_file.__module__]
+        monkeypatch.setattr(module, 'streaming_threshold', 0)
+        monkeypatch.setattr(module, 'stream_chunk_size', 7)
+        rand = random.Random(42)
+        words = ['foo', 'bar', '%%VERSION%%', '\n', ' ', 'baz\n', 'ab']
+        contents = ''.join(rand.choice(words) for _ in range(2000))
+        (tmp_path / 'input').write_text(contents)
+        output = tmp_path / 'output'
+        output.write_text('old contents')
+        output.chmod(0o640)
+
+        apply_regexes_to_file(
+            str(tmp_path / 'input'), str(output), [(regex, replacement)],
+            overlap=32
+        )
+        assert output.read_text() == re.sub(regex, replacement, contents)
+        assert output.stat().st_mode & 0o777 == 0o640
+        assert sorted(os.listdir(tmp_path)) == ['input', 'output']
+
+    def test_combine_literal_substitutions(self):
+        def combine(*substitutions):
+            return [
+                pattern.pattern for pattern, _ in
+                _combine_literal_substitutions([
+                    (re.compile(regex), replacement)
+                    for regex, replacement in substitutions
+                ])
+            ]
+
+        assert combine(
+            ('%%TAG%%', '10.3'), ('%%OFFSET%%', '5'), (r'%%\w+%%', 'x'),
+            ('%%NAME%%', 'mariadb'), ('%%ARCH%%', 'x86_64'),
+        ) == ['(%%TAG%%|%%OFFSET%%)', r'%%\w+%%', '(%%NAME%%|%%ARCH%%)']
+        # the literals must start with the same character
+        assert combine(('zypper', 'x'), ('LABEL', 'y')) == ['zypper', 'LABEL']
+        # a later literal could match in (or next to) an earlier replacement
+        assert combine(('%%A%%', 'B'), ('B', 'x')) == ['%%A%%', 'B']
+        assert combine(('%%A%%', ''), ('ab', 'x')) == ['%%A%%', 'ab']
+        assert combine(('%%A%%', 'B%'), ('%%B%%', 'x')) == ['%%A%%', '%%B%%']
+        assert combine(('%%A%%', '1.0'), ('%%B1%%', 'x')) == [
+            '(%%A%%|%%B1%%)'
+        ]
+        assert combine(('a\nb', 'x'), ('c', 'y')) == ['a\nb', 'c']
+        assert combine(('abc', 'x'), ('b', 'y')) == ['abc', 'b']
+        assert combine(('a', 'x'), ('a', 'y')) == ['a', 'a']
+        # only literals replaced by strings are combined
+        assert combine(('a', 'x'), ('b', lambda match: 'y')) == ['a', 'b']
+        assert combine(('(?i)a', 'x'), ('b', 'y')) == ['(?i)a', 'b']
+
+    def test_apply_regexes_to_file_literals(self, tmp_path):
+        # the combined and literal substitutions give the same result as
+        # applying the regexes one after another
+        rand = random.Random(7)
+        for _ in range(300):
+            contents = ''.join(rand.choice('ab%\n') for _ in range(60))
+            substitutions = [
+                (
+                    '%' + ''.join(rand.choice('ab%') for _ in range(
+                        rand.randint(0, 2)
+                    )),
+                    rand.choice(['', 'x', 'y\\n', 'a', r'<\g<0>>']),
+                )
+                for _ in range(rand.randint(1, 4))
+            ]
+            expected, count = contents, 0
+            for regex, replacement in substitutions:
+                expected, matches = re.subn(regex, replacement, expected)
+                count += matches
+            (tmp_path / 'input').write_text(contents)
+            assert apply_regexes_to_file(
+                str(tmp_path / 'input'), str(tmp_path / 'output'),
+                substitutions
+            ) == count
+            assert (tmp_path / 'output').read_text() == expected
+
+        # literals occurring at overlapping positions
+        (tmp_path / 'input').write_text('%%B%%A%% %%A%%B%%')
+        assert apply_regexes_to_file(
+            str(tmp_path / 'input'), str(tmp_path / 'output'),
+            [('%%A%%', '1'), ('%%B%%', '2')]
+        ) == 2
+        assert (tmp_path / 'output').read_text() == '%%B1 1B%%'
+
+    def test_regex_is_line_local(self):
+        for regex in ('%%VERSION%%', r'\bfoo-\d+', r'[a-z]+', r'\S+'):
+            assert _regex_is_line_local(re.compile(regex))
+        for regex in (
+            r'foo\nbar', r'foo\s', r'[^a]', r'.', r'^foo', r'foo$',
+            r'(?s:.)', r'(?=x)', r'[\x00-\x7f]', r'\W',
+        ):
+            if regex == r'.':
+                assert _regex_is_line_local(re.compile(regex))
+                assert not _regex_is_line_local(re.compile(regex, re.S))
+            else:
+                assert not _regex_is_line_local(re.compile(regex))
+
+    @pytest.mark.parametrize('regex,expected', [
+        (r'(a+)+', True),
+        (r'(\w+\s?)*$', True),
+        (r'(?:a|b+)+c', True),
+        (r'x(a*)*', True),
+        (r'((ab)+)+', True),
+        (r'(?:x|(?:y+)+)', True),
+        (r'%%VERSION%%', False),
+        (r'(\d+\.)+\d+', False),
+        (r'(\w+)(\s+\w+)*', False),
+        (r'^(\d+(\.\d+){0,1})', False),
+        (r'(a?b?)*', False),
+        (r'(a+){2}', False),
+    ])
+    def test_regex_has_nested_quantifiers(self, regex, expected):
+        assert _regex_has_nested_quantifiers(re.compile(regex)) == expected
+
+    def test_apply_regexes_to_file_nested_quantifiers(self, tmp_path, capsys):
+        (tmp_path / 'input').write_text('aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa!')
+        with pytest.raises(Exception, match='nests unbounded quantifiers'):
+            apply_regexes_to_file(
+                str(tmp_path / 'input'), str(tmp_path / 'output'),
+                [('%%VERSION%%', '1.0'), (r'(a+)+$', 'x')]
+            )
+        assert not (tmp_path / 'output').exists()
+
+        # with a time budget they are only warned about
+        (tmp_path / 'input').write_text('version: 1.2.3\n')
+        for _ in range(2):
+            assert apply_regexes_to_file(
+                str(tmp_path / 'input'), str(tmp_path / 'output'),
+                [(r'(\d+\.?)+', '2.0')], timeout=5
+            ) == 1
+        assert (tmp_path / 'output').read_text() == 'version: 2.0\n'
+        assert capsys.readouterr().err.count('nests unbounded') == 1
+
+    def test_apply_regexes_to_file_timeout(self, tmp_path):
+        input_file = str(tmp_path / 'input')
+        output_file = str(tmp_path / 'output')
+        (tmp_path / 'input').write_text('x' * 40 + '\n%%VERSION%%\n')
+        substitutions = [('%%VERSION%%', '1.0'), (r'(x+x+)+y', 'z')]
+        errors = []
+
+        def apply():
+            start = time.perf_counter()
+            try:
+                apply_regexes_to_file(
+                    input_file, output_file, substitutions, timeout=0.2
+                )
+            except Exception as error:
+                errors.append((str(error), time.perf_counter() - start))
+
+        # interrupted by a signal in the main thread and by killing the
+        # worker process in other threads
+        apply()
+        thread = threading.Thread(target=apply)
+        thread.start()
+        thread.join()
+        assert len(errors) == 2
+        for message, seconds in errors:
+            assert message == (
+                "Applying the regex(es) '(x+x+)+y' to {0} took longer than "
+                "0.2 seconds, a regex might backtrack "
+                "catastrophically".format(input_file)
+            )
+            assert seconds < 5
+        assert os.listdir(tmp_path) == ['input']
+
+        # regexes finishing in time
+        substitutions[1] = (r'(x+)y|(\d)\.', r'<\2>')
+        apply()
+        assert (tmp_path / 'output').read_text() == 'x' * 40 + '\n<1>0\n'
+        os.unlink(output_file)
+        thread = threading.Thread(target=apply)
+        thread.start()
+        thread.join()
+        assert (tmp_path / 'output').read_text() == 'x' * 40 + '\n<1>0\n'
+        assert len(errors) == 2
+
+        # errors of the worker process are raised again
+        substitutions[1] = (r'x+', r'\3')
+        thread = threading.Thread(target=apply)
+        thread.start()
+        thread.join()
+        assert errors[-1][0].startswith('invalid group reference 3')
+
+        # literals are not run with a time limit
+        with patch((
+            'replace_using_package_version.'
+            'replace_using_package_version._call_with_timeout'
+        )) as mock_call:
+            assert apply_regexes_to_file(
+                input_file, output_file, [('%%VERSION%%', '1.0')], timeout=1
+            ) == 1
+            mock_call.assert_not_called()
+
     @patch('docopt.docopt')
     def test_main_no_file(self, mock_docopt):
         mock_docopt.return_value = {
-            '--file': 'file'
+            '--file': ['file']
         }
         try:
             main()
         except Exception as e:
             assert 'File file not found' in str(e)
 
+    def test_get_files_from_args(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        for path in (
+            'Dockerfile', 'Dockerfile.base', 'charts/a/Chart.yaml',
+            'charts/a/values.yaml', 'charts/b/values.yaml',
+        ):
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            open(path, 'w').close()
+        os.mkdir('charts/dir.yaml')
+
+        assert get_files_from_args({'--file': [
+            'Dockerfile*', './Dockerfile', 'charts/**/Chart.yaml',
+            'charts/a/*.yaml',
+        ]}) == [
+            'Dockerfile', 'Dockerfile.base', 'charts/a/Chart.yaml',
+            'charts/a/values.yaml',
+        ]
+        with pytest.raises(Exception, match='No file matches nope/\\*'):
+            get_files_from_args({'--file': ['Dockerfile', 'nope/*']})
+        with pytest.raises(RuntimeError, match='File nope not found'):
+            get_files_from_args({'--file': ['nope']})
+        # existing files are taken literally even if they look like globs
+        for path in ('Dockerfile[prod]', 'spec?.in'):
+            open(path, 'w').close()
+        assert get_files_from_args({'--file': [
+            'Dockerfile[prod]', 'spec?.in'
+        ]}) == ['Dockerfile[prod]', 'spec?.in']
+        with pytest.raises(Exception, match=(
+            'Files charts/a/values.yaml and charts/b/values.yaml would both '
+            'be written to values.yaml'
+        )):
+            get_files_from_args({'--file': ['charts/*/*.yaml']})
+
+        with patch((
+            'replace_using_package_version.'
+            'replace_using_package_version.guess_recipe_filename_from_env'
+        ), return_value='Dockerfile'):
+            assert get_files_from_args({'--file': []}) == ['Dockerfile']
+
+    @patch((
+        'replace_using_package_version.'
+        'replace_using_package_version.find_package_version'
+    ))
+    @patch('docopt.docopt')
+    def test_main_multiple_files(
+        self, mock_docopt, mock_find_pkg, tmp_path, monkeypatch, capsys
+    ):
+        monkeypatch.chdir(tmp_path)
+        os.mkdir('out')
+        os.makedirs('chart/templates')
+        (tmp_path / 'Dockerfile').write_text('FROM base:%%VERSION%%\n')
+        (tmp_path / 'chart' / 'Chart.yaml').write_text(
+            'version: %%VERSION%%\nappVersion: %%VERSION%%\n'
+        )
+        (tmp_path / 'chart' / 'values.yaml').write_text('tag: latest\n')
+        mock_docopt.return_value = {
+            '--file': ['Dockerfile', 'chart/*.yaml'],
+            '--outdir': 'out',
+            '--regex': '%%VERSION%%',
+            '--package': 'mariadb',
+            '--parse-version': 'minor',
+            '--jobs': '3',
+        }
+        mock_find_pkg.return_value = '10.11.6-1.1'
+        main()
+
+        # the version is only resolved once
+        mock_find_pkg.assert_called_once_with(
+            'mariadb', LocalRepos(('./repos',)), jobs=3
+        )
+        assert sorted(os.listdir('out')) == [
+            'Chart.yaml', 'Dockerfile', 'values.yaml'
+        ]
+        assert (tmp_path / 'out' / 'Dockerfile').read_text() == (
+            'FROM base:10.11\n'
+        )
+        assert (tmp_path / 'out' / 'Chart.yaml').read_text() == (
+            'version: 10.11\nappVersion: 10.11\n'
+        )
+        assert (tmp_path / 'out' / 'values.yaml').read_text() == (
+            'tag: latest\n'
+        )
+        assert capsys.readouterr().out == (
+            'Replaced 1 match(es) in Dockerfile\n'
+            'Replaced 2 match(es) in chart/Chart.yaml\n'
+            'Replaced 0 match(es) in chart/values.yaml\n'
+        )
+
+        # regexes are applied in the main thread under a time budget, without
+        # forking worker processes from threads
+        mock_docopt.return_value['--regex'] = r'(?:%%VERSION%%|latest)\b'
+        with patch('multiprocessing.get_context') as mock_get_context:
+            main()
+        mock_get_context.assert_not_called()
+        assert (tmp_path / 'out' / 'values.yaml').read_text() == (
+            'tag: 10.11\n'
+        )
+
     @patch('os.path.isfile')
     @patch('docopt.docopt')
     def test_main_no_outdir(self, mock_docopt, mock_file):
         mock_file.return_value = True
         mock_docopt.return_value = {
-            '--file': 'file',
+            '--file': ['file'],
             '--outdir': 'outdir'
         }
         try:
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+#
+# SPDX-FileCopyrightText: (c) 2023 SUSE LLC
+#
+# This file is part of obs-service-replace_using_package_version.
+#
+#   obs-service-replace_using_package_version is free software: you can
+#   redistribute it and/or modify it under the terms of the GNU General
+#   Public License as published by the Free Software Foundation, either
+#   version 3 of the License, or (at your option) any later version.
+#
+#   obs-service-replace_using_package_version is distributed in the hope
+#   that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#   implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with obs-service-replace_using_package_version.  If not,
+#   see <http://www.gnu.org/licenses/>.
+#
+"""
+Generator of rpm packages and synthetic repositories for the tests and the
+benchmarks.
+
+The packages consist of the rpm lead, the signature header and the main
+header only (without payload), which is all that is needed to look up
+versions. They are written directly, so neither rpmbuild nor the rpm
+bindings are required. The output only depends on the seed and the number
+of packages, so that benchmark results are comparable across commits.
+"""
+import os
+import random
+import struct
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+RPM_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+RPM_HEADER_MAGIC = b'\x8e\xad\xe8\x01\x00\x00\x00\x00'
+
+RPM_INT32_TYPE = 4
+RPM_STRING_TYPE = 6
+RPM_BIN_TYPE = 7
+RPM_STRING_ARRAY_TYPE = 8
+
+RPMTAG_HEADERSIGNATURES = 62
+RPMTAG_HEADERIMMUTABLE = 63
+RPMSIGTAG_SIZE = 1000
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_SUMMARY = 1004
+RPMTAG_LICENSE = 1014
+RPMTAG_OS = 1021
+RPMTAG_ARCH = 1022
+RPMTAG_SOURCERPM = 1044
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_PROVIDEFLAGS = 1112
+RPMTAG_PROVIDEVERSION = 1113
+RPMTAG_PAYLOADFORMAT = 1124
+
+RPMSENSE_EQUAL = 1 << 3
+
+# (name prefix, weight) of the generated package flavours
+_flavours = (
+    ('', 50),
+    ('lib', 20),
+    ('python3-', 15),
+    ('perl-', 10),
+    ('golang-', 5),
+)
+_words = (
+    'alpha', 'beta', 'core', 'crypto', 'data', 'devel', 'fast', 'gtk', 'http',
+    'image', 'json', 'kernel', 'lang', 'media', 'net', 'open', 'parse',
+    'qt', 'rpc', 'ssl', 'text', 'util', 'xml', 'yaml', 'zip',
+)
+
+
+class Package(NamedTuple):
+    name: str
+    epoch: Optional[int]
+    version: str
+    release: str
+    arch: str
+    #: (name, flags, version) tuples
+    provides: List[Tuple[str, int, str]]
+
+    @property
+    def filename(self) -> str:
+        return (
+            f'{self.name}-{self.version}-{self.release}.{self.arch}.rpm'
+        )
+
+    @property
+    def evr(self) -> str:
+        evr = f'{self.version}-{self.release}'
+        if self.epoch:
+            evr = f'{self.epoch}:{evr}'
+        return evr
+
+
+def _header_entry(tag: int, value) -> Tuple[int, int, object]:
+    if isinstance(value, int):
+        return tag, RPM_INT32_TYPE, [value]
+    if isinstance(value, str):
+        return tag, RPM_STRING_TYPE, value
+    if value and isinstance(value[0], int):
+        return tag, RPM_INT32_TYPE, value
+    return tag, RPM_STRING_ARRAY_TYPE, value
+
+
+def write_header(tags: Dict[int, object], region_tag: int) -> bytes:
+    """Serialize `tags` (tag -> int, str, list of int or list of str) into a
+    rpm header with an immutable region tagged `region_tag`.
+
+    """
+    entries = sorted(_header_entry(tag, value) for tag, value in tags.items())
+    index = []
+    data = bytearray()
+    for tag, tag_type, value in entries:
+        if tag_type == RPM_INT32_TYPE:
+            data.extend(b'\0' * (-len(data) % 4))
+            encoded = struct.pack(f'>{len(value)}i', *value)
+            count = len(value)
+        elif tag_type == RPM_STRING_TYPE:
+            encoded = value.encode() + b'\0'
+            count = 1
+        else:
+            encoded = b''.join(item.encode() + b'\0' for item in value)
+            count = len(value)
+        index.append(struct.pack('>4i', tag, tag_type, len(data), count))
+        data.extend(encoded)
+
+    # the region covers all entries, its trailer points back to the index
+    entry_count = len(index) + 1
+    index.insert(0, struct.pack(
+        '>4i', region_tag, RPM_BIN_TYPE, len(data), 16
+    ))
+    data.extend(struct.pack(
+        '>4i', region_tag, RPM_BIN_TYPE, -entry_count * 16, 16
+    ))
+    return (
+        RPM_HEADER_MAGIC
+        + struct.pack('>2i', entry_count, len(data))
+        + b''.join(index)
+        + bytes(data)
+    )
+
+
+def write_lead(name: str) -> bytes:
+    return (
+        RPM_LEAD_MAGIC
+        + struct.pack('>BBhh', 3, 0, 0, 1)
+        + name.encode()[:65].ljust(66, b'\0')
+        # os linux, signature type header signature
+        + struct.pack('>hh', 1, 5)
+        + b'\0' * 16
+    )
+
+
+def write_package(path: str, package: Package) -> None:
+    """Write the lead, signature and header of `package` to `path`."""
+    tags = {
+        RPMTAG_NAME: package.name,
+        RPMTAG_VERSION: package.version,
+        RPMTAG_RELEASE: package.release,
+        RPMTAG_SUMMARY: f'Synthetic package {package.name}',
+        RPMTAG_LICENSE: 'GPL-3.0-or-later',
+        RPMTAG_OS: 'linux',
+        RPMTAG_ARCH: package.arch,
+        RPMTAG_SOURCERPM: f'{package.name}-{package.version}-'
+                          f'{package.release}.src.rpm',
+        RPMTAG_PROVIDENAME: [name for name, _, _ in package.provides],
+        RPMTAG_PROVIDEFLAGS: [flags for _, flags, _ in package.provides],
+        RPMTAG_PROVIDEVERSION: [
+            version for _, _, version in package.provides
+        ],
+        RPMTAG_PAYLOADFORMAT: 'cpio',
+    }
+    if package.epoch is not None:
+        tags[RPMTAG_EPOCH] = package.epoch
+    header = write_header(tags, RPMTAG_HEADERIMMUTABLE)
+    signature = write_header(
+        {RPMSIGTAG_SIZE: len(header)}, RPMTAG_HEADERSIGNATURES
+    )
+    signature += b'\0' * (-len(signature) % 8)
+    with open(path, 'wb') as rpm_file:
+        rpm_file.write(write_lead(package.name) + signature + header)
+
+
+def _provides_count(rng: random.Random, prefix: str) -> int:
+    # most packages only provide themselves and a few symbols, libraries and
+    # language modules provide a lot more
+    if prefix == 'lib':
+        return rng.randint(2, 40)
+    if prefix in ('perl-', 'python3-'):
+        return min(int(rng.paretovariate(1.2)), 300) + 1
+    return rng.choice((1, 1, 1, 2, 2, 3, 5, 8))
+
+
+def _make_provides(
+    rng: random.Random, name: str, prefix: str, evr: str, arch: str
+) -> List[Tuple[str, int, str]]:
+    provides = [(name, RPMSENSE_EQUAL, evr)]
+    if arch != 'noarch':
+        provides.append((f'{name}(x86-64)', RPMSENSE_EQUAL, evr))
+    base = name[len(prefix):]
+    for i in range(_provides_count(rng, prefix) - 1):
+        if prefix == 'lib':
+            provides.append((f'{name}.so.{i}()(64bit)', 0, ''))
+        elif prefix == 'perl-':
+            module = base.replace('-', '::')
+            provides.append((f'perl({module}::Part{i})', 0, ''))
+        elif prefix == 'python3-':
+            provides.append(
+                (f'python3dist({base}-ext{i})', RPMSENSE_EQUAL,
+                 evr.split('-')[0])
+            )
+        elif prefix == 'golang-':
+            provides.append(
+                (f'golang(example.org/{base}/pkg{i})', RPMSENSE_EQUAL, evr)
+            )
+        else:
+            provides.append((f'config({name}-{i})', RPMSENSE_EQUAL, evr))
+    return provides
+
+
+def generate_packages(count: int, seed: int = 0) -> List[Package]:
+    """Return `count` deterministic synthetic packages.
+
+    About one in ten packages is present in multiple versions and a few have
+    an epoch, as in real repositories.
+
+    """
+    rng = random.Random(f'{seed}-{count}')
+    packages: List[Package] = []
+    index = 0
+    while len(packages) < count:
+        prefix = rng.choices(
+            [prefix for prefix, _ in _flavours],
+            [weight for _, weight in _flavours],
+        )[0]
+        name = f'{prefix}{rng.choice(_words)}-{rng.choice(_words)}-{index}'
+        index += 1
+        arch = rng.choice(('x86_64', 'x86_64', 'noarch'))
+        epoch = rng.choice((None,) * 19 + (1,))
+        versions = 1 if rng.random() < 0.9 else rng.randint(2, 3)
+        major = rng.randint(0, 30)
+        for minor in range(versions):
+            version = f'{major}.{minor}.{rng.randint(0, 99)}'
+            release = f'{rng.randint(1, 150)}.{rng.randint(1, 9)}'
+            evr = f'{version}-{release}'
+            if epoch:
+                evr = f'{epoch}:{evr}'
+            packages.append(Package(
+                name, epoch, version, release, arch,
+                _make_provides(rng, name, prefix, evr, arch),
+            ))
+    return packages[:count]
+
+
+def generate_repo(path: str, count: int, seed: int = 0) -> List[Package]:
+    """Write `count` synthetic packages into the directory `path`, spread
+    over per architecture subdirectories like in a build root.
+
+    """
+    packages = generate_packages(count, seed)
+    for package in packages:
+        directory = os.path.join(path, package.arch)
+        os.makedirs(directory, exist_ok=True)
+        write_package(os.path.join(directory, package.filename), package)
+    return packages
+
+
+def generate_input_file(
+    path: str, size: int, versions: List[str], seed: int = 0
+) -> None:
+    """Write a text file of about `size` bytes that looks like a big build
+    recipe, with one of `versions` mentioned every few lines.
+
+    """
+    rng = random.Random(f'{seed}-{size}')
+    lines = [
+        'RUN zypper --non-interactive install --no-recommends {0}\n',
+        'LABEL org.opencontainers.image.version="{1}"\n',
+        '# plain comment line without any version at all, {2}\n',
+        'ENV PATH=/usr/local/bin:/usr/bin:/bin BUILD_ID={2}\n',
+        'COPY files/{0} /usr/share/{0}\n',
+    ]
+    written = 0
+    with open(path, 'w') as input_file:
+        while written < size:
+            line = rng.choice(lines).format(
+                rng.choice(_words), rng.choice(versions),
+                rng.randint(0, 10 ** 6),
+            )
+            input_file.write(line)
+            written += len(line)